@@ -1,25 +1,71 @@
 # Easily capture stdout/stderr of the current process and subprocesses.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 7, 2020
+# Last Change: October 16, 2026
 # URL: https://capturer.readthedocs.io
 
 """Easily capture stdout/stderr of the current process and subprocesses."""
 
 # Standard library modules.
+import array
+import binascii
+import bisect
+import codecs
+import ctypes
+import errno
+import fcntl
+import io
+import logging
+import mmap
 import multiprocessing
+import multiprocessing.reduction
+import numbers
 import os
 import pty
+import re
+import select
 import shutil
 import signal
+import struct
 import sys
 import tempfile
+import termios
+import threading
 import time
+import zlib
+
+try:
+    # Python 3.
+    import queue
+except ImportError:
+    # Python 2.
+    import Queue as queue
+
+try:
+    # Python 3.4+ can start child processes using spawn and forkserver.
+    from multiprocessing.context import get_spawning_popen
+except ImportError:
+    # Python 2.7 always forks child processes.
+    get_spawning_popen = None
+
+try:
+    # Python 3.4+ ships with the selectors module.
+    import selectors
+except ImportError:
+    # Python 2.7 falls back to select.select() (see FileDescriptorSelector).
+    selectors = None
+
+try:
+    # Python 3.3+ ships with the lzma module.
+    import lzma
+except ImportError:
+    # Python 2.7 only supports zlib compression (see CompressedStorage).
+    lzma = None
 
 # External dependencies.
 from humanfriendly.deprecation import define_aliases
 from humanfriendly.text import compact, dedent
-from humanfriendly.terminal import clean_terminal_output
+from humanfriendly.terminal import ANSI_ERASE_LINE, CLEAN_OUTPUT_PATTERN
 
 # Semi-standard module versioning.
 __version__ = '3.0'
@@ -27,6 +73,18 @@ __version__ = '3.0'
 # Define aliases for backwards compatibility.
 define_aliases(module_name=__name__, interpret_carriage_returns='humanfriendly.terminal.clean_terminal_output')
 
+# Use a clock that's shared between processes and never goes backwards.
+monotonic = getattr(time, 'monotonic', time.time)
+
+# The captures with the 'python' scope that switch to the 'fd' scope when a
+# subprocess is spawned (see handle_audit_event()).
+python_scope_captures = []
+
+# Tracks whether the current thread is starting a relay process, because the
+# fork that starts a relay process doesn't spawn a subprocess whose output
+# needs to be captured (see handle_audit_event()).
+relay_worker_state = threading.local()
+
 DEFAULT_TEXT_ENCODING = 'UTF-8'
 """
 The name of the default character encoding used to convert captured output to
@@ -35,15 +93,203 @@ Unicode text (a string).
 
 GRACEFUL_SHUTDOWN_SIGNAL = signal.SIGUSR1
 """
-The number of the UNIX signal used to communicate graceful shutdown requests
-from the main process to the output relay process (an integer). See also
-:func:`~MultiProcessHelper.enable_graceful_shutdown()`.
+The number of the UNIX signal that was used to communicate graceful shutdown
+requests from the main process to the output relay process (an integer).
+
+Shutdown requests are nowadays sent over a pipe (see
+:func:`~MultiProcessHelper.stop_children()`) so this signal is no longer
+used by :mod:`capturer` itself. It's kept for backwards compatibility.
 """
 
-TERMINATION_DELAY = 0.01
+TERMINATION_DELAY = 0
 """
 The number of seconds to wait before terminating the output relay process (a
-floating point number).
+number).
+
+This defaults to zero because :func:`~PseudoTerminal.finish_capture()` waits
+for the output relay process to store all pending output before returning
+(see :func:`~MultiProcessHelper.stop_children()`). A positive delay can still
+be useful to give subprocesses that run in the background the chance to emit
+their final output.
+"""
+
+SHUTDOWN_POLL_INTERVAL = 0.1
+"""
+The number of seconds between checks whether a child process is still alive
+while waiting for it to acknowledge a shutdown request (a number).
+"""
+
+DEFAULT_ENGINE = 'process'
+"""
+The name of the default relay engine (a string).
+
+The relay engine determines how the loops that capture, store and relay output
+are run in the background:
+
+``'process'``
+ Each loop runs in a separate child process started using the
+ :mod:`multiprocessing` module. This is the historical behavior.
+
+``'thread'``
+ Each loop runs in a daemon thread of the current process, which avoids the
+ overhead of forking (and joining) child processes on every capture.
+"""
+
+SUPPORTED_ENGINES = ('process', 'thread')
+"""The names of the supported relay engines (a tuple of strings)."""
+
+DEFAULT_START_METHOD = None
+"""
+The :mod:`multiprocessing` start method used to start relay processes (a
+string or :data:`None`).
+
+The default (:data:`None`) uses the start method that's configured for the
+:mod:`multiprocessing` module (see :func:`multiprocessing.get_start_method()`).
+Relay processes support the ``'fork'``, ``'spawn'`` and ``'forkserver'``
+start methods (see :func:`start_forkserver()` to make the latter fast).
+"""
+
+PIPE_CAPACITY = 65536
+"""
+The number of bytes that fit in a pipe buffer on Linux (an integer). Used to
+limit the size of the chunks transferred by :class:`ZeroCopyRelay`.
+"""
+
+FOLLOW_INTERVAL = 0.01
+"""
+The number of seconds to wait for new output while following a capture that's
+in progress (a number). Used by :func:`~PseudoTerminal.iter_chunks()`.
+"""
+
+FOLLOW_CHUNK_SIZE = 1024 * 64
+"""
+The maximum number of bytes yielded at once while following a capture (an
+integer). Used by :func:`~PseudoTerminal.iter_chunks()`.
+"""
+
+MAX_LINE_LENGTH = 1024 * 64
+"""
+The maximum number of bytes that :class:`OutputBuffer` holds back while
+waiting for a line break (an integer). Longer lines are relayed in pieces of
+about this size, so pathological output (e.g. progress bars or minified
+JSON without line breaks) doesn't accumulate in memory.
+"""
+
+VIEW_CACHE_LIMIT = 1024 * 1024 * 64
+"""
+The maximum size of captured output (in bytes) for which decoded views are
+cached (an integer).
+
+:class:`PseudoTerminal` caches the values returned by its accessors so that
+calling several accessors on the same capture reads, decodes and interprets
+the output only once (see :func:`~PseudoTerminal.get_cached_view()`). Views of
+captures larger than this aren't cached, to avoid pinning huge captures in
+memory.
+"""
+
+SUPPORTED_KEEP_MODES = ('tail', 'head+tail')
+"""
+The parts of the captured output that :class:`RingBufferStorage` can keep (a
+tuple of strings).
+"""
+
+SUPPORTED_COMPRESSION = ('zlib', 'lzma')
+"""
+The compression methods supported by :class:`CompressedStorage` (a tuple of
+strings).
+"""
+
+FLUSH_INTERVAL = 0.01
+"""
+The maximum number of seconds that a relay worker buffers compressed output
+(see :class:`CompressedWriter`) and index entries (see :class:`ChunkRecorder`)
+before making them available to readers (a number).
+
+Flushing the compressor makes all output written so far available to partial
+reads, but flushing after every chunk of output hurts the compression ratio
+(output read line by line compresses two or three times worse).
+"""
+
+SUPPORTED_BACKENDS = ('file', 'memfd', 'spooled', 'memory')
+"""
+The names of the storage backends supported by :class:`CaptureOutput` (a
+tuple of strings):
+
+``'file'``
+ An unlinked temporary file in the default temporary directory (see
+ :func:`tempfile.mkstemp()`).
+
+``'memfd'``
+ An anonymous memory backed file (see :func:`os.memfd_create()`, this
+ requires Python 3.8+ on Linux).
+
+``'spooled'``
+ Output is kept in memory until it exceeds a given size and then spilled to
+ disk (see :class:`SpooledStorage`).
+
+``'memory'``
+ Output is kept in a :class:`bytearray` in the current process (see
+ :class:`MemoryStorage`). Only supported when the scope is ``'python'``
+ (where it's the default).
+"""
+
+DEFAULT_SPOOL_SIZE = 1024 * 1024 * 8
+"""
+The number of bytes of output kept in memory by :class:`SpooledStorage`
+before spilling to disk (an integer, defaults to 8 MiB).
+"""
+
+SUPPORTED_TRANSPORTS = ('pty', 'pipe')
+"""
+The kinds of channels through which :class:`PseudoTerminal` captures output
+(a tuple of strings):
+
+``'pty'``
+ A pseudo terminal (see :func:`pty.openpty()`), so that programs behave like
+ they're connected to a real terminal (e.g. they use ANSI escape sequences
+ and line buffering). The terminal driver translates line feeds to carriage
+ return + line feed pairs and its buffer only holds a few KiB of output, so
+ producers block as soon as the relay worker falls behind.
+
+``'pipe'``
+ A pipe (see :func:`open_pipe()`) without terminal semantics or line feed
+ translation, whose capacity is raised to absorb bursts of output (refer to
+ :data:`DEFAULT_PIPE_SIZE`). Intended for non-interactive batch jobs.
+"""
+
+DEFAULT_PIPE_SIZE = 1024 * 1024
+"""
+The requested capacity in bytes of the pipes used by the ``'pipe'``
+transport (an integer, defaults to 1 MiB, which is the maximum that
+unprivileged processes can request on Linux by default).
+"""
+
+SUPPORTED_SCOPES = ('fd', 'python')
+"""
+The scopes of output capturing supported by :class:`CaptureOutput` (a tuple
+of strings):
+
+``'fd'``
+ The standard output and error streams are captured at the level of file
+ descriptors using a pseudo terminal, so output from subprocesses (and C
+ extensions) is captured as well.
+
+``'python'``
+ Only output written to :data:`sys.stdout` and :data:`sys.stderr` by the
+ current interpreter is captured, without a pseudo terminal or relay worker
+ (see :class:`PythonTerminal`). Captures switch to the ``'fd'`` scope when
+ a subprocess is spawned (refer to :data:`SUBPROCESS_AUDIT_EVENTS`).
+"""
+
+SUBPROCESS_AUDIT_EVENTS = frozenset(['os.fork', 'os.forkpty', 'os.posix_spawn', 'os.system', 'subprocess.Popen'])
+"""
+The names of the audit events that are raised when a subprocess is spawned (a
+:class:`frozenset` of strings).
+
+Captures with the ``'python'`` scope watch for these events using an audit
+hook (see :func:`handle_audit_event()`, this requires Python 3.8+) and switch
+to the ``'fd'`` scope before the subprocess is spawned, so that the output of
+the subprocess is captured as well.
 """
 
 PARTIAL_DEFAULT = False
@@ -68,12 +314,18 @@ def enable_old_api():
 
     This function is called when the :mod:`capturer` module is imported. It
     modifies the :class:`CaptureOutput` class to install method proxies for
-    :func:`~PseudoTerminal.get_handle()`, :func:`~PseudoTerminal.get_bytes()`,
-    :func:`~PseudoTerminal.get_lines()`, :func:`~PseudoTerminal.get_text()`,
-    :func:`~PseudoTerminal.save_to_handle()` and
-    :func:`~PseudoTerminal.save_to_path()`.
+    :func:`~PseudoTerminal.get_handle()`, :func:`~PseudoTerminal.get_buffer()`,
+    :func:`~PseudoTerminal.get_bytes()`, :func:`~PseudoTerminal.get_lines()`,
+    :func:`~PseudoTerminal.get_timestamped_lines()`,
+    :func:`~PseudoTerminal.get_text()`, :func:`~PseudoTerminal.iter_chunks()`,
+    :func:`~PseudoTerminal.iter_lines()`, :func:`~PseudoTerminal.mark()`,
+    :func:`~PseudoTerminal.create_cursor()`, :func:`~PseudoTerminal.read_new()`,
+    :func:`~PseudoTerminal.wait_for()`, :func:`~PseudoTerminal.save_to_handle()`
+    and :func:`~PseudoTerminal.save_to_path()`.
     """
-    for name in ('get_handle', 'get_bytes', 'get_lines', 'get_text', 'save_to_handle', 'save_to_path'):
+    for name in ('get_handle', 'get_buffer', 'get_bytes', 'get_lines', 'get_timestamped_lines', 'get_text',
+                 'iter_chunks', 'iter_lines', 'mark', 'create_cursor', 'read_new',
+                 'wait_for', 'save_to_handle', 'save_to_path'):
         setattr(CaptureOutput, name, create_proxy_method(name))
 
 
@@ -123,6 +375,378 @@ def create_proxy_method(name):
     return proxy_method
 
 
+def get_tee_function():
+    """
+    Get the :man:`tee` function from the C library using :mod:`ctypes`.
+
+    :returns: A :mod:`ctypes` function or :data:`None` when the C library
+              doesn't provide :man:`tee` (it's Linux specific).
+    """
+    if not hasattr(get_tee_function, 'cached_result'):
+        try:
+            function = ctypes.CDLL(None, use_errno=True).tee
+            function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+            function.restype = ctypes.c_ssize_t
+        except (AttributeError, OSError):
+            function = None
+        get_tee_function.cached_result = function
+    return get_tee_function.cached_result
+
+
+def tee(fd_in, fd_out, length):
+    """
+    Duplicate the contents of a pipe into another pipe using :man:`tee`.
+
+    :param fd_in: The read end of the source pipe (an integer).
+    :param fd_out: The write end of the destination pipe (an integer).
+    :param length: The maximum number of bytes to duplicate (an integer).
+    :returns: The number of bytes duplicated (an integer).
+    :raises: :exc:`~exceptions.OSError` when :man:`tee` fails.
+    """
+    function = get_tee_function()
+    if function is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    result = function(fd_in, fd_out, length, 0)
+    if result < 0:
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number))
+    return result
+
+
+def pread(fd, num_bytes, offset):
+    """
+    Read from a file descriptor at the given offset.
+
+    :param fd: The file descriptor to read from (an integer).
+    :param num_bytes: The maximum number of bytes to read (an integer).
+    :param offset: The offset where reading starts (an integer).
+    :returns: The data that was read (a binary string).
+
+    Uses :func:`os.pread()` when available and falls back to
+    :func:`os.lseek()` and :func:`os.read()` (on Python 2).
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(fd, num_bytes, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, num_bytes)
+
+
+def pwrite(fd, data, offset):
+    """
+    Write all of the given data to a file descriptor at the given offset.
+
+    :param fd: The file descriptor to write to (an integer).
+    :param data: The data to write (a binary string or buffer).
+    :param offset: The offset where writing starts (an integer).
+
+    Uses :func:`os.pwrite()` when available and falls back to
+    :func:`os.lseek()` and :func:`os.write()` (on Python 2).
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            num_bytes = os.pwrite(fd, view, offset)
+            view = view[num_bytes:]
+            offset += num_bytes
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        write_all(fd, data)
+
+
+def create_compressor(compression):
+    """
+    Create a compressor for captured output.
+
+    :param compression: One of the strings in :data:`SUPPORTED_COMPRESSION`.
+    :returns: A :func:`zlib.compressobj()` object that produces a gzip stream
+              or an :class:`lzma.LZMACompressor` object that produces an xz
+              stream.
+    """
+    if compression == 'lzma':
+        return lzma.LZMACompressor()
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def create_decompressor(compression):
+    """
+    Create a decompressor for captured output.
+
+    :param compression: One of the strings in :data:`SUPPORTED_COMPRESSION`.
+    :returns: An object with a ``decompress()`` method.
+    """
+    if compression == 'lzma':
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def create_temporary_file(backend='file'):
+    """
+    Create the file in which captured output is stored.
+
+    :param backend: One of the strings ``'file'`` or ``'memfd'`` (refer to
+                    :data:`SUPPORTED_BACKENDS` for details).
+    :returns: A tuple with a writable file descriptor (an integer) and a
+              readable file object. Both refer to the same file but they have
+              their own file offset.
+    """
+    if backend == 'memfd':
+        output_fd = os.memfd_create('capturer', os.MFD_CLOEXEC)
+        # Reopening the file gives the reader its own file offset.
+        return output_fd, open('/proc/self/fd/%i' % output_fd, 'rb')
+    output_fd, output_file = tempfile.mkstemp()
+    output_handle = open(output_file, 'rb')
+    # Unlink the temporary file because we have a readable file descriptor
+    # and a writable file descriptor and that's all we need! If this
+    # surprises you I suggest you investigate why unlink() was named the
+    # way it was in UNIX :-).
+    os.unlink(output_file)
+    return output_fd, output_handle
+
+
+def open_pipe(size=DEFAULT_PIPE_SIZE):
+    """
+    Create a pipe with an enlarged kernel buffer.
+
+    :param size: The requested capacity of the pipe in bytes (an integer or
+                 :data:`None` to keep the default capacity).
+    :returns: A tuple with the readable and writable file descriptors of the
+              pipe (two integers).
+
+    The capacity is changed using ``F_SETPIPE_SZ`` which is Linux specific.
+    Unprivileged processes can't exceed ``/proc/sys/fs/pipe-max-size``, so
+    the capacity is capped at that maximum. When the capacity can't be
+    changed at all the pipe keeps its default capacity (usually
+    :data:`PIPE_CAPACITY`).
+    """
+    read_fd, write_fd = os.pipe()
+    if size and sys.platform.startswith('linux'):
+        command = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+        try:
+            fcntl.fcntl(write_fd, command, size)
+        except (IOError, OSError):
+            try:
+                with open('/proc/sys/fs/pipe-max-size') as handle:
+                    fcntl.fcntl(write_fd, command, min(size, int(handle.read())))
+            except (IOError, OSError, ValueError):
+                # Keep the default capacity.
+                pass
+    return read_fd, write_fd
+
+
+def read_exactly(fd, num_bytes):
+    """
+    Read the given number of bytes from a file descriptor.
+
+    :param fd: The file descriptor to read from (an integer).
+    :param num_bytes: The number of bytes to read (an integer).
+    :returns: The output that was read (a binary string, which may be shorter
+              than requested when the file descriptor reached EOF).
+    """
+    chunks = []
+    while num_bytes > 0:
+        chunk = os.read(fd, num_bytes)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b''.join(chunks)
+
+
+def write_all(fd, data):
+    """
+    Write all of the given data to a file descriptor.
+
+    :param fd: The file descriptor to write to (an integer).
+    :param data: The data to write (a binary string).
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def reduce_fd(fd):
+    """
+    Prepare a file descriptor that's about to be pickled.
+
+    :param fd: A file descriptor (an integer or :data:`None`).
+    :returns: A :func:`multiprocessing.reduction.DupFd()` object or the given
+              file descriptor.
+
+    When a child process is being started using the ``'spawn'`` or
+    ``'forkserver'`` start methods the file descriptor is wrapped in a
+    :func:`multiprocessing.reduction.DupFd()` object, which passes it on to
+    the child process (see :func:`rebuild_fd()`). Otherwise it's returned as
+    is (child processes started using ``'fork'`` inherit it and the relay
+    workers of a :class:`CapturePool` receive it separately).
+    """
+    if fd is not None and get_spawning_popen is not None and get_spawning_popen() is not None:
+        return multiprocessing.reduction.DupFd(fd)
+    return fd
+
+
+def rebuild_fd(value):
+    """
+    Restore a file descriptor prepared by :func:`reduce_fd()`.
+
+    :param value: The value returned by :func:`reduce_fd()`.
+    :returns: A file descriptor (an integer or :data:`None`).
+    """
+    return value.detach() if hasattr(value, 'detach') else value
+
+
+def reduce_fds(state, names):
+    """
+    Prepare the file descriptors in the state of an object that's about to be pickled.
+
+    :param state: A dictionary with the attributes of the object (modified in
+                  place).
+    :param names: The names of the attributes that hold file descriptors.
+    :returns: The given dictionary (see :func:`reduce_fd()`).
+    """
+    for name in names:
+        state[name] = reduce_fd(state[name])
+    return state
+
+
+def rebuild_fds(state, names):
+    """
+    Restore the file descriptors prepared by :func:`reduce_fds()`.
+
+    :param state: A dictionary with the attributes of the object that's
+                  being unpickled (modified in place).
+    :param names: The names of the attributes that hold file descriptors.
+    :returns: The given dictionary (see :func:`rebuild_fd()`).
+    """
+    for name in names:
+        state[name] = rebuild_fd(state[name])
+    return state
+
+
+def run_worker(helper, name, started_event):
+    """
+    Run a relay worker in a child process (started by :func:`MultiProcessHelper.start_child()`).
+
+    :param helper: The :class:`MultiProcessHelper` object. When the child
+                   process isn't forked this is a copy that only has the
+                   :attr:`~MultiProcessHelper.worker_attributes`.
+    :param name: The name of the method that implements the relay worker (a
+                 string).
+    :param started_event: Refer to :func:`MultiProcessHelper.start_child()`.
+    """
+    getattr(helper, name)(started_event)
+
+
+def start_forkserver():
+    """
+    Start the :mod:`multiprocessing` fork server with the `capturer` module preloaded.
+
+    Relay processes that are started using the ``'forkserver'`` start method
+    are forked from the fork server, so once the fork server has imported the
+    `capturer` module (and its dependencies) starting a relay process doesn't
+    import anything. This function waits until the fork server is ready (by
+    starting a child process that exits right away) so that the first
+    capture doesn't pay for starting it. It's best called early (before any
+    threads are started). Without it the fork server is started on demand,
+    but it doesn't preload the `capturer` module.
+
+    Requires Python 3.4+ on a platform that supports the ``'forkserver'``
+    start method.
+    """
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['__main__', __name__])
+    child_process = context.Process(target=os.getpid)
+    child_process.start()
+    child_process.join()
+
+
+def flush_standard_streams():
+    """
+    Flush the buffers of :data:`sys.stdout` and :data:`sys.stderr`.
+
+    Called before output capturing is stopped, so that output that's still
+    buffered by Python is captured as well.
+    """
+    for handle in (sys.stdout, sys.stderr):
+        try:
+            handle.flush()
+        except (AttributeError, IOError, OSError, ValueError):
+            # Ignore missing, closed and broken streams.
+            pass
+
+
+def find_stream_handlers(stream):
+    """
+    Find the :mod:`logging` handlers that write to the given stream.
+
+    :param stream: A file-like object (e.g. :data:`sys.stderr`).
+    :returns: A list of :class:`logging.StreamHandler` objects.
+
+    Handlers keep a reference to the stream they were created for, so the
+    handlers that were created before :data:`sys.stdout` and :data:`sys.stderr`
+    are replaced (see :class:`PythonTerminal`) need to be updated as well.
+    """
+    loggers = [logging.root] + list(logging.Logger.manager.loggerDict.values())
+    return [
+        handler for logger in loggers for handler in getattr(logger, 'handlers', [])
+        if isinstance(handler, logging.StreamHandler) and handler.stream is stream
+    ]
+
+
+def handle_audit_event(event, args):
+    """
+    Switch captures with the ``'python'`` scope to the ``'fd'`` scope when a subprocess is spawned.
+
+    :param event: The name of the audit event (a string).
+    :param args: The arguments of the audit event (a tuple).
+
+    This audit hook is installed by :func:`watch_subprocesses()`. Audit hooks
+    can't be removed, so this is a no-op while no captures are watching.
+    Forks made to start relay processes (see
+    :func:`MultiProcessHelper.start_child()`) are ignored.
+    """
+    starting_relay = getattr(relay_worker_state, 'starting', False)
+    if python_scope_captures and event in SUBPROCESS_AUDIT_EVENTS and not starting_relay:
+        while python_scope_captures:
+            try:
+                capturer = python_scope_captures.pop()
+            except IndexError:
+                # Another thread switched the capture.
+                break
+            capturer.switch_to_fd_scope()
+
+
+def watch_subprocesses(capturer):
+    """
+    Switch a capture to the ``'fd'`` scope when a subprocess is spawned.
+
+    :param capturer: A :class:`CaptureOutput` object whose scope is ``'python'``.
+    :returns: :data:`True` when subprocesses are being watched, :data:`False`
+              when the Python interpreter doesn't support audit hooks
+              (Python 3.8+ is required).
+    """
+    if not hasattr(sys, 'addaudithook'):
+        return False
+    if not getattr(watch_subprocesses, 'installed', False):
+        sys.addaudithook(handle_audit_event)
+        watch_subprocesses.installed = True
+    python_scope_captures.append(capturer)
+    return True
+
+
+def unwatch_subprocesses(capturer):
+    """
+    Stop watching for subprocesses on behalf of a capture.
+
+    :param capturer: A :class:`CaptureOutput` object that was given to
+                     :func:`watch_subprocesses()`.
+    """
+    try:
+        python_scope_captures.remove(capturer)
+    except ValueError:
+        # The capture already switched scopes.
+        pass
+
+
 class MultiProcessHelper(object):
 
     """
@@ -130,54 +754,226 @@ class MultiProcessHelper(object):
 
     This class serves as a base class for :class:`CaptureOutput` and
     :class:`PseudoTerminal` because both classes need the same child process
-    handling logic.
+    handling logic. Depending on the :attr:`engine` the "child processes" are
+    either real child processes or daemon threads in the current process.
+
+    Child processes that aren't forked get a copy of the helper that's
+    unpickled from the :attr:`worker_attributes` (so state that's only used by
+    the main process isn't pickled) and the file descriptors they need are
+    passed along (see :func:`reduce_fds()`).
     """
 
-    def __init__(self):
-        """Initialize a :class:`MultiProcessHelper` object."""
+    worker_attributes = ('engine', 'start_method', 'worker_connection')
+    """The names of the attributes that are used by the child processes (a tuple of strings)."""
+
+    worker_fds = ()
+    """The names of the :attr:`worker_attributes` that hold file descriptors (a tuple of strings)."""
+
+    def __init__(self, engine=DEFAULT_ENGINE, start_method=DEFAULT_START_METHOD):
+        """
+        Initialize a :class:`MultiProcessHelper` object.
+
+        :param engine: The name of the relay engine to use (one of the strings
+                       in :data:`SUPPORTED_ENGINES`, defaults to
+                       :data:`DEFAULT_ENGINE`).
+        :param start_method: The :mod:`multiprocessing` start method used to
+                             start child processes (a string, defaults to
+                             :data:`DEFAULT_START_METHOD`).
+        :raises: :exc:`~exceptions.ValueError` when the engine or the start
+                 method isn't supported.
+        """
+        if engine not in SUPPORTED_ENGINES:
+            msg = "Unsupported relay engine %r! (supported engines are %s)"
+            raise ValueError(msg % (engine, ", ".join(map(repr, SUPPORTED_ENGINES))))
+        if start_method is not None:
+            supported = multiprocessing.get_all_start_methods() if get_spawning_popen is not None else ['fork']
+            if start_method not in supported:
+                msg = "Unsupported start method %r! (supported start methods are %s)"
+                raise ValueError(msg % (start_method, ", ".join(map(repr, supported))))
+        self.engine = engine
+        self.start_method = start_method
         self.processes = []
+        self.control_connection = None
+        self.worker_connection = None
+        self.acknowledgement = None
+
+    def __getstate__(self):
+        """Get the :attr:`worker_attributes` to pickle (see :func:`reduce_fds()`)."""
+        state = dict((name, getattr(self, name)) for name in self.worker_attributes)
+        return reduce_fds(state, self.worker_fds)
+
+    def __setstate__(self, state):
+        """Restore the :attr:`worker_attributes` in a child process (see :func:`rebuild_fds()`)."""
+        self.__dict__.update(rebuild_fds(state, self.worker_fds))
+
+    @property
+    def uses_threads(self):
+        """:data:`True` if the :attr:`engine` is ``'thread'``, :data:`False` otherwise."""
+        return self.engine == 'thread'
+
+    @property
+    def context(self):
+        """
+        The :mod:`multiprocessing` context for the :attr:`start_method`.
+
+        This is the :mod:`multiprocessing` module itself when the start method
+        is :data:`None` (or on Python 2.7, which doesn't support contexts).
+        """
+        if self.start_method is None or get_spawning_popen is None:
+            return multiprocessing
+        return multiprocessing.get_context(self.start_method)
+
+    def create_event(self):
+        """
+        Create an event object suitable for the :attr:`engine`.
+
+        :returns: A :class:`threading.Event` or :class:`multiprocessing.Event` object.
+        """
+        return threading.Event() if self.uses_threads else self.context.Event()
+
+    def create_queue(self):
+        """
+        Create a queue object suitable for the :attr:`engine`.
+
+        :returns: A :class:`queue.Queue` or :class:`multiprocessing.Queue` object.
+        """
+        return queue.Queue() if self.uses_threads else self.context.Queue()
 
     def start_child(self, target):
         """
-        Start a child process using :class:`multiprocessing.Process`.
+        Start a child process (or thread) that runs the given target.
 
         :param target: The callable to run in the child process. Expected to
                        take a single argument which is a
                        :class:`multiprocessing.Event` to be set when the child
                        process has finished initialization.
+
+        When the :attr:`engine` is ``'thread'`` a :class:`threading.Thread` is
+        started instead of a :class:`multiprocessing.Process`. The target of
+        child processes is :func:`run_worker()` (given the helper and the
+        name of the target method) so that the child process only needs
+        the :attr:`worker_attributes` when it isn't forked.
+
+        Before the child is started a :func:`multiprocessing.Pipe()` is
+        allocated. The child end (:attr:`worker_connection`) can be watched by
+        the target for shutdown requests, which it's expected to acknowledge
+        using :func:`acknowledge_shutdown()` (see :func:`stop_children()`).
         """
-        started_event = multiprocessing.Event()
-        child_process = multiprocessing.Process(target=target, args=(started_event,))
+        started_event = self.create_event()
+        self.control_connection, self.worker_connection = multiprocessing.Pipe()
+        if self.uses_threads:
+            child_process = threading.Thread(target=target, args=(started_event,))
+        else:
+            child_process = self.context.Process(target=run_worker, args=(self, target.__name__, started_event))
         self.processes.append(child_process)
         child_process.daemon = True
-        child_process.start()
+        relay_worker_state.starting = True
+        try:
+            child_process.start()
+        finally:
+            relay_worker_state.starting = False
+        if not self.uses_threads:
+            # Close our copy of the child end of the pipe, so that we notice
+            # when the child process dies without acknowledging a request.
+            self.worker_connection.close()
         started_event.wait()
 
     def stop_children(self):
         """
         Gracefully shut down all child processes.
 
-        Child processes are expected to call :func:`enable_graceful_shutdown()`
-        during initialization.
+        A shutdown request is sent to each child process that's still alive,
+        after which we wait for the child process to acknowledge the request.
+        Child processes are expected to watch the :attr:`worker_connection`,
+        store all pending output once a shutdown request arrives, acknowledge
+        the request using :func:`acknowledge_shutdown()` and terminate. The
+        acknowledgement is available as :attr:`acknowledgement` afterwards.
+
+        This handshake guarantees that all output that was written before
+        :func:`stop_children()` was called has been stored once it returns,
+        without having to guess how long that takes.
         """
         while self.processes:
             child_process = self.processes.pop()
             if child_process.is_alive():
-                os.kill(child_process.pid, GRACEFUL_SHUTDOWN_SIGNAL)
+                self.acknowledgement = self.request_shutdown(child_process)
             child_process.join()
+        self.close_connections()
+
+    def request_shutdown(self, child_process):
+        """
+        Ask a child process to shut down and wait for its acknowledgement.
+
+        :param child_process: The :class:`multiprocessing.Process` or
+                              :class:`threading.Thread` object.
+        :returns: The acknowledgement sent by the child process (any picklable
+                  value) or :data:`None` when the child process terminated
+                  without acknowledging the request.
+        """
+        try:
+            self.control_connection.send(None)
+        except (IOError, OSError):
+            # The child process died before the request was sent.
+            return None
+        return self.wait_for_reply(child_process)
+
+    def wait_for_reply(self, child_process):
+        """
+        Wait for a child process to reply to a request.
+
+        :param child_process: The :class:`multiprocessing.Process` or
+                              :class:`threading.Thread` object.
+        :returns: The reply sent by the child process (any picklable value) or
+                  :data:`None` when the child process terminated without
+                  replying.
+        """
+        try:
+            while True:
+                # Check whether the child is alive before polling, so that we
+                # don't miss a reply sent just before it exited.
+                alive = child_process.is_alive()
+                if self.control_connection.poll(SHUTDOWN_POLL_INTERVAL if alive else 0):
+                    return self.control_connection.recv()
+                if not alive:
+                    break
+        except (EOFError, IOError, OSError):
+            # The child process died before replying.
+            pass
+
+    def acknowledge_shutdown(self, acknowledgement=None):
+        """
+        Acknowledge a shutdown request (called in the child process).
+
+        :param acknowledgement: The value to send to the main process (any
+                                picklable value).
+        """
+        self.worker_connection.recv()
+        self.worker_connection.send(acknowledgement)
+
+    def close_connections(self):
+        """Close the connections used to send shutdown requests (if any)."""
+        for name in ('control_connection', 'worker_connection'):
+            connection = getattr(self, name)
+            if connection is not None:
+                connection.close()
+                setattr(self, name, None)
 
     def wait_for_children(self):
         """Wait for all child processes to terminate."""
         for child_process in self.processes:
             child_process.join()
+        self.close_connections()
 
     def enable_graceful_shutdown(self):
         """
         Register a signal handler that converts :data:`GRACEFUL_SHUTDOWN_SIGNAL` to an exception.
 
-        Used by :func:`~PseudoTerminal.capture_loop()` to gracefully interrupt
-        the blocking :func:`os.read()` call when the capture loop needs to be
-        terminated (this is required for coverage collection).
+        This used to be called by :func:`~PseudoTerminal.capture_loop()` to
+        gracefully interrupt the blocking :func:`os.read()` call when the
+        capture loop needed to be terminated. Nowadays the capture loops watch
+        the :attr:`worker_connection` instead (so that user defined signal
+        handlers aren't clobbered) but this method is kept for backwards
+        compatibility.
         """
         signal.signal(GRACEFUL_SHUTDOWN_SIGNAL, self.raise_shutdown_request)
 
@@ -190,9 +986,17 @@ class CaptureOutput(MultiProcessHelper):
 
     """Context manager to capture the standard output and error streams."""
 
+    worker_attributes = MultiProcessHelper.worker_attributes + ('output_queue', 'stdout_stream', 'stderr_stream')
+    """The names of the attributes that are used by :func:`merge_loop()` (a tuple of strings)."""
+
     def __init__(self, merged=True, encoding=DEFAULT_TEXT_ENCODING,
                  termination_delay=TERMINATION_DELAY, chunk_size=1024,
-                 relay=True):
+                 relay=True, engine=DEFAULT_ENGINE, multiplexed=False,
+                 max_chunk_size=None, zero_copy=False, pool=None,
+                 max_bytes=None, keep='tail', compression=None, backend=None,
+                 spool_size=DEFAULT_SPOOL_SIZE, timestamps=True, scope='fd',
+                 transport='pty', pipe_size=DEFAULT_PIPE_SIZE, stats_callback=None,
+                 store_processors=None, relay_processors=None, start_method=DEFAULT_START_METHOD):
         """
         Initialize a :class:`CaptureOutput` object.
 
@@ -212,23 +1016,178 @@ class CaptureOutput(MultiProcessHelper):
                                   :data:`TERMINATION_DELAY`).
         :param chunk_size: The maximum number of bytes to read from the
                            captured streams on each call to :func:`os.read()`
-                           (an integer).
+                           (an integer). When `max_chunk_size` is given this
+                           is the minimum number of bytes to read instead.
         :param relay: If this is :data:`True` (the default) then captured
                       output is relayed to the terminal or parent process,
                       if it's :data:`False` the captured output is hidden
                       (swallowed).
+        :param engine: The name of the relay engine to use (one of the strings
+                       in :data:`SUPPORTED_ENGINES`, defaults to
+                       :data:`DEFAULT_ENGINE`).
+        :param multiplexed: If this is :data:`True` (not the default) and
+                            `merged` is :data:`False` then the standard output
+                            and error streams are captured, stored and relayed
+                            by a single loop that watches both pseudo
+                            terminals (see :class:`Multiplexer`). This avoids
+                            the separate merge process and the pickling of
+                            output chunks into a :class:`multiprocessing.Queue`.
+        :param max_chunk_size: The maximum number of bytes to read from the
+                               captured streams on each call to
+                               :func:`os.read()` (an integer or :data:`None`).
+                               When this is given the number of bytes to read
+                               adapts to the amount of pending output (see
+                               :class:`AdaptiveReader`).
+        :param zero_copy: If this is :data:`True` (not the default) then
+                          captured output is stored and relayed without
+                          copying it into Python, when the platform supports
+                          this (see :class:`ZeroCopyRelay`). Only applies to
+                          output that isn't relayed through a queue (so
+                          `merged` should be :data:`True`, `relay` should be
+                          :data:`False` or both).
+        :param pool: A :class:`CapturePool` object to borrow the pseudo
+                     terminal and relay worker from (:data:`None` by default,
+                     which means they're created for this capture). The
+                     `chunk_size`, `engine`, `max_chunk_size`, `zero_copy`
+                     and `start_method` options of the pool apply instead.
+                     Only supported when `merged` is :data:`True`.
+        :param max_bytes: The maximum number of bytes of output to keep for
+                          each captured stream (an integer or :data:`None`).
+                          When this is given captured output is stored in a
+                          fixed size :class:`RingBufferStorage` so that disk
+                          usage stays constant no matter how much output is
+                          captured. Defaults to :data:`None` (keep all output).
+        :param keep: Which part of the output to keep when `max_bytes` is
+                     given (one of the strings in
+                     :data:`SUPPORTED_KEEP_MODES`, defaults to ``'tail'``).
+        :param compression: The name of a compression method (one of the
+                            strings in :data:`SUPPORTED_COMPRESSION`) to
+                            compress captured output while it's being stored
+                            (see :class:`CompressedStorage`). Defaults to
+                            :data:`None` (no compression). Can't be combined
+                            with `max_bytes`.
+        :param backend: Where captured output is stored (one of the strings
+                        in :data:`SUPPORTED_BACKENDS`, defaults to
+                        ``'memory'`` when the scope is ``'python'`` and
+                        neither `max_bytes` nor `compression` is given, to
+                        ``'file'`` otherwise). The ``'spooled'`` and
+                        ``'memory'`` backends can't be combined with
+                        `max_bytes` or `compression`.
+                        Subclasses can override :func:`create_storage()` to
+                        plug in their own storage.
+        :param spool_size: The number of bytes of output the ``'spooled'``
+                           backend keeps in memory (an integer, defaults to
+                           :data:`DEFAULT_SPOOL_SIZE`).
+        :param timestamps: :data:`True` to record when each chunk of output
+                           was captured (see :class:`ChunkIndex`),
+                           :data:`False` to disable this. The index grows
+                           with the number of chunks captured (17 bytes per
+                           chunk), so long running captures that use
+                           `max_bytes` may want to disable it.
+        :param scope: What output to capture (one of the strings in
+                      :data:`SUPPORTED_SCOPES`, defaults to ``'fd'``). The
+                      ``'python'`` scope only captures output written to
+                      :data:`sys.stdout` and :data:`sys.stderr`, which makes
+                      starting and finishing a capture a lot cheaper (see
+                      :class:`PythonTerminal`). Can't be combined with
+                      `pool`.
+        :param transport: How output is captured (one of the strings in
+                          :data:`SUPPORTED_TRANSPORTS`, defaults to
+                          ``'pty'``). The ``'pipe'`` transport doesn't emulate
+                          a terminal, so subprocesses may buffer their output
+                          differently (and won't use ANSI escape sequences).
+                          Can't be combined with `pool`.
+        :param pipe_size: The requested capacity in bytes of the pipes used by
+                          the ``'pipe'`` transport (an integer, defaults to
+                          :data:`DEFAULT_PIPE_SIZE`).
+        :param stats_callback: A callable that's called with the
+                               :class:`CaptureStats` object (see
+                               :attr:`stats`) at the end of the first call
+                               to :func:`finish_capture()` of each capture,
+                               for example to feed the statistics to a
+                               metrics system (defaults to :data:`None`).
+        :param store_processors: A list of processors that transform captured
+                                 output before it's stored (see
+                                 :class:`ProcessorChain`), for example to
+                                 redact secrets or strip ANSI escape
+                                 sequences. Defaults to :data:`None`.
+        :param relay_processors: A list of processors that transform captured
+                                 output before it's relayed (defaults to
+                                 :data:`None`). The stored and relayed copies
+                                 are processed separately, so they can
+                                 differ. Processors disable `zero_copy`.
+        :param start_method: The :mod:`multiprocessing` start method used to
+                             start relay processes (one of the strings
+                             returned by
+                             :func:`multiprocessing.get_all_start_methods()`
+                             or :data:`None`, defaults to
+                             :data:`DEFAULT_START_METHOD`). Only relevant
+                             when the engine is ``'process'``. With the
+                             ``'spawn'`` and ``'forkserver'`` start methods
+                             processors need to be picklable.
+        :raises: :exc:`~exceptions.ValueError` when the engine or start method
+                 isn't supported, a pool is given and `merged` is
+                 :data:`False`, the scope is ``'python'`` or the transport
+                 is ``'pipe'``, the scope or transport isn't supported or
+                 the storage options are invalid.
         """
         # Initialize the superclass.
-        super(CaptureOutput, self).__init__()
+        super(CaptureOutput, self).__init__(engine=engine, start_method=start_method)
+        if backend is None:
+            backend = 'memory' if scope == 'python' and max_bytes is None and compression is None else 'file'
         # Store constructor arguments.
         self.chunk_size = chunk_size
         self.encoding = encoding
+        self.max_chunk_size = max_chunk_size
+        self.backend = backend
+        self.compression = compression
+        self.keep = keep
+        self.max_bytes = max_bytes
         self.merged = merged
+        self.multiplexed = multiplexed
+        self.pipe_size = pipe_size
+        self.pool = pool
         self.relay = relay
+        self.scope = scope
+        self.spool_size = spool_size
+        self.stats_callback = stats_callback
+        self.store_processors = store_processors
+        self.relay_processors = relay_processors
+        self.timestamps = timestamps
+        self.transport = transport
+        self.zero_copy = zero_copy
         self.termination_delay = termination_delay
         # Initialize instance variables.
+        self.multiplexer = None
+        self.output_queue = None
         self.pseudo_terminals = []
+        self.shared_index = None
+        self.stats = CaptureStats()
+        self.stats_reported = False
         self.streams = []
+        if pool is not None and not merged:
+            raise ValueError("Capture pools only support merged output!")
+        if scope not in SUPPORTED_SCOPES:
+            msg = "Unsupported scope %r! (supported scopes are %s)"
+            raise ValueError(msg % (scope, ", ".join(map(repr, SUPPORTED_SCOPES))))
+        if pool is not None and scope != 'fd':
+            raise ValueError("Capture pools only support the 'fd' scope!")
+        if transport not in SUPPORTED_TRANSPORTS:
+            msg = "Unsupported transport %r! (supported transports are %s)"
+            raise ValueError(msg % (transport, ", ".join(map(repr, SUPPORTED_TRANSPORTS))))
+        if pool is not None and transport != 'pty':
+            raise ValueError("Capture pools only support the 'pty' transport!")
+        if max_bytes is not None:
+            RingBufferStorage.validate_options(max_bytes, keep)
+        if compression is not None:
+            CompressedStorage.validate_options(compression)
+            if max_bytes is not None:
+                raise ValueError("Compressed storage can't be combined with max_bytes!")
+        FileStorage.validate_backend(backend)
+        if backend in ('spooled', 'memory') and (max_bytes is not None or compression is not None):
+            raise ValueError("The %s backend can't be combined with max_bytes or compression!" % backend)
+        if backend == 'memory' and scope != 'python':
+            raise ValueError("The memory backend is only supported by the 'python' scope!")
         # Initialize stdout/stderr stream containers.
         self.stdout_stream = self.initialize_stream(sys.stdout, STDOUT_FD)
         self.stderr_stream = self.initialize_stream(sys.stderr, STDERR_FD)
@@ -283,6 +1242,8 @@ class CaptureOutput(MultiProcessHelper):
     @property
     def is_capturing(self):
         """:data:`True` if output is being captured, :data:`False` otherwise."""
+        if self.scope == 'python':
+            return any(pseudo_terminal.is_capturing for pseudo_terminal in self.pseudo_terminals)
         return any(stream.is_redirected for kind, stream in self.streams)
 
     def start_capture(self):
@@ -299,33 +1260,76 @@ class CaptureOutput(MultiProcessHelper):
         """
         if self.is_capturing:
             raise TypeError("Output capturing is already enabled!")
+        started = monotonic()
+        self.stats = CaptureStats()
+        self.stats_reported = False
+        self.shared_index = None
+        if self.scope == 'python':
+            # Capture the output written to sys.stdout and sys.stderr without
+            # a pseudo terminal or relay worker (until a subprocess is spawned).
+            if self.merged:
+                self.output = self.allocate_python_terminal(self.stderr_stream)
+                self.output.redirect('stdout')
+                self.output.redirect('stderr')
+            else:
+                self.stdout = self.allocate_python_terminal(self.stdout_stream, STDOUT_FD)
+                self.stderr = self.allocate_python_terminal(self.stderr_stream, STDERR_FD)
+                self.stdout.redirect('stdout')
+                self.stderr.redirect('stderr')
+            watch_subprocesses(self)
+        else:
+            self.start_fd_capture()
+        if self.merged:
+            self.stats.streams = dict(output=self.output.stats)
+        else:
+            self.stats.streams = dict(stdout=self.stdout.stats, stderr=self.stderr.stats)
+        self.stats.start_capture_seconds = monotonic() - started
+
+    def start_fd_capture(self):
+        """
+        Start capturing the standard streams at the level of file descriptors.
+
+        Internal shortcut for :func:`start_capture()` when the scope is ``'fd'``.
+        """
         if self.merged:
             # Capture (and most likely relay) stdout/stderr as one stream.
             fd = self.stderr_stream.original_fd if self.relay else None
             self.output = self.allocate_pty(relay_fd=fd)
+            if self.pool is not None:
+                # The relay worker of the pool is already running (and
+                # discards output until storage is attached) so we start
+                # storing output before the streams are redirected.
+                self.output.start_capture()
             for kind, stream in self.streams:
                 self.output.attach(stream)
+        elif self.multiplexed:
+            # Capture (and most likely relay) stdout/stderr as separate streams
+            # using a single loop that watches both pseudo terminals.
+            self.multiplexer = Multiplexer(self.termination_delay, engine=self.engine, start_method=self.start_method)
+            self.stdout = self.allocate_pty(stream=STDOUT_FD)
+            self.stderr = self.allocate_pty(stream=STDERR_FD)
+            self.multiplexer.add(self.stdout, self.stdout_stream.original_fd if self.relay else None)
+            self.multiplexer.add(self.stderr, self.stderr_stream.original_fd if self.relay else None)
+            self.attach_streams()
         else:
             # Capture (and most likely relay) stdout/stderr as separate streams.
             if self.relay:
                 # Start the subprocess to relay output.
-                self.output_queue = multiprocessing.Queue()
+                self.output_queue = self.create_queue()
                 self.start_child(self.merge_loop)
             else:
                 # Disable relaying of output.
                 self.output_queue = None
-            self.stdout = self.allocate_pty(output_queue=self.output_queue, queue_token=STDOUT_FD)
-            self.stderr = self.allocate_pty(output_queue=self.output_queue, queue_token=STDERR_FD)
-            for kind, stream in self.streams:
-                if kind == STDOUT_FD:
-                    self.stdout.attach(stream)
-                elif kind == STDERR_FD:
-                    self.stderr.attach(stream)
-                else:
-                    raise Exception("Programming error: Unrecognized stream type!")
-        # Start capturing and relaying of output (in one or two subprocesses).
-        for pseudo_terminal in self.pseudo_terminals:
-            pseudo_terminal.start_capture()
+            self.stdout = self.allocate_pty(output_queue=self.output_queue, queue_token=STDOUT_FD, stream=STDOUT_FD)
+            self.stderr = self.allocate_pty(output_queue=self.output_queue, queue_token=STDERR_FD, stream=STDERR_FD)
+            self.attach_streams()
+        # Start capturing and relaying of output (in one or two subprocesses
+        # or threads, depending on the relay engine).
+        if self.multiplexer is not None:
+            self.multiplexer.start_capture()
+        elif self.pool is None:
+            for pseudo_terminal in self.pseudo_terminals:
+                pseudo_terminal.start_capture()
 
     def finish_capture(self):
         """
@@ -336,324 +1340,3951 @@ class CaptureOutput(MultiProcessHelper):
         wants to extend :class:`CaptureOutput` and build their own context
         manager on top of it.
         """
+        started = monotonic()
+        if self.scope == 'python':
+            unwatch_subprocesses(self)
         for pseudo_terminal in self.pseudo_terminals:
             pseudo_terminal.finish_capture()
+        if self.output_queue is not None and self.control_connection is not None:
+            # Get the statistics of the merge loop.
+            counters = self.wait_for_reply(self.processes[0])
+            if counters:
+                self.stats.update(counters)
         self.wait_for_children()
+        self.stats.finish_capture_seconds += monotonic() - started
+        if self.stats_callback is not None and not self.stats_reported:
+            self.stats_reported = True
+            self.stats_callback(self.stats)
 
-    def allocate_pty(self, relay_fd=None, output_queue=None, queue_token=None):
+    def switch_to_fd_scope(self):
         """
-        Allocate a pseudo terminal.
+        Start capturing the standard output and error streams at the level of file descriptors.
 
-        Internal shortcut for :func:`start_capture()` to allocate multiple
-        pseudo terminals without code duplication.
+        When the scope is ``'python'`` and output is being captured, pseudo
+        terminals are allocated and the standard streams are redirected like
+        the ``'fd'`` scope does, so that output written by subprocesses (and
+        C extensions) is captured as well. Output captured so far is kept and
+        output written to :data:`sys.stdout` and :data:`sys.stderr` continues
+        to be captured in the same order.
+
+        This is called automatically when a subprocess is spawned, on Python
+        3.8+ (see :func:`handle_audit_event()`). On older Python versions it
+        can be called explicitly before spawning subprocesses. The relay
+        workers are always threads (regardless of the relay engine) because
+        the storage is already in use by the current process.
         """
-        obj = PseudoTerminal(
-            self.encoding, self.termination_delay, self.chunk_size,
-            relay_fd=relay_fd, output_queue=output_queue,
-            queue_token=queue_token,
+        if self.scope == 'python' and self.is_capturing:
+            unwatch_subprocesses(self)
+            # Make sure that output relayed so far doesn't end up in the pseudo terminals.
+            flush_standard_streams()
+            terminals = [t for t in self.pseudo_terminals if t.is_capturing and t.master_fd is None]
+            for pseudo_terminal in terminals:
+                pseudo_terminal.switch_to_fd_scope()
+            if self.merged:
+                for kind, stream in self.streams:
+                    self.output.attach(stream)
+            else:
+                self.attach_streams()
+            for pseudo_terminal in terminals:
+                pseudo_terminal.start_capture()
+
+    def get_combined_chunks(self, partial=PARTIAL_DEFAULT):
+        """get_combined_chunks(partial=False)
+        Get the output captured on both streams in the order in which it was stored.
+
+        :param partial: Refer to :func:`PseudoTerminal.get_handle()` for details.
+        :returns: A list of tuples with two values each: The number of the
+                  stream (:data:`STDOUT_FD`, :data:`STDERR_FD` or zero when
+                  `merged` is :data:`True`) and a chunk of output (a binary
+                  string).
+        :raises: :exc:`~exceptions.TypeError` when timestamps weren't recorded.
+
+        When `merged` is :data:`False` each stream is stored only once (by its
+        own pseudo terminal) while the :class:`ChunkIndex` objects of both
+        pseudo terminals share a single append-only log of entries that are
+        tagged with the stream. The position of an entry in the log is a
+        sequence number that's shared between the relay workers, so the two
+        streams are interleaved in the order in which the relay workers
+        stored the chunks of output.
+
+        This order is only as accurate as the reads of the relay workers: One
+        read can contain the output of many writes. The order of the writes
+        that went to the same stream is always preserved, however writes to
+        both streams in quick succession (e.g. alternating lines written
+        without delay) can end up grouped per stream. There's no way to
+        recover the original order once output has been buffered by the
+        pseudo terminals, so use `merged` set to :data:`True` when the exact
+        interleaving matters. When the scope is ``'python'`` output is stored
+        by the thread that writes it, so the order is exact (until the
+        capture switches to the ``'fd'`` scope).
+        """
+        if not partial:
+            self.finish_capture()
+        ranges = []
+        for name in ('output',) if self.merged else ('stdout', 'stderr'):
+            pseudo_terminal = getattr(self, name, None)
+            if pseudo_terminal is None:
+                continue
+            if pseudo_terminal.index is None:
+                raise TypeError("Timestamps weren't recorded! (refer to the timestamps option of CaptureOutput)")
+            for sequence_number, timestamp, start, end in pseudo_terminal.index.get_ranges(pseudo_terminal.mark()):
+                ranges.append((sequence_number, start, end, pseudo_terminal))
+        ranges.sort(key=lambda r: r[:3])
+        chunks = []
+        for sequence_number, start, end, pseudo_terminal in ranges:
+            stream = pseudo_terminal.index.stream
+            output = pseudo_terminal.read_range(start, end)
+            if chunks and chunks[-1][0] == stream:
+                # Merge consecutive chunks of the same stream.
+                chunks[-1] = (stream, chunks[-1][1] + output)
+            elif output:
+                chunks.append((stream, output))
+        return chunks
+
+    def get_combined_bytes(self, partial=PARTIAL_DEFAULT):
+        """get_combined_bytes(partial=False)
+        Get the output captured on both streams as binary data.
+
+        :param partial: Refer to :func:`PseudoTerminal.get_handle()` for details.
+        :returns: The combined output as a binary string (see
+                  :func:`get_combined_chunks()`).
+        """
+        return b''.join(output for stream, output in self.get_combined_chunks(partial))
+
+    def get_combined_lines(self, interpreted=True, partial=PARTIAL_DEFAULT):
+        """get_combined_lines(interpreted=True, partial=False)
+        Get the output captured on both streams split into lines.
+
+        :param interpreted: Refer to :func:`PseudoTerminal.get_lines()`.
+        :param partial: Refer to :func:`PseudoTerminal.get_handle()` for details.
+        :returns: The combined output as a list of Unicode strings (see
+                  :func:`get_combined_chunks()`).
+        """
+        decoders = {}
+        interpreter = TerminalInterpreter()
+        text = []
+        for stream, output in self.get_combined_chunks(partial):
+            # Multi byte characters are decoded per stream because chunks of
+            # the other stream can end up between their bytes.
+            if stream not in decoders:
+                decoders[stream] = codecs.getincrementaldecoder(self.encoding)('replace')
+            decoded = decoders[stream].decode(output)
+            if interpreted:
+                interpreter.feed(decoded)
+            else:
+                text.append(decoded)
+        if interpreted:
+            interpreter.feed(u'', final=True)
+            return interpreter.get_lines()
+        return u''.join(text).splitlines()
+
+    def get_combined_text(self, interpreted=True, partial=PARTIAL_DEFAULT):
+        """get_combined_text(interpreted=True, partial=False)
+        Get the output captured on both streams as a single string.
+
+        :param interpreted: Refer to :func:`PseudoTerminal.get_lines()`.
+        :param partial: Refer to :func:`PseudoTerminal.get_handle()` for details.
+        :returns: The combined output as a Unicode string (see
+                  :func:`get_combined_chunks()`).
+        """
+        return u'\n'.join(self.get_combined_lines(interpreted, partial))
+
+    def attach_streams(self):
+        """
+        Attach the standard output and error streams to separate pseudo terminals.
+
+        Internal shortcut for :func:`start_capture()` that attaches the
+        :class:`Stream` objects to the ``stdout`` and ``stderr`` pseudo
+        terminals when `merged` is :data:`False`.
+        """
+        for kind, stream in self.streams:
+            if kind == STDOUT_FD:
+                self.stdout.attach(stream)
+            elif kind == STDERR_FD:
+                self.stderr.attach(stream)
+            else:
+                raise Exception("Programming error: Unrecognized stream type!")
+
+    def allocate_pty(self, relay_fd=None, output_queue=None, queue_token=None, stream=0):
+        """
+        Allocate a pseudo terminal.
+
+        Internal shortcut for :func:`start_capture()` to allocate multiple
+        pseudo terminals without code duplication.
+        """
+        obj = PseudoTerminal(
+            self.encoding, self.termination_delay, self.chunk_size,
+            relay_fd=relay_fd, output_queue=output_queue,
+            queue_token=queue_token, engine=self.engine,
+            max_chunk_size=self.max_chunk_size,
+            zero_copy=self.zero_copy,
+            pool=self.pool,
+            storage=self.create_storage(),
+            index=self.create_index(stream),
+            transport=self.transport,
+            pipe_size=self.pipe_size,
+            store_processors=self.store_processors,
+            relay_processors=self.relay_processors,
+            start_method=self.start_method,
+        )
+        self.pseudo_terminals.append(obj)
+        return obj
+
+    def allocate_python_terminal(self, relay_stream, stream=0):
+        """
+        Allocate a :class:`PythonTerminal` object.
+
+        Internal shortcut for :func:`start_capture()` when the scope is
+        ``'python'``. The `relay_stream` is the :class:`Stream` whose original
+        file descriptor receives the relayed output once the capture switches
+        to the ``'fd'`` scope.
+        """
+        obj = PythonTerminal(
+            self.encoding, self.termination_delay, self.chunk_size,
+            relay_fd=relay_stream.original_fd if self.relay else None,
+            max_chunk_size=self.max_chunk_size,
+            zero_copy=self.zero_copy,
+            storage=self.create_storage(),
+            index=self.create_index(stream),
+            transport=self.transport,
+            pipe_size=self.pipe_size,
+            store_processors=self.store_processors,
+            relay_processors=self.relay_processors,
+        )
+        self.pseudo_terminals.append(obj)
+        return obj
+
+    def create_storage(self):
+        """
+        Create the storage for the output captured by a pseudo terminal.
+
+        :returns: A :class:`FileStorage` object (or an object of one of its
+                  subclasses, depending on the storage options).
+        """
+        if self.backend == 'memory':
+            return MemoryStorage()
+        if self.backend == 'spooled':
+            return SpooledStorage(self.spool_size)
+        if self.max_bytes is not None:
+            return RingBufferStorage(self.max_bytes, self.keep, self.backend)
+        if self.compression is not None:
+            return CompressedStorage(self.compression, self.backend)
+        return FileStorage(self.backend)
+
+    def create_index(self, stream=0):
+        """
+        Create the timestamped index of the output captured by a pseudo terminal.
+
+        :param stream: Refer to :class:`ChunkIndex`.
+        :returns: A :class:`ChunkIndex` object or :data:`None` when
+                  `timestamps` is :data:`False`.
+
+        When `merged` is :data:`False` the indexes of both streams share a
+        single log (see :func:`ChunkIndex.share()`).
+        """
+        if self.timestamps:
+            if stream and self.shared_index is not None:
+                return self.shared_index.share(stream)
+            in_memory = self.backend != 'file' and hasattr(os, 'memfd_create')
+            index = ChunkIndex(stream, 'memfd' if in_memory else 'file', shared=bool(stream))
+            if stream:
+                self.shared_index = index
+            return index
+
+    def merge_loop(self, started_event):
+        """
+        Merge and relay output in a child process.
+
+        This internal method is used when standard output and standard error
+        are being captured separately. It's responsible for emitting each
+        captured line on the appropriate stream without interleaving text
+        within lines.
+        """
+        buffers = {
+            STDOUT_FD: OutputBuffer(self.stdout_stream.original_fd),
+            STDERR_FD: OutputBuffer(self.stderr_stream.original_fd),
+        }
+        stats = CaptureStats()
+        started_event.set()
+        while buffers:
+            captured_from, output, queued_at = self.output_queue.get()
+            stats.queued_chunks += 1
+            stats.queue_latency_seconds += monotonic() - queued_at
+            try:
+                stats.max_queue_depth = max(stats.max_queue_depth, self.output_queue.qsize() + 1)
+            except NotImplementedError:
+                # multiprocessing.Queue.qsize() isn't implemented on Mac OS X.
+                pass
+            started = monotonic()
+            if output:
+                buffers[captured_from].add(output)
+            else:
+                buffers[captured_from].flush()
+                buffers.pop(captured_from)
+            stats.relay_write_seconds += monotonic() - started
+        # Let the main process know how the queue performed.
+        self.worker_connection.send(stats.get_counters(('queued_chunks', 'queue_latency_seconds',
+                                                        'max_queue_depth', 'relay_write_seconds')))
+
+
+class CapturePool(object):
+
+    """
+    Pool of pseudo terminals and relay workers that are reused between captures.
+
+    Allocating a pseudo terminal and starting a relay process is the most
+    expensive part of :func:`CaptureOutput.start_capture()`. When a
+    :class:`CapturePool` is passed to :class:`CaptureOutput` the pseudo
+    terminal and relay worker are borrowed from the pool instead and returned
+    to the pool when the capture finishes, so that only a fresh temporary file
+    is created for each capture. Captures that use a pool behave the same as
+    captures that don't. Here's an example:
+
+    .. code-block:: python
+
+       from capturer import CaptureOutput, CapturePool
+
+       with CapturePool() as pool:
+           for i in range(1000):
+               with CaptureOutput(pool=pool) as capturer:
+                   print("Capture number %i" % i)
+               assert capturer.get_text() == "Capture number %i" % i
+
+    The pool is thread safe. When several captures use the same pool at the
+    same time each capture borrows its own pseudo terminal.
+    """
+
+    def __init__(self, size=2, chunk_size=1024, engine=DEFAULT_ENGINE, max_chunk_size=None, zero_copy=False,
+                 start_method=DEFAULT_START_METHOD):
+        """
+        Initialize a :class:`CapturePool` object.
+
+        :param size: The maximum number of idle pseudo terminals (and relay
+                     workers) that are kept alive (an integer, defaults to 2).
+        :param chunk_size: Refer to :class:`CaptureOutput` for details.
+        :param engine: Refer to :class:`CaptureOutput` for details.
+        :param max_chunk_size: Refer to :class:`CaptureOutput` for details.
+        :param zero_copy: Refer to :class:`CaptureOutput` for details.
+        :param start_method: Refer to :class:`CaptureOutput` for details.
+        """
+        self.size = size
+        self.chunk_size = chunk_size
+        self.engine = engine
+        self.max_chunk_size = max_chunk_size
+        self.start_method = start_method
+        self.zero_copy = zero_copy
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        """Enter a :keyword:`with` block (the pool is closed when the block is left)."""
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Automatically call :func:`close()` when leaving a :keyword:`with` block."""
+        self.close()
+
+    def acquire(self):
+        """
+        Borrow a pseudo terminal and relay worker from the pool.
+
+        :returns: A :class:`PooledTerminal` object (a new one is created when
+                  the pool is empty).
+        """
+        with self.lock:
+            while self.idle:
+                terminal = self.idle.pop()
+                if terminal.is_alive:
+                    return terminal
+                terminal.close()
+        return PooledTerminal(
+            self.chunk_size, engine=self.engine,
+            max_chunk_size=self.max_chunk_size,
+            zero_copy=self.zero_copy,
+            start_method=self.start_method,
+        )
+
+    def release(self, terminal):
+        """
+        Return a pseudo terminal and relay worker to the pool.
+
+        :param terminal: A :class:`PooledTerminal` object returned by
+                         :func:`acquire()`. It's destroyed instead when its
+                         relay worker died or the pool is full.
+        """
+        with self.lock:
+            if terminal.is_alive and len(self.idle) < self.size:
+                self.idle.append(terminal)
+                return
+        terminal.close()
+
+    def close(self):
+        """Destroy the idle pseudo terminals and stop their relay workers."""
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
+
+
+class CaptureStats(object):
+
+    """
+    Statistics about a capture, to find out whether capturing output is a bottleneck.
+
+    Each :class:`PseudoTerminal` has its own statistics (see
+    :attr:`PseudoTerminal.stats`) and the statistics of a
+    :class:`CaptureOutput` object (see :attr:`CaptureOutput.stats`) refer to
+    those of its pseudo terminals using :attr:`streams`. All counters start
+    at zero and durations are measured in seconds.
+
+    The counters in :data:`worker_counters` are collected by the relay worker.
+    When that's a child process they're reported back to the main process
+    when the capture finishes, until then they're zero.
+    """
+
+    counters = (
+        'bytes_captured',
+        'read_calls',
+        'relay_write_seconds',
+        'queued_chunks',
+        'queue_latency_seconds',
+        'max_queue_depth',
+        'start_capture_seconds',
+        'finish_capture_seconds',
+        'decode_seconds',
+    )
+    """
+    The names of the counters (a tuple of strings):
+
+    ``bytes_captured``
+     The number of bytes of output that were stored.
+
+    ``read_calls``
+     The number of times output was read from the pseudo terminal.
+
+    ``relay_write_seconds``
+     The time spent relaying output (writing it to the original stream or
+     putting it on the queue of the ``merged=False`` path).
+
+    ``queued_chunks``, ``queue_latency_seconds`` and ``max_queue_depth``
+     The number of chunks of output relayed through the queue of the
+     ``merged=False`` path, the total time they spent waiting in the queue
+     and the maximum number of chunks that were waiting at once.
+
+    ``start_capture_seconds`` and ``finish_capture_seconds``
+     The time spent in ``start_capture()`` and ``finish_capture()``
+     (including the termination delay).
+
+    ``decode_seconds``
+     The time spent computing views of the captured output (reading, decoding
+     and interpreting it) for accessors like ``get_text()``.
+    """
+
+    worker_counters = ('bytes_captured', 'read_calls', 'relay_write_seconds')
+    """The names of the counters that are collected by the relay worker (a tuple of strings)."""
+
+    def __init__(self, **counters):
+        """
+        Initialize a :class:`CaptureStats` object.
+
+        :param counters: Initial values for the counters in :data:`counters`.
+        """
+        for name in self.counters:
+            setattr(self, name, 0)
+        self.update(counters)
+        self.streams = {}
+
+    @property
+    def average_chunk_size(self):
+        """The average number of bytes captured per read (a number)."""
+        return float(self.bytes_captured) / self.read_calls if self.read_calls else 0.0
+
+    @property
+    def average_queue_latency(self):
+        """The average number of seconds that chunks spent in the queue (a number)."""
+        return self.queue_latency_seconds / self.queued_chunks if self.queued_chunks else 0.0
+
+    def get_counters(self, names=None):
+        """
+        Get the values of counters.
+
+        :param names: An iterable of counter names (defaults to :data:`counters`).
+        :returns: A dictionary that maps counter names to numbers.
+        """
+        return dict((name, getattr(self, name)) for name in (names or self.counters))
+
+    def update(self, counters):
+        """
+        Set the values of counters.
+
+        :param counters: A dictionary that maps counter names to numbers (for
+                         example reported by the relay worker).
+        """
+        for name, value in counters.items():
+            setattr(self, name, value)
+
+    def to_dict(self):
+        """
+        Get the statistics in a form suitable for metrics systems.
+
+        :returns: A dictionary with the counters, the averages and (when
+                  :attr:`streams` isn't empty) a nested dictionary with the
+                  statistics of each stream.
+        """
+        result = self.get_counters()
+        result.update(average_chunk_size=self.average_chunk_size, average_queue_latency=self.average_queue_latency)
+        if self.streams:
+            result['streams'] = dict((name, stats.to_dict()) for name, stats in self.streams.items())
+        return result
+
+
+class IncrementalLineDecoder(object):
+
+    """
+    Decode binary output into lines of text, one chunk at a time.
+
+    Used by :func:`PseudoTerminal.iter_lines()` to turn a stream of binary
+    chunks into complete lines of text. Multi byte characters and line
+    terminators that are split between chunks are handled correctly and the
+    resulting lines match those produced by :meth:`str.splitlines()` on the
+    decoded output as a whole.
+    """
+
+    def __init__(self, encoding, errors='strict'):
+        """
+        Initialize an :class:`IncrementalLineDecoder` object.
+
+        :param encoding: The name of the character encoding used to decode the
+                         output (a string).
+        :param errors: The error handling scheme used to decode the output (a
+                       string, defaults to ``'strict'``).
+        """
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.pending = u''
+
+    def decode(self, chunk, final=False):
+        """
+        Decode a chunk of output.
+
+        :param chunk: The output to decode (a binary string).
+        :param final: :data:`True` if this is the last chunk of output,
+                      :data:`False` otherwise.
+        :returns: A list of complete lines (Unicode strings without line
+                  terminators). When `final` is :data:`True` any remaining
+                  partial line is included.
+        """
+        text = self.pending + self.decoder.decode(chunk, final)
+        lines = text.splitlines(True)
+        self.pending = u''
+        if lines and not final:
+            # Hold back the last line when it's incomplete. A trailing
+            # carriage return is held back as well because the following
+            # chunk may start with a line feed.
+            last_line = lines[-1]
+            if last_line.splitlines()[0] == last_line or last_line.endswith(u'\r'):
+                self.pending = lines.pop()
+        return [line.splitlines()[0] for line in lines]
+
+
+class TerminalInterpreter(object):
+
+    """
+    Emulate the effect of special characters on terminal output, one chunk at a time.
+
+    This is an incremental equivalent of :func:`.clean_terminal_output()`:
+    Feeding the decoded output to :func:`feed()` in arbitrary chunks and then
+    calling :func:`get_lines()` gives the same result as passing the output as
+    a whole to :func:`.clean_terminal_output()`, but each chunk of output is
+    only processed once. :class:`PseudoTerminal` uses this to keep the
+    interpreted output up to date between calls to
+    :func:`~PseudoTerminal.get_lines()` and :func:`~PseudoTerminal.get_text()`.
+
+    Lines are considered complete as soon as a line feed is seen, after that
+    carriage returns, backspaces and 'erase line' escape sequences no longer
+    affect them.
+    """
+
+    ansi_sequence_pattern = re.compile(u'\x1b\\[(?!K)[0-?]*[ -/]*[@-~]')
+    """Matches ANSI escape sequences other than 'erase line'."""
+
+    incomplete_sequence_pattern = re.compile(u'\x1b(\\[[0-?]*[ -/]*)?\\Z')
+    """Matches an ANSI escape sequence that's cut off at the end of a chunk."""
+
+    def __init__(self, strip_ansi=False):
+        """
+        Initialize a :class:`TerminalInterpreter` object.
+
+        :param strip_ansi: :data:`True` to remove ANSI escape sequences (other
+                           than 'erase line') from the output, :data:`False`
+                           (the default) to preserve them like
+                           :func:`.clean_terminal_output()` does.
+        """
+        self.strip_ansi = strip_ansi
+        self.lines = []
+        self.current_line = u''
+        self.current_position = 0
+        self.pending = u''
+
+    def feed(self, text, final=False):
+        """
+        Interpret a chunk of output.
+
+        :param text: The output to interpret (a Unicode string).
+        :param final: :data:`True` if this is the last chunk of output,
+                      :data:`False` otherwise.
+        :returns: A list with the lines that were completed by this chunk
+                  (Unicode strings without line terminators).
+
+        An escape sequence that's split between chunks is held back until the
+        next chunk arrives (or `final` is :data:`True`).
+        """
+        text = self.pending + text
+        self.pending = u''
+        if not final:
+            match = self.incomplete_sequence_pattern.search(text)
+            if match:
+                self.pending = text[match.start():]
+                text = text[:match.start()]
+        if self.strip_ansi:
+            text = self.ansi_sequence_pattern.sub(u'', text)
+        num_lines = len(self.lines)
+        # The following loop is the same as in clean_terminal_output(), except
+        # that the state is kept in instance variables between calls.
+        for token in CLEAN_OUTPUT_PATTERN.split(text):
+            if token == u'\r':
+                # Seek back to the start of the current line.
+                self.current_position = 0
+            elif token == u'\b':
+                # Seek back one character in the current line.
+                self.current_position = max(0, self.current_position - 1)
+            elif token == u'\n':
+                # Capture and clear the current line.
+                self.lines.append(self.current_line)
+                self.current_line = u''
+                self.current_position = 0
+            elif token == ANSI_ERASE_LINE:
+                # Clear the current line.
+                self.current_line = u''
+                self.current_position = 0
+            elif token:
+                # Merge regular output into the current line.
+                new_position = self.current_position + len(token)
+                prefix = self.current_line[:self.current_position]
+                suffix = self.current_line[new_position:]
+                self.current_line = prefix + token + suffix
+                self.current_position = new_position
+        return self.lines[num_lines:]
+
+    def get_lines(self):
+        """
+        Get the interpreted output.
+
+        :returns: A list of Unicode strings (one for each line). The current
+                  (incomplete) line is included and empty trailing lines are
+                  removed, like :func:`.clean_terminal_output()` does.
+        """
+        lines = self.lines + [self.current_line]
+        while lines and not lines[-1]:
+            lines.pop(-1)
+        return lines
+
+
+class OutputCursor(object):
+
+    """
+    Read the output captured by a :class:`PseudoTerminal` incrementally.
+
+    Each read returns only the output that was captured since the previous
+    read, so polling a long running capture doesn't get slower as the capture
+    grows. The text based readers decode the output incrementally, which means
+    multi byte characters that are split between reads are handled correctly.
+    Don't mix binary and text reads on the same cursor, because the text based
+    readers can hold back part of the output until the rest arrives.
+    """
+
+    def __init__(self, pseudo_terminal, offset=0):
+        """
+        Initialize an :class:`OutputCursor` object.
+
+        :param pseudo_terminal: The :class:`PseudoTerminal` whose output
+                                should be read.
+        :param offset: The byte offset where reading should start (an
+                       integer, defaults to zero).
+        """
+        self.pseudo_terminal = pseudo_terminal
+        self.offset = offset
+        errors = pseudo_terminal.decoding_errors
+        self.decoder = codecs.getincrementaldecoder(pseudo_terminal.encoding)(errors)
+        self.line_decoder = IncrementalLineDecoder(pseudo_terminal.encoding, errors)
+
+    def read_bytes(self):
+        """
+        Get the output captured since the previous read.
+
+        :returns: A binary string.
+        """
+        chunks = []
+        while True:
+            offset, output = self.pseudo_terminal.storage.read(self.offset)
+            if not output:
+                return b''.join(chunks)
+            chunks.append(output)
+            self.offset = offset + len(output)
+
+    def read_text(self):
+        """
+        Get the output captured since the previous read as text.
+
+        :returns: A Unicode string. A multi byte character that's split at the
+                  end of the captured output is held back until the rest of
+                  it has been captured (or the capture has finished).
+        """
+        finished = not self.pseudo_terminal.is_capturing
+        return self.decoder.decode(self.read_bytes(), finished)
+
+    def read_lines(self):
+        """
+        Get the lines that were completed since the previous read.
+
+        :returns: A list of Unicode strings (without line terminators). The
+                  last line is held back until it's complete (or the capture
+                  has finished).
+        """
+        finished = not self.pseudo_terminal.is_capturing
+        return self.line_decoder.decode(self.read_bytes(), finished)
+
+
+class OutputNotifier(object):
+
+    """
+    Helper for :func:`PseudoTerminal.wait_for()`.
+
+    Wakes up threads that are waiting for captured output using a pipe: the
+    relay worker (which may be a child process) writes to the pipe once it
+    has stored a burst of output (see :func:`FileWriter.notify()`) and the
+    waiting threads wait for the pipe to become readable. Once all copies of
+    the writable end have been closed (because the capture finished) the
+    pipe stays readable, so waiting threads can't miss the end of a capture.
+
+    Only one waiting thread at a time reads from the pipe. It increments
+    :attr:`generation` when it's woken up and wakes up the other waiting
+    threads using a condition variable, so that a thread that empties the
+    pipe doesn't consume the notifications of other waiting threads.
+    """
+
+    def __init__(self):
+        """Initialize an :class:`OutputNotifier` object."""
+        read_fd, self.write_fd = os.pipe()
+        for fd in (read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # The readable end is closed when the notifier is garbage collected.
+        self.handle = os.fdopen(read_fd, 'rb', 0)
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.selector = FileDescriptorSelector([read_fd])
+        self.generation = 0
+        self.reading = False
+        self.waiting = 0
+
+    def enter(self):
+        """Register a waiting thread (so that output stored in the current process triggers notifications)."""
+        with self.lock:
+            self.waiting += 1
+
+    def leave(self):
+        """Unregister a waiting thread."""
+        with self.lock:
+            self.waiting -= 1
+
+    def wait(self, generation, timeout=None):
+        """
+        Wait for a notification.
+
+        :param generation: The value of :attr:`generation` before the waiting
+                           thread checked for output (an integer). When a
+                           notification has arrived since then this returns
+                           immediately.
+        :param timeout: The maximum number of seconds to wait (a number or
+                        :data:`None` to wait indefinitely).
+        """
+        deadline = monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while self.generation == generation:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return
+                if self.reading:
+                    # Another waiting thread is reading from the pipe.
+                    self.condition.wait(remaining)
+                    continue
+                self.reading = True
+                self.lock.release()
+                try:
+                    readable = self.selector.wait(remaining)
+                    if readable:
+                        self.drain()
+                finally:
+                    self.lock.acquire()
+                    self.reading = False
+                if readable:
+                    self.generation += 1
+                # Wake up the other waiting threads (either because of the
+                # notification or so that one of them takes over reading).
+                self.condition.notify_all()
+
+    def drain(self):
+        """Read the pending notifications from the pipe."""
+        try:
+            os.read(self.handle.fileno(), PIPE_CAPACITY)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+class Multiplexer(MultiProcessHelper):
+
+    """
+    Helper for :class:`CaptureOutput`.
+
+    Captures, stores and relays the output of several pseudo terminals in a
+    single loop (see :func:`multiplex_loop()`). Used when `merged` is
+    :data:`False` and `multiplexed` is :data:`True`.
+
+    Because the pseudo terminals share a single loop, finishing the capture of
+    one pseudo terminal finishes the capture of all of them.
+    """
+
+    worker_attributes = MultiProcessHelper.worker_attributes + ('members',)
+    """The names of the attributes that are used by :func:`multiplex_loop()` (a tuple of strings)."""
+
+    def __init__(self, termination_delay, engine=DEFAULT_ENGINE, start_method=DEFAULT_START_METHOD):
+        """
+        Initialize a :class:`Multiplexer` object.
+
+        :param termination_delay: The number of seconds to wait before
+                                  terminating the output relay process (a
+                                  floating point number).
+        :param engine: The name of the relay engine to use (one of the strings
+                       in :data:`SUPPORTED_ENGINES`, defaults to
+                       :data:`DEFAULT_ENGINE`).
+        :param start_method: Refer to :class:`MultiProcessHelper`.
+        """
+        # Initialize the superclass.
+        super(Multiplexer, self).__init__(engine=engine, start_method=start_method)
+        # Store constructor arguments.
+        self.termination_delay = termination_delay
+        # Initialize instance variables.
+        self.members = []
+
+    def add(self, pseudo_terminal, relay_fd=None):
+        """
+        Add a pseudo terminal to the multiplexer.
+
+        :param pseudo_terminal: A :class:`PseudoTerminal` object.
+        :param relay_fd: The number of the file descriptor where output
+                         captured by the pseudo terminal should be relayed to
+                         (an integer or :data:`None` to disable relaying).
+        """
+        pseudo_terminal.multiplexer = self
+        self.members.append((pseudo_terminal, relay_fd))
+
+    def __getstate__(self):
+        """Get the :attr:`worker_attributes` to pickle (including the relay file descriptors)."""
+        state = super(Multiplexer, self).__getstate__()
+        state['members'] = [(pseudo_terminal, reduce_fd(relay_fd)) for pseudo_terminal, relay_fd in self.members]
+        return state
+
+    def __setstate__(self, state):
+        """Restore the :attr:`worker_attributes` in a child process (including the relay file descriptors)."""
+        state['members'] = [(pseudo_terminal, rebuild_fd(relay_fd)) for pseudo_terminal, relay_fd in state['members']]
+        super(Multiplexer, self).__setstate__(state)
+
+    def start_capture(self):
+        """Start the child process (or thread) responsible for capturing and relaying output."""
+        if not self.uses_threads:
+            for pseudo_terminal, relay_fd in self.members:
+                pseudo_terminal.create_notifier()
+        self.start_child(self.multiplex_loop)
+
+    def finish_capture(self):
+        """Stop the process of capturing output and destroy the pseudo terminals."""
+        if self.processes:
+            flush_standard_streams()
+            if self.termination_delay:
+                time.sleep(self.termination_delay)
+            self.stop_children()
+            if self.acknowledgement:
+                for (pseudo_terminal, relay_fd), offset, counters in zip(
+                        self.members, self.acknowledgement['offsets'], self.acknowledgement['stats']):
+                    pseudo_terminal.drained_offset = offset
+                    pseudo_terminal.stats.update(counters)
+            for pseudo_terminal, relay_fd in self.members:
+                pseudo_terminal.finish_capture()
+
+    def multiplex_loop(self, started_event):
+        """
+        Capture, store and relay the output of all pseudo terminals.
+
+        This function is run in the background by :func:`start_capture()`. It
+        waits for any of the master ends of the pseudo terminals to become
+        readable, stores the output in the temporary file of the pseudo
+        terminal and relays the output to the appropriate file descriptor
+        after each line break (so that lines emitted on different streams
+        aren't interleaved).
+
+        Shutdown requests are only honored once none of the pseudo terminals
+        have pending output, so all output is stored before the request is
+        acknowledged (see :func:`~MultiProcessHelper.stop_children()`).
+        """
+        members = {}
+        for pseudo_terminal, relay_fd in self.members:
+            buffer = OutputBuffer(relay_fd) if relay_fd is not None else None
+            members[pseudo_terminal.master_fd] = (pseudo_terminal, buffer)
+        stored = dict((fd, 0) for fd in members)
+        selector = FileDescriptorSelector(members)
+        selector.register(self.worker_connection.fileno())
+        started_event.set()
+        try:
+            while True:
+                # Flush buffered output once the pseudo terminals are idle
+                # (and wake up threads waiting for output as soon as they
+                # become idle).
+                writers = [pseudo_terminal.writer for pseudo_terminal, buffer in members.values()]
+                pending = [writer for writer in writers if writer.needs_flush]
+                notify = [writer for writer in writers if writer.needs_notify]
+                readable = selector.wait(0) if notify else []
+                if not readable:
+                    for writer in notify:
+                        writer.notify()
+                    readable = selector.wait(FLUSH_INTERVAL if pending else None)
+                ready = [fd for fd in readable if fd in members]
+                if not ready:
+                    if readable:
+                        raise ShutdownRequested
+                    for writer in pending:
+                        writer.flush()
+                    continue
+                for fd in ready:
+                    pseudo_terminal, buffer = members[fd]
+                    output = pseudo_terminal.read_chunk()
+                    pseudo_terminal.stats.read_calls += 1
+                    if output:
+                        # Store the output in the temporary file.
+                        pseudo_terminal.writer.write(output)
+                        stored[fd] += len(output)
+                        pseudo_terminal.stats.bytes_captured += len(output)
+                        # Relay the output to the original stream?
+                        if buffer is not None:
+                            started = monotonic()
+                            if pseudo_terminal.relay_processors is not None:
+                                output = pseudo_terminal.relay_processors.process(output)
+                            buffer.add(output)
+                            pseudo_terminal.stats.relay_write_seconds += monotonic() - started
+                    else:
+                        # Stop watching pseudo terminals that reached EOF.
+                        selector.unregister(fd)
+        except ShutdownRequested:
+            # Relay any remaining output (that didn't end in a line break).
+            for pseudo_terminal, buffer in members.values():
+                pseudo_terminal.writer.finish()
+                if buffer is not None:
+                    if pseudo_terminal.relay_processors is not None:
+                        buffer.add(pseudo_terminal.relay_processors.process(b'', final=True))
+                    buffer.flush()
+            # Let the main process know how much output was stored.
+            offsets = [stored[pseudo_terminal.master_fd] for pseudo_terminal, relay_fd in self.members]
+            stats = [pseudo_terminal.stats.get_counters(CaptureStats.worker_counters)
+                     for pseudo_terminal, relay_fd in self.members]
+            self.acknowledge_shutdown(dict(offsets=offsets, stats=stats))
+        finally:
+            selector.close()
+
+
+class OutputBuffer(object):
+
+    """
+    Helper for :func:`CaptureOutput.merge_loop()`.
+
+    Buffers captured output and flushes to the appropriate stream after each
+    line break. Only output that was added since the previous call to
+    :func:`add()` is scanned for line breaks, so the time spent relaying
+    output is linear in the size of the output (even for very long lines).
+    """
+
+    def __init__(self, fd, max_line_length=MAX_LINE_LENGTH):
+        """
+        Initialize an :class:`OutputBuffer` object.
+
+        :param fd: The number of the file descriptor where output should be
+                   flushed (an integer).
+        :param max_line_length: The maximum number of bytes to hold back
+                                while waiting for a line break (an integer or
+                                :data:`None` for no limit, defaults to
+                                :data:`MAX_LINE_LENGTH`).
+        """
+        self.fd = fd
+        self.buffer = bytearray()
+        self.max_line_length = max_line_length
+
+    def add(self, output):
+        """
+        Add output to the buffer and flush appropriately.
+
+        :param output: The output to add to the buffer (a string).
+        """
+        scan_offset = len(self.buffer)
+        self.buffer += output
+        index = self.buffer.rfind(b'\n', scan_offset)
+        if index >= 0:
+            write_all(self.fd, self.buffer[:index + 1])
+            del self.buffer[:index + 1]
+        elif self.max_line_length is not None and len(self.buffer) >= self.max_line_length:
+            self.flush()
+
+    def flush(self):
+        """Flush any remaining buffered output to the stream."""
+        if self.buffer:
+            output, self.buffer = self.buffer, bytearray()
+            write_all(self.fd, output)
+
+
+class LineProcessor(object):
+
+    """
+    Wraps a callable that processes captured output one line at a time.
+
+    Refer to :class:`ProcessorChain` for details. Here's an example that
+    redacts a secret from the captured output:
+
+    .. code-block:: python
+
+       from capturer import CaptureOutput, LineProcessor
+
+       def redact(line):
+           return line.replace(b'hunter2', b'*******')
+
+       processors = [LineProcessor(redact)]
+       with CaptureOutput(store_processors=processors, relay_processors=processors):
+           ...
+    """
+
+    def __init__(self, function):
+        """
+        Initialize a :class:`LineProcessor` object.
+
+        :param function: A callable that takes a line of output (a binary
+                         string including the line break, except for the
+                         last line when it doesn't end in a line break) and
+                         returns the processed output (a binary string, which
+                         is empty to drop the line).
+        """
+        self.function = function
+
+    def __call__(self, line):
+        """Process a line of output (refer to :func:`__init__()` for details)."""
+        return self.function(line)
+
+
+class ProcessorChain(object):
+
+    """
+    Applies a list of processors to captured output in the relay worker.
+
+    A processor is a callable that takes a chunk of output (a binary string)
+    and returns the processed output (a binary string, which can be empty).
+    Processors wrapped in a :class:`LineProcessor` are called once for each
+    complete line instead: output is buffered until a line break is seen (or
+    :data:`MAX_LINE_LENGTH` bytes are buffered, or the capture finishes). The
+    output of each processor is the input of the next processor.
+
+    Each chain keeps its own line buffers, so the same processors can be
+    given to several pseudo terminals. Chains are used by the relay worker
+    (which may be a child process) so processors need to be picklable when
+    they're used with a :class:`CapturePool` whose engine is ``'process'``.
+    """
+
+    def __init__(self, processors):
+        """
+        Initialize a :class:`ProcessorChain` object.
+
+        :param processors: An iterable of processors.
+        """
+        self.processors = list(processors)
+        self.buffers = [bytearray() if isinstance(p, LineProcessor) else None for p in self.processors]
+
+    def process(self, output, final=False):
+        """
+        Process a chunk of output.
+
+        :param output: The output to process (a binary string).
+        :param final: :data:`True` when the capture is finishing (to process
+                      the remaining output in the line buffers).
+        :returns: The processed output (a binary string).
+        """
+        for processor, buffer in zip(self.processors, self.buffers):
+            if buffer is None:
+                if output:
+                    output = processor(output)
+                continue
+            scan_offset = len(buffer)
+            buffer += output
+            if final or len(buffer) >= MAX_LINE_LENGTH:
+                end = len(buffer)
+            else:
+                end = buffer.rfind(b'\n', scan_offset) + 1
+                if not end:
+                    output = b''
+                    continue
+            lines = bytes(buffer[:end])
+            del buffer[:end]
+            output = b''.join(processor(line) for line in re.findall(b'[^\n]*\n|[^\n]+', lines))
+        return output
+
+
+class FileStorage(object):
+
+    """
+    Storage for captured output in an (unlinked) temporary file.
+
+    The temporary file grows as output is captured and holds all of the output.
+    Output is written by a :class:`FileWriter` object (see
+    :func:`create_writer()`) and read using the methods of the storage.
+    """
+
+    dropped_bytes = 0
+    """The number of bytes of output that weren't kept (always zero)."""
+
+    is_lossy = False
+    """:data:`True` if the storage drops output, :data:`False` otherwise."""
+
+    def __init__(self, backend='file'):
+        """
+        Initialize a :class:`FileStorage` object.
+
+        :param backend: The kind of file to create (``'file'`` or ``'memfd'``,
+                        refer to :func:`create_temporary_file()`).
+        """
+        self.output_fd, self.output_handle = create_temporary_file(backend)
+        self.mapped_output = None
+
+    @staticmethod
+    def validate_backend(backend):
+        """
+        Validate the name of a storage backend.
+
+        :param backend: One of the strings in :data:`SUPPORTED_BACKENDS`.
+        :raises: :exc:`~exceptions.ValueError` when the backend isn't
+                 supported (or isn't available on this platform).
+        """
+        if backend not in SUPPORTED_BACKENDS:
+            msg = "Unsupported storage backend! (%r is not one of %s)"
+            raise ValueError(msg % (backend, ", ".join(map(repr, SUPPORTED_BACKENDS))))
+        if backend in ('memfd', 'spooled') and not hasattr(os, 'memfd_create'):
+            raise ValueError("The %r backend requires os.memfd_create() (Python 3.8+ on Linux)!" % backend)
+
+    def finish(self):
+        """
+        Update the storage once output is no longer being stored.
+
+        Does nothing for :class:`FileStorage` objects.
+        """
+
+    def create_writer(self):
+        """
+        Create the object that stores output in the temporary file.
+
+        :returns: A :class:`FileWriter` object.
+        """
+        return FileWriter(self.output_fd)
+
+    def get_size(self):
+        """
+        Get the number of bytes of output that have been stored.
+
+        :returns: The size of the captured output in bytes (an integer).
+        """
+        return os.fstat(self.output_handle.fileno()).st_size
+
+    def read(self, offset, size=None):
+        """
+        Read captured output starting at the given byte offset.
+
+        :param offset: The byte offset in the captured output (an integer).
+        :param size: The maximum number of bytes to read (an integer or
+                     :data:`None` to read all available output).
+        :returns: A tuple of two values:
+
+                  1. The offset where the output that was read starts (an
+                     integer). This is the given offset unless the output at
+                     that offset was dropped.
+                  2. The output that was read (a binary string).
+        """
+        available = self.get_size() - offset
+        size = available if size is None else min(size, available)
+        if size <= 0:
+            return offset, b''
+        return offset, pread(self.output_handle.fileno(), size, offset)
+
+    def get_buffer(self):
+        """
+        Get the captured output as a read-only memory map.
+
+        :returns: A read-only :class:`mmap.mmap` object (or an empty binary
+                  string when no output was captured).
+        """
+        size = self.get_size()
+        if self.mapped_output is None or len(self.mapped_output) != size:
+            if size > 0:
+                self.mapped_output = mmap.mmap(self.output_handle.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                self.mapped_output = b''
+        return self.mapped_output
+
+    def get_handle(self):
+        """
+        Get the captured output as a file object.
+
+        :returns: A file object positioned at the start of the output.
+        """
+        self.output_handle.seek(0)
+        return self.output_handle
+
+
+class RingBufferStorage(FileStorage):
+
+    """
+    Storage that keeps a bounded window of the captured output.
+
+    The temporary file has a fixed size that's allocated up front, so disk
+    usage stays constant no matter how much output is captured. The file
+    starts with a header that holds the total number of bytes written (an
+    unsigned 64 bit integer) followed by a region for the start of the
+    output (only used when `keep` is ``'head+tail'``) and a ring buffer that
+    holds the most recent output.
+
+    Byte offsets into the captured output (for example those used by
+    :func:`PseudoTerminal.mark()` and :class:`OutputCursor`) remain logical
+    offsets into all of the output that was captured, reading starts at the
+    first output that was kept when the output at an offset was dropped.
+    """
+
+    header = struct.Struct('<Q')
+
+    is_lossy = True
+
+    def __init__(self, max_bytes, keep='tail', backend='file'):
+        """
+        Initialize a :class:`RingBufferStorage` object.
+
+        :param max_bytes: The maximum number of bytes of output to keep (a
+                          positive integer).
+        :param keep: Which part of the output to keep (one of the strings in
+                     :data:`SUPPORTED_KEEP_MODES`, defaults to ``'tail'``).
+        :param backend: Refer to :class:`FileStorage`.
+        :raises: :exc:`~exceptions.ValueError` when the options are invalid.
+        """
+        self.validate_options(max_bytes, keep)
+        super(RingBufferStorage, self).__init__(backend)
+        self.head_size = max_bytes // 2 if keep == 'head+tail' else 0
+        self.tail_size = max_bytes - self.head_size
+        os.ftruncate(self.output_fd, self.header.size + max_bytes)
+
+    @staticmethod
+    def validate_options(max_bytes, keep):
+        """
+        Validate the options of a :class:`RingBufferStorage` object.
+
+        :param max_bytes: Refer to :class:`RingBufferStorage`.
+        :param keep: Refer to :class:`RingBufferStorage`.
+        :raises: :exc:`~exceptions.ValueError` when the options are invalid.
+        """
+        if keep not in SUPPORTED_KEEP_MODES:
+            msg = "Invalid value for keep! (%r is not one of %s)"
+            raise ValueError(msg % (keep, ", ".join(map(repr, SUPPORTED_KEEP_MODES))))
+        if not (isinstance(max_bytes, numbers.Integral) and max_bytes > 0):
+            raise ValueError("The value of max_bytes must be a positive integer! (got %r)" % max_bytes)
+
+    @property
+    def dropped_bytes(self):
+        """The number of bytes of output that weren't kept (an integer)."""
+        return max(0, self.get_size() - self.head_size - self.tail_size)
+
+    def create_writer(self):
+        """
+        Create the object that stores output in the ring buffer.
+
+        :returns: A :class:`RingBufferWriter` object.
+        """
+        return RingBufferWriter(self.output_fd, self.head_size, self.tail_size)
+
+    def get_size(self):
+        """
+        Get the number of bytes of output that have been captured.
+
+        :returns: The total size of the captured output in bytes (including
+                  output that was dropped) as an integer.
+        """
+        total, = self.header.unpack(pread(self.output_handle.fileno(), self.header.size, 0))
+        return total
+
+    def read(self, offset, size=None):
+        """
+        Read captured output starting at the given byte offset.
+
+        :param offset: The logical byte offset in the captured output (an
+                       integer).
+        :param size: The maximum number of bytes to read (an integer or
+                     :data:`None` to read all available output).
+        :returns: A tuple of two values, refer to :func:`FileStorage.read()`.
+
+        Output at the start of the ring buffer may be overwritten while it's
+        being read, in which case it's read again from the new start.
+        """
+        while True:
+            total = self.get_size()
+            head_end = min(total, self.head_size)
+            if offset < head_end:
+                end = head_end if size is None else min(head_end, offset + size)
+                # The head region is never overwritten.
+                return offset, pread(self.output_handle.fileno(), end - offset, self.header.size + offset)
+            start = max(offset, self.head_size, total - self.tail_size)
+            if start >= total:
+                return offset, b''
+            end = total if size is None else min(total, start + size)
+            output = self.read_ring(start, end)
+            if start >= self.get_size() - self.tail_size:
+                return start, output
+            offset = start
+
+    def read_ring(self, start, end):
+        """
+        Read output from the ring buffer.
+
+        :param start: The logical byte offset where reading starts (an integer).
+        :param end: The logical byte offset where reading ends (an integer).
+        :returns: The output that was read (a binary string).
+        """
+        chunks = []
+        fd = self.output_handle.fileno()
+        while start < end:
+            ring_offset = (start - self.head_size) % self.tail_size
+            size = min(end - start, self.tail_size - ring_offset)
+            chunks.append(pread(fd, size, self.header.size + self.head_size + ring_offset))
+            start += size
+        return b''.join(chunks)
+
+    def get_buffer(self):
+        """
+        Get the output that was kept.
+
+        :returns: A binary string with the output that was kept (the head and
+                  tail are simply concatenated, :attr:`dropped_bytes` can be
+                  used to find out whether output was dropped in between).
+        """
+        chunks = []
+        offset = 0
+        while True:
+            offset, output = self.read(offset)
+            if not output:
+                return b''.join(chunks)
+            chunks.append(output)
+            offset += len(output)
+
+    def get_handle(self):
+        """
+        Get the output that was kept as a file object.
+
+        :returns: An :class:`io.BytesIO` object.
+        """
+        return io.BytesIO(self.get_buffer())
+
+
+class CompressedStorage(FileStorage):
+
+    """
+    Storage that compresses captured output while it's being stored.
+
+    The temporary file holds a gzip_ (for ``'zlib'``) or xz_ (for ``'lzma'``)
+    compressed stream, so it can be saved as is (see
+    :func:`PseudoTerminal.save_to_handle()`). The decompressed output isn't
+    kept in memory: Output is decompressed as a stream by
+    :class:`DecompressingReader` objects, one of which keeps track of the
+    decompressed size while another serves :func:`read()`. Sequential reads
+    (like following the output while it's being captured) decompress each
+    part of the compressed stream only once, reading at an earlier offset
+    decompresses the stream from the start.
+
+    The ``'zlib'`` compressor is flushed regularly so that partial reads see
+    the output captured so far (lagging behind by at most
+    :data:`FLUSH_INTERVAL` seconds). The ``'lzma'`` compressor
+    doesn't support this, so partial reads may lag behind until the
+    compressor emits a block (it compresses better though).
+
+    .. _gzip: https://en.wikipedia.org/wiki/Gzip
+    .. _xz: https://en.wikipedia.org/wiki/XZ_Utils
+    """
+
+    def __init__(self, compression='zlib', backend='file'):
+        """
+        Initialize a :class:`CompressedStorage` object.
+
+        :param compression: The compression method to use (one of the strings
+                            in :data:`SUPPORTED_COMPRESSION`, defaults to
+                            ``'zlib'``).
+        :param backend: Refer to :class:`FileStorage`.
+        :raises: :exc:`~exceptions.ValueError` when the compression method
+                 isn't supported.
+        """
+        self.validate_options(compression)
+        super(CompressedStorage, self).__init__(backend)
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.reader = DecompressingReader(self, history_size=MAX_LINE_LENGTH)
+        self.sizer = DecompressingReader(self)
+
+    @staticmethod
+    def validate_options(compression):
+        """
+        Validate the options of a :class:`CompressedStorage` object.
+
+        :param compression: Refer to :class:`CompressedStorage`.
+        :raises: :exc:`~exceptions.ValueError` when the compression method
+                 isn't supported (or isn't available).
+        """
+        if compression not in SUPPORTED_COMPRESSION:
+            msg = "Unsupported compression method! (%r is not one of %s)"
+            raise ValueError(msg % (compression, ", ".join(map(repr, SUPPORTED_COMPRESSION))))
+        if compression == 'lzma' and lzma is None:
+            raise ValueError("The lzma module isn't available! (it requires Python 3.3+)")
+
+    def create_writer(self):
+        """
+        Create the object that compresses and stores output.
+
+        :returns: A :class:`CompressedWriter` object.
+        """
+        return CompressedWriter(self.output_fd, self.compression)
+
+    def get_size(self):
+        """
+        Get the number of bytes of output that can be read.
+
+        :returns: The size of the decompressed output in bytes (an integer).
+
+        Only the part of the compressed stream that was stored since the
+        previous call is decompressed (and the decompressed output is
+        discarded).
+        """
+        with self.lock:
+            while self.sizer.read_chunk(FOLLOW_CHUNK_SIZE):
+                pass
+            return self.sizer.offset
+
+    def read(self, offset, size=None):
+        """
+        Read captured output starting at the given byte offset.
+
+        :param offset: The byte offset in the decompressed output (an integer).
+        :param size: The maximum number of bytes to read (an integer or
+                     :data:`None` to read all available output).
+        :returns: A tuple of two values, refer to :func:`FileStorage.read()`.
+        """
+        with self.lock:
+            reader = self.reader
+            if offset < reader.offset - len(reader.history):
+                # Decompress the stream from the start.
+                reader = self.reader = DecompressingReader(self, history_size=MAX_LINE_LENGTH)
+            chunks = []
+            if offset < reader.offset:
+                chunks.append(reader.history[len(reader.history) - (reader.offset - offset):])
+            while reader.offset < offset:
+                if not reader.read_chunk(min(offset - reader.offset, FOLLOW_CHUNK_SIZE)):
+                    return offset, b''
+            length = sum(map(len, chunks))
+            while size is None or length < size:
+                chunk = reader.read_chunk(FOLLOW_CHUNK_SIZE if size is None else size - length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length += len(chunk)
+            output = b''.join(chunks)
+            return offset, output if size is None else output[:size]
+
+    def get_buffer(self):
+        """
+        Get the decompressed output.
+
+        :returns: A binary string.
+        """
+        return DecompressingReader(self).readall()
+
+    def get_handle(self, compressed=False):
+        """
+        Get the captured output as a file object.
+
+        :param compressed: :data:`True` to get the compressed stream,
+                           :data:`False` to get the decompressed output.
+        :returns: A file object positioned at the start of the output.
+        """
+        if compressed:
+            if os.fstat(self.output_handle.fileno()).st_size == 0:
+                # No output was written so the compressor was never created.
+                return io.BytesIO(create_compressor(self.compression).flush())
+            self.output_handle.seek(0)
+            return self.output_handle
+        return io.BufferedReader(DecompressingReader(self))
+
+
+class DecompressingReader(io.RawIOBase):
+
+    """
+    Read-only file object that decompresses the output in a :class:`CompressedStorage`.
+
+    The compressed stream is read from the temporary file and decompressed a
+    chunk at a time, so only the decompressed output that wasn't read yet
+    (and optionally the most recently read output) is kept in memory.
+    Decompression is limited to the requested number of bytes (the input
+    that wasn't consumed is decompressed by the next read), so very
+    compressible output doesn't expand into a large buffer. Output that's
+    stored after the reader reached the end of the compressed stream can
+    still be read.
+    """
+
+    def __init__(self, storage, history_size=0):
+        """
+        Initialize a :class:`DecompressingReader` object.
+
+        :param storage: The :class:`CompressedStorage` object to read from.
+        :param history_size: The number of most recently read bytes to keep in
+                             :attr:`history` (an integer, defaults to zero).
+        """
+        super(DecompressingReader, self).__init__()
+        self.storage = storage
+        self.history_size = history_size
+        self.decompressor = create_decompressor(storage.compression)
+        self.compressed_offset = 0
+        self.needs_input = True
+        self.offset = 0
+        self.pending = b''
+        self.pending_offset = 0
+        self.history = b''
+
+    def readable(self):
+        """Tell :mod:`io` that the reader is readable."""
+        return True
+
+    def readinto(self, buffer):
+        """
+        Decompress output into a buffer.
+
+        :param buffer: A writable buffer.
+        :returns: The number of bytes that were read (an integer).
+        """
+        output = self.read_chunk(len(buffer))
+        buffer[:len(output)] = output
+        return len(output)
+
+    def readall(self):
+        """
+        Decompress all of the remaining output.
+
+        :returns: A binary string.
+        """
+        return b''.join(iter(lambda: self.read_chunk(FOLLOW_CHUNK_SIZE), b''))
+
+    def read_chunk(self, size):
+        """
+        Decompress the next chunk of output.
+
+        :param size: The maximum number of bytes to return (an integer).
+        :returns: A binary string (empty when all of the output that's
+                  available was read).
+        """
+        if size <= 0:
+            return b''
+        while self.pending_offset >= len(self.pending):
+            if self.needs_input:
+                data = pread(self.storage.output_handle.fileno(), FOLLOW_CHUNK_SIZE, self.compressed_offset)
+                if not data:
+                    return b''
+                self.compressed_offset += len(data)
+            else:
+                # The lzma decompressor keeps the unconsumed input itself.
+                data = getattr(self.decompressor, 'unconsumed_tail', b'')
+            self.pending = self.decompressor.decompress(data, size)
+            self.pending_offset = 0
+            if hasattr(self.decompressor, 'needs_input'):
+                self.needs_input = self.decompressor.needs_input or self.decompressor.eof
+            else:
+                # The zlib decompressor may hold output when the limit was reached.
+                self.needs_input = not self.decompressor.unconsumed_tail and len(self.pending) < size
+        output = self.pending[self.pending_offset:self.pending_offset + size]
+        self.pending_offset += len(output)
+        self.offset += len(output)
+        if self.history_size:
+            self.history = (self.history + output)[-self.history_size:]
+        return output
+
+
+class SpooledStorage(FileStorage):
+
+    """
+    Storage that keeps captured output in memory until it grows too large.
+
+    Output is stored in an anonymous memory backed file (see
+    :func:`os.memfd_create()`) until more than `spool_size` bytes have been
+    captured. At that point the :class:`SpoolingWriter` spills the output to
+    a temporary file on disk and continues storing output there, so small
+    captures never touch the filesystem.
+
+    Because the writer may run in a child process, the temporary file is
+    created at a pathname that's chosen up front (but not created until
+    needed). The memory backed file starts with a header that holds a flag
+    which the writer sets once the output has been spilled. The storage
+    maps the header into memory, so checking the flag doesn't cost a system
+    call. Once the flag is set the storage opens and unlinks the temporary
+    file. The pathname is also unlinked by :func:`finish()` when no spill
+    was noticed (in case the writer died during the spill).
+    """
+
+    header = struct.Struct('<B')
+
+    def __init__(self, spool_size=DEFAULT_SPOOL_SIZE):
+        """
+        Initialize a :class:`SpooledStorage` object.
+
+        :param spool_size: The number of bytes to keep in memory before
+                           spilling to disk (an integer, defaults to
+                           :data:`DEFAULT_SPOOL_SIZE`).
+        """
+        super(SpooledStorage, self).__init__(backend='memfd')
+        # The writer shares the file offset, so output is written after the header.
+        write_all(self.output_fd, self.header.pack(0))
+        self.mapped_header = mmap.mmap(self.output_handle.fileno(), self.header.size, access=mmap.ACCESS_READ)
+        token = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self.spill_path = os.path.join(tempfile.gettempdir(), 'capturer-%s.spill' % token)
+        self.spilled = False
+        self.spool_size = spool_size
+
+    @property
+    def data_offset(self):
+        """The offset of the output in the file that currently holds it (an integer)."""
+        return 0 if self.spilled else self.header.size
+
+    def create_writer(self):
+        """
+        Create the object that stores output and spills it to disk.
+
+        :returns: A :class:`SpoolingWriter` object.
+        """
+        return SpoolingWriter(self.output_fd, self.spill_path, self.spool_size)
+
+    def check_spilled(self):
+        """Switch to the temporary file on disk once the writer has spilled the output."""
+        if not self.spilled and self.mapped_header[0]:
+            handle = open(self.spill_path, 'rb')
+            os.unlink(self.spill_path)
+            self.mapped_header.close()
+            self.output_handle.close()
+            self.output_handle = handle
+            self.mapped_output = None
+            self.spilled = True
+
+    def finish(self):
+        """Pick up output that was spilled to disk and make sure the temporary file is unlinked."""
+        self.check_spilled()
+        if not self.spilled:
+            try:
+                os.unlink(self.spill_path)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def get_size(self):
+        """
+        Get the number of bytes of output that have been stored.
+
+        :returns: The size of the captured output in bytes (an integer).
+        """
+        self.check_spilled()
+        return max(0, super(SpooledStorage, self).get_size() - self.data_offset)
+
+    def read(self, offset, size=None):
+        """
+        Read captured output starting at the given byte offset.
+
+        Refer to :func:`FileStorage.read()` for details.
+        """
+        available = self.get_size() - offset
+        size = available if size is None else min(size, available)
+        if size <= 0:
+            return offset, b''
+        return offset, pread(self.output_handle.fileno(), size, self.data_offset + offset)
+
+    def get_buffer(self):
+        """
+        Get the captured output.
+
+        :returns: A read-only :class:`mmap.mmap` object once the output has
+                  been spilled to disk, a binary string before that (the
+                  memory backed file is truncated by the spill, so memory
+                  mapping it isn't safe).
+        """
+        if self.get_size() > 0 and not self.spilled:
+            offset, output = self.read(0)
+            return output
+        return super(SpooledStorage, self).get_buffer()
+
+    def get_handle(self):
+        """
+        Get the captured output as a file object.
+
+        :returns: A file object positioned at the start of the output.
+        """
+        self.check_spilled()
+        self.output_handle.seek(self.data_offset)
+        return self.output_handle
+
+
+class MemoryStorage(FileStorage):
+
+    """
+    Storage for captured output in memory.
+
+    Output is kept in a :class:`bytearray` that's shared with the
+    :class:`MemoryWriter`, so the output must be stored by the current
+    process (by a :class:`PythonTerminal` or a relay thread).
+    """
+
+    def __init__(self):
+        """Initialize a :class:`MemoryStorage` object."""
+        self.buffer = bytearray()
+        self.mapped_output = b''
+
+    def create_writer(self):
+        """
+        Create the object that stores output in memory.
+
+        :returns: A :class:`MemoryWriter` object.
+        """
+        return MemoryWriter(self.buffer)
+
+    def get_size(self):
+        """
+        Get the number of bytes of output that have been stored.
+
+        :returns: The size of the captured output in bytes (an integer).
+        """
+        return len(self.buffer)
+
+    def read(self, offset, size=None):
+        """
+        Read captured output starting at the given byte offset.
+
+        Refer to :func:`FileStorage.read()` for details.
+        """
+        end = len(self.buffer) if size is None else offset + size
+        return offset, bytes(self.buffer[offset:end])
+
+    def get_buffer(self):
+        """
+        Get the captured output.
+
+        :returns: A binary string (the buffer itself isn't exposed because it
+                  can't be resized while it's exported).
+        """
+        if len(self.mapped_output) != len(self.buffer):
+            self.mapped_output = bytes(self.buffer)
+        return self.mapped_output
+
+    def get_handle(self):
+        """
+        Get the captured output as a file object.
+
+        :returns: A :class:`io.BytesIO` object positioned at the start of the output.
+        """
+        return io.BytesIO(self.get_buffer())
+
+
+class ChunkIndex(object):
+
+    """
+    Timestamped index of the chunks of output captured by a pseudo terminal.
+
+    The relay worker records an entry for each chunk of output that it stores
+    (see :class:`ChunkRecorder`). Entries are packed using :attr:`entry`
+    (a timestamp, the byte offset of the chunk in the captured output and the
+    number of the stream that was captured) and stored in an (unlinked)
+    temporary file, because the relay worker may be a child process.
+
+    Timestamps are values of :func:`time.monotonic()` (the same clock in
+    all processes) taken when the chunk was stored. Entries are parsed into
+    :class:`array.array` objects as they're needed, so looking up the
+    timestamp of an offset (or the other way around) takes logarithmic time.
+
+    When stdout and stderr are captured separately their indexes share a
+    single append-only log (see :func:`share()`). Entries are appended to the
+    log as soon as a chunk has been stored (instead of being buffered) so the
+    position of an entry in the log is a sequence number that's shared
+    between the relay workers of both streams, which is what
+    :func:`CaptureOutput.get_combined_chunks()` uses to interleave the streams.
+    """
+
+    entry = struct.Struct('<dQB')
+    """The binary format of the entries in the index (a :class:`struct.Struct` object)."""
+
+    offset_typecode = 'Q' if 'Q' in getattr(array, 'typecodes', '') else 'L'
+    """The :mod:`array` type code of the byte offsets (unsigned 64 bit integers on Python 3.3+)."""
+
+    def __init__(self, stream=0, backend='file', shared=False, log=None):
+        """
+        Initialize a :class:`ChunkIndex` object.
+
+        :param stream: The number of the stream whose output is indexed
+                       (:data:`STDOUT_FD`, :data:`STDERR_FD` or zero when
+                       both streams are captured together).
+        :param backend: Refer to :func:`create_temporary_file()`.
+        :param shared: :data:`True` if the index is (going to be) shared with
+                       the index of another stream (see :func:`share()`),
+                       :data:`False` otherwise.
+        :param log: The :class:`ChunkIndex` whose log should be shared (used
+                    by :func:`share()`, implies `shared`).
+        """
+        self.stream = stream
+        self.shared = shared or log is not None
+        if log is not None:
+            # Our own file descriptor shares the file offset and flags.
+            self.output_fd, self.output_handle = os.dup(log.output_fd), log.output_handle
+        else:
+            self.output_fd, self.output_handle = create_temporary_file(backend)
+            if self.shared:
+                # Entries of concurrent relay workers are appended atomically.
+                flags = fcntl.fcntl(self.output_fd, fcntl.F_GETFL)
+                fcntl.fcntl(self.output_fd, fcntl.F_SETFL, flags | os.O_APPEND)
+        self.lock = threading.Lock()
+        self.offsets = array.array(self.offset_typecode)
+        self.parsed = 0
+        self.sequence_numbers = array.array(self.offset_typecode)
+        self.timestamps = array.array('d')
+
+    def share(self, stream):
+        """
+        Create the index of another stream that shares the log of this index.
+
+        :param stream: Refer to :class:`ChunkIndex`.
+        :returns: A :class:`ChunkIndex` object.
+        """
+        return ChunkIndex(stream, log=self)
+
+    def create_recorder(self):
+        """
+        Create the object that records index entries in the relay worker.
+
+        :returns: A :class:`ChunkRecorder` object.
+        """
+        return ChunkRecorder(self.output_fd, self.stream, buffered=not self.shared)
+
+    def update(self):
+        """Parse the index entries that were recorded since the previous update."""
+        with self.lock:
+            fd = self.output_handle.fileno()
+            available = os.fstat(fd).st_size - self.parsed
+            # Ignore an entry that's still being written.
+            available -= available % self.entry.size
+            if available > 0:
+                data = pread(fd, available, self.parsed)
+                for offset in range(0, available, self.entry.size):
+                    timestamp, chunk_offset, stream = self.entry.unpack_from(data, offset)
+                    # Skip the entries of the other stream in a shared log.
+                    if stream == self.stream:
+                        self.sequence_numbers.append((self.parsed + offset) // self.entry.size)
+                        self.timestamps.append(timestamp)
+                        self.offsets.append(chunk_offset)
+                self.parsed += available
+
+    def get_ranges(self, size):
+        """
+        Get the byte ranges of the recorded chunks of output.
+
+        :param size: The size of the captured output in bytes (an integer).
+        :returns: A list of tuples with four values each: The sequence number
+                  of a chunk (its position in the log), the timestamp of the
+                  chunk, the byte offset where the chunk starts and the byte
+                  offset where it ends (the start of the next chunk or
+                  `size`).
+        """
+        self.update()
+        ends = list(self.offsets[1:]) + [size]
+        return list(zip(self.sequence_numbers, self.timestamps, self.offsets, ends))
+
+    def get_timestamp(self, offset):
+        """
+        Find out when the output at the given offset was captured.
+
+        :param offset: A byte offset in the captured output (an integer).
+        :returns: The timestamp of the chunk that contains the offset (a
+                  number) or :data:`None` when no chunks were recorded yet.
+        """
+        self.update()
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        if self.timestamps:
+            return self.timestamps[max(0, index)]
+
+    def find_offset(self, timestamp, inclusive=True):
+        """
+        Find the first chunk of output captured at (or after) the given time.
+
+        :param timestamp: A value of :func:`time.monotonic()` (a number).
+        :param inclusive: :data:`True` to include chunks captured at exactly
+                          the given time, :data:`False` to exclude them.
+        :returns: The byte offset of the chunk (an integer) or :data:`None`
+                  when no output was captured after the given time.
+        """
+        self.update()
+        search = bisect.bisect_left if inclusive else bisect.bisect_right
+        index = search(self.timestamps, timestamp)
+        if index < len(self.offsets):
+            return self.offsets[index]
+
+
+class ChunkRecorder(object):
+
+    """
+    Records the entries of a :class:`ChunkIndex` in the relay worker.
+
+    Entries are buffered and written at least every :data:`FLUSH_INTERVAL`
+    seconds (and whenever the pseudo terminal is idle), so recording an entry
+    doesn't cost a system call per chunk of output. Entries of a shared log
+    aren't buffered, because the order of the entries in the log must match
+    the order in which the chunks were stored.
+    """
+
+    def __init__(self, fd, stream, buffered=True):
+        """
+        Initialize a :class:`ChunkRecorder` object.
+
+        :param fd: The writable file descriptor of the index (an integer).
+        :param stream: Refer to :class:`ChunkIndex`.
+        :param buffered: :data:`False` to write each entry right away,
+                         :data:`True` to buffer entries (the default).
+        """
+        self.buffered = buffered
+        self.fd = fd
+        self.stream = stream
+        self.offset = 0
+        self.pending = bytearray()
+        self.flushed_at = 0
+
+    def __getstate__(self):
+        """Prepare the recorder to be pickled (see :func:`reduce_fds()`)."""
+        return reduce_fds(dict(self.__dict__), ['fd'])
+
+    def __setstate__(self, state):
+        """Restore the recorder after it was unpickled (see :func:`rebuild_fds()`)."""
+        self.__dict__.update(rebuild_fds(state, ['fd']))
+
+    @property
+    def needs_flush(self):
+        """:data:`True` when entries are buffered, :data:`False` otherwise."""
+        return bool(self.pending)
+
+    def record(self, size):
+        """
+        Record that a chunk of output was stored.
+
+        :param size: The size of the chunk in bytes (an integer).
+        """
+        now = monotonic()
+        self.pending += ChunkIndex.entry.pack(now, self.offset, self.stream)
+        self.offset += size
+        if not self.buffered or now - self.flushed_at >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered entries to the index."""
+        if self.pending:
+            entries, self.pending = self.pending, bytearray()
+            write_all(self.fd, entries)
+        self.flushed_at = monotonic()
+
+    def close(self):
+        """Write the buffered entries and close the file descriptor."""
+        self.flush()
+        os.close(self.fd)
+
+
+class FileWriter(object):
+
+    """
+    Stores captured output in a :class:`FileStorage` object.
+
+    Writers are created by the parent process but used by the relay worker
+    (which may be a child process), so they're simple picklable objects that
+    wrap a file descriptor.
+    """
+
+    supports_zero_copy = True
+    """:data:`True` if :class:`ZeroCopyRelay` can write to :attr:`fd` directly."""
+
+    def __init__(self, fd):
+        """
+        Initialize a :class:`FileWriter` object.
+
+        :param fd: The writable file descriptor of the temporary file (an integer).
+        """
+        self.fd = fd
+        self.notify_fd = None
+        self.processors = None
+        self.recorder = None
+        self.unnotified = False
+
+    def __getstate__(self):
+        """Prepare the writer to be pickled (see :func:`reduce_fds()`)."""
+        return reduce_fds(dict(self.__dict__), ['fd', 'notify_fd'])
+
+    def __setstate__(self, state):
+        """Restore the writer after it was unpickled (see :func:`rebuild_fds()`)."""
+        self.__dict__.update(rebuild_fds(state, ['fd', 'notify_fd']))
+
+    @property
+    def needs_flush(self):
+        """:data:`True` when the writer buffers output (or index entries) that :func:`flush()` would store."""
+        return self.recorder is not None and self.recorder.needs_flush
+
+    @property
+    def needs_notify(self):
+        """:data:`True` when output that can be read was stored since the previous call to :func:`notify()`."""
+        return self.unnotified and self.notify_fd is not None
+
+    def write(self, output):
+        """
+        Process captured output, store it and record it in the index.
+
+        :param output: The output to store (a binary string).
+
+        When :attr:`processors` isn't :data:`None` (it's a
+        :class:`ProcessorChain` object) the processed output is stored.
+        """
+        if self.processors is not None:
+            output = self.processors.process(output)
+            if not output:
+                return
+        self.store(output)
+        self.record(len(output))
+
+    def store(self, output):
+        """
+        Store captured output.
+
+        :param output: The output to store (a binary string).
+        """
+        write_all(self.fd, output)
+
+    def record(self, size):
+        """
+        Record a chunk of output that was stored in the index (if any).
+
+        :param size: The size of the chunk in bytes (an integer).
+
+        This is called by :func:`write()` and by relay workers that store
+        output without calling :func:`write()` (see :class:`ZeroCopyRelay`).
+        """
+        if self.recorder is not None:
+            self.recorder.record(size)
+        self.unnotified = True
+
+    def notify(self):
+        """
+        Wake up the threads waiting for captured output (see :class:`OutputNotifier`).
+
+        Called by the relay worker when the pseudo terminal is idle while
+        :attr:`needs_notify` is :data:`True`, so a burst of output results in
+        a single notification.
+        """
+        self.unnotified = False
+        try:
+            os.write(self.notify_fd, b'\n')
+        except OSError as e:
+            # When the pipe is full the waiting threads wake up anyway.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EPIPE):
+                raise
+
+    def flush(self):
+        """
+        Store output (and index entries) buffered by the writer so that it can be read.
+
+        Called by the relay worker when the pseudo terminal is idle while
+        :attr:`needs_flush` is :data:`True`.
+        """
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def finish(self):
+        """
+        Store any output (and index entries) that's still buffered by the writer.
+
+        Called by the relay worker once it stops storing output.
+        """
+        self.flush_processors()
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def flush_processors(self):
+        """Store the output that's still buffered by the :attr:`processors` (if any)."""
+        if self.processors is not None:
+            output = self.processors.process(b'', final=True)
+            if output:
+                self.store(output)
+                self.record(len(output))
+
+    def close(self):
+        """Close the file descriptor(s) (once output is no longer being stored)."""
+        self.finish()
+        os.close(self.fd)
+        self.close_auxiliary_fds()
+
+    def close_auxiliary_fds(self):
+        """Close the file descriptors of the index and :func:`notify()` (if any)."""
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.notify_fd is not None:
+            os.close(self.notify_fd)
+            self.notify_fd = None
+
+
+class MemoryWriter(FileWriter):
+
+    """Stores captured output in a :class:`MemoryStorage` object."""
+
+    supports_zero_copy = False
+
+    def __init__(self, buffer):
+        """
+        Initialize a :class:`MemoryWriter` object.
+
+        :param buffer: The :class:`bytearray` of the storage.
+        """
+        super(MemoryWriter, self).__init__(None)
+        self.buffer = buffer
+
+    def store(self, output):
+        """
+        Store captured output.
+
+        :param output: The output to store (a binary string).
+        """
+        self.buffer += output
+
+    def close(self):
+        """Close the file descriptors of the index and :func:`notify()` (once output is no longer being stored)."""
+        self.finish()
+        self.close_auxiliary_fds()
+
+
+class RingBufferWriter(FileWriter):
+
+    """
+    Stores captured output in a :class:`RingBufferStorage` object.
+
+    The header is updated after the output has been written, so readers never
+    see output that hasn't been written yet.
+    """
+
+    supports_zero_copy = False
+
+    def __init__(self, fd, head_size, tail_size):
+        """
+        Initialize a :class:`RingBufferWriter` object.
+
+        :param fd: The writable file descriptor of the temporary file (an integer).
+        :param head_size: The size of the head region in bytes (an integer).
+        :param tail_size: The size of the ring buffer in bytes (a positive integer).
+        """
+        super(RingBufferWriter, self).__init__(fd)
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.position = 0
+
+    def store(self, output):
+        """
+        Store captured output.
+
+        :param output: The output to store (a binary string).
+        """
+        header_size = RingBufferStorage.header.size
+        output = memoryview(output)
+        if self.position < self.head_size:
+            size = min(len(output), self.head_size - self.position)
+            pwrite(self.fd, output[:size], header_size + self.position)
+            self.position += size
+            output = output[size:]
+        if len(output) > self.tail_size:
+            # Output that would be overwritten right away isn't written at all.
+            self.position += len(output) - self.tail_size
+            output = output[-self.tail_size:]
+        while output:
+            ring_offset = (self.position - self.head_size) % self.tail_size
+            size = min(len(output), self.tail_size - ring_offset)
+            pwrite(self.fd, output[:size], header_size + self.head_size + ring_offset)
+            self.position += size
+            output = output[size:]
+        pwrite(self.fd, RingBufferStorage.header.pack(self.position), 0)
+
+
+class CompressedWriter(FileWriter):
+
+    """
+    Stores captured output in a :class:`CompressedStorage` object.
+
+    The compressor is created when output is first written, because it can't
+    be pickled (and it only makes sense in the relay worker that stores the
+    output). The ``'zlib'`` compressor is flushed at least every
+    :data:`FLUSH_INTERVAL` seconds while output is being written
+    and whenever the pseudo terminal is idle.
+    """
+
+    supports_zero_copy = False
+
+    def __init__(self, fd, compression):
+        """
+        Initialize a :class:`CompressedWriter` object.
+
+        :param fd: The writable file descriptor of the temporary file (an integer).
+        :param compression: The compression method (a string).
+        """
+        super(CompressedWriter, self).__init__(fd)
+        self.compression = compression
+        self.compressor = None
+        self.flushed_at = 0
+        self.unflushed = False
+
+    @property
+    def needs_flush(self):
+        """:data:`True` when the compressor (or the index) holds output that :func:`flush()` would store."""
+        return self.unflushed or super(CompressedWriter, self).needs_flush
+
+    @property
+    def needs_notify(self):
+        """:data:`True` when output that can be read was stored since the previous call to :func:`notify()`."""
+        return not self.unflushed and super(CompressedWriter, self).needs_notify
+
+    def store(self, output):
+        """
+        Compress and store captured output.
+
+        :param output: The output to store (a binary string).
+        """
+        if self.compressor is None:
+            self.compressor = create_compressor(self.compression)
+        data = self.compressor.compress(output)
+        if data:
+            write_all(self.fd, data)
+        # The lzma compressor can only be flushed by ending the stream.
+        self.unflushed = self.compression == 'zlib'
+        if self.unflushed and monotonic() - self.flushed_at >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Flush the compressor so that all output written so far can be decompressed."""
+        if self.unflushed:
+            write_all(self.fd, self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.unflushed = False
+        self.flushed_at = monotonic()
+        super(CompressedWriter, self).flush()
+
+    def finish(self):
+        """End the compressed stream (only if this writer stored output)."""
+        self.flush_processors()
+        if self.compressor is not None:
+            write_all(self.fd, self.compressor.flush())
+            self.compressor = None
+            self.unflushed = False
+        super(CompressedWriter, self).finish()
+
+
+class SpoolingWriter(FileWriter):
+
+    """
+    Stores captured output in a :class:`SpooledStorage` object.
+
+    The spill replaces the file descriptor of the memory backed file with the
+    file descriptor of the temporary file on disk (using :func:`os.dup2()`),
+    so :attr:`fd` never changes. The storage is told about the spill by
+    setting the flag in the header of the memory backed file (see
+    :class:`SpooledStorage`).
+    """
+
+    supports_zero_copy = False
+
+    def __init__(self, fd, spill_path, spool_size):
+        """
+        Initialize a :class:`SpoolingWriter` object.
+
+        :param fd: The writable file descriptor of the memory backed file (an integer).
+        :param spill_path: The pathname of the temporary file on disk (a string).
+        :param spool_size: The number of bytes to keep in memory (an integer).
+        """
+        super(SpoolingWriter, self).__init__(fd)
+        self.spill_path = spill_path
+        self.spool_size = spool_size
+        self.size = 0
+
+    def store(self, output):
+        """
+        Store captured output (spilling it to disk when needed).
+
+        :param output: The output to store (a binary string).
+        """
+        write_all(self.fd, output)
+        if self.size <= self.spool_size < self.size + len(output):
+            self.spill()
+        self.size += len(output)
+
+    def spill(self):
+        """Copy the output stored in memory to a temporary file on disk and continue storing output there."""
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_CLOEXEC', 0)
+        disk_fd = os.open(self.spill_path, flags, 0o600)
+        offset = SpooledStorage.header.size
+        while True:
+            output = pread(self.fd, FOLLOW_CHUNK_SIZE, offset)
+            if not output:
+                break
+            write_all(disk_fd, output)
+            offset += len(output)
+        # Tell the storage about the spill and release the memory.
+        pwrite(self.fd, SpooledStorage.header.pack(1), 0)
+        os.ftruncate(self.fd, SpooledStorage.header.size)
+        os.dup2(disk_fd, self.fd)
+        os.close(disk_fd)
+
+
+class TerminalRelay(MultiProcessHelper):
+
+    """
+    Base class for :class:`PseudoTerminal` and :class:`PooledTerminal`.
+
+    Implements reading output from the master end of a pseudo terminal and
+    storing and relaying that output, which is what the child processes (or
+    threads) started by both classes spend their time on.
+    """
+
+    worker_attributes = MultiProcessHelper.worker_attributes + (
+        'chunk_size', 'master_fd', 'max_chunk_size', 'output_queue', 'queue_token',
+        'reader', 'relay_fd', 'relay_processors', 'stats', 'writer', 'zero_copy',
+    )
+    """The names of the attributes that are used by the relay worker (a tuple of strings)."""
+
+    worker_fds = ('master_fd', 'relay_fd')
+    """The names of the :attr:`worker_attributes` that hold file descriptors (a tuple of strings)."""
+
+    def __init__(self, chunk_size, relay_fd=None, output_queue=None, queue_token=None,
+                 engine=DEFAULT_ENGINE, max_chunk_size=None, zero_copy=False,
+                 start_method=DEFAULT_START_METHOD):
+        """
+        Initialize a :class:`TerminalRelay` object.
+
+        Refer to :class:`PseudoTerminal` for details about the parameters.
+        """
+        # Initialize the superclass.
+        super(TerminalRelay, self).__init__(engine=engine, start_method=start_method)
+        # Store constructor arguments.
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.zero_copy = zero_copy
+        self.relay_fd = relay_fd
+        self.output_queue = output_queue
+        self.queue_token = queue_token
+        # Initialize instance variables.
+        self.master_fd = None
+        self.slave_fd = None
+        self.relay_processors = None
+        self.stats = CaptureStats()
+        self.writer = None
+        if max_chunk_size:
+            self.reader = AdaptiveReader(chunk_size, max_chunk_size)
+        else:
+            self.reader = None
+
+    def close_pseudo_terminal(self):
+        """Close the pseudo terminal's master/slave file descriptors."""
+        for name in ('master_fd', 'slave_fd'):
+            fd = getattr(self, name)
+            if fd is not None:
+                os.close(fd)
+                setattr(self, name, None)
+
+    def read_chunk(self):
+        """
+        Read a chunk of output from the master end of the pseudo terminal.
+
+        :returns: The output that was read (a binary string).
+
+        Used by :func:`store_output()` and :func:`Multiplexer.multiplex_loop()`.
+        """
+        if self.reader is not None:
+            return self.reader.read(self.master_fd)
+        return os.read(self.master_fd, self.chunk_size)
+
+    def create_zero_copy_relay(self):
+        """
+        Create a :class:`ZeroCopyRelay` for use in :func:`store_output()`.
+
+        :returns: A :class:`ZeroCopyRelay` object or :data:`None` when
+                  zero-copy relaying wasn't requested, isn't supported by the
+                  platform or doesn't apply (because output is relayed
+                  through a queue, isn't stored or isn't stored as is).
+        """
+        stored_as_is = self.writer is not None and self.writer.supports_zero_copy and self.writer.processors is None
+        relayed_as_is = self.output_queue is None and self.relay_processors is None
+        if self.zero_copy and stored_as_is and relayed_as_is and ZeroCopyRelay.is_supported():
+            chunk_size = min(max(self.chunk_size, self.max_chunk_size or 0), PIPE_CAPACITY)
+            return ZeroCopyRelay(self.master_fd, self.writer.fd, self.relay_fd, chunk_size)
+
+    def relay_output(self, output, final=False):
+        """
+        Relay output to the real terminal and/or the main process.
+
+        :param output: The output to relay (a binary string).
+        :param final: :data:`True` when the capture is finishing (refer to
+                      :func:`ProcessorChain.process()`).
+
+        When :attr:`relay_processors` isn't :data:`None` (it's a
+        :class:`ProcessorChain` object) the processed output is relayed.
+        """
+        if self.relay_fd is None and self.output_queue is None:
+            return
+        started = monotonic()
+        if self.relay_processors is not None:
+            output = self.relay_processors.process(output, final)
+        if output:
+            # Relay the output to the real terminal?
+            if self.relay_fd is not None:
+                write_all(self.relay_fd, output)
+            # Relay the output to the master process?
+            if self.output_queue is not None:
+                self.output_queue.put((self.queue_token, output, started))
+        self.stats.relay_write_seconds += monotonic() - started
+
+    def store_output(self, selector):
+        """
+        Store and relay output until a request arrives on the worker connection.
+
+        :param selector: A :class:`FileDescriptorSelector` that watches the
+                         master end of the pseudo terminal and the
+                         :attr:`worker_connection`.
+        :returns: The number of bytes of output that were stored (an integer).
+
+        Output is given priority over requests, so once this method returns
+        all output that was written before the request was sent has been
+        stored. Output is discarded while :attr:`writer` is :data:`None`.
+        """
+        zero_copy = self.create_zero_copy_relay()
+        stored = 0
+        try:
+            while True:
+                # Wait for output or a request, giving priority to output.
+                # Buffered output is flushed once the pseudo terminal is idle
+                # and threads waiting for output are woken up as soon as it
+                # becomes idle.
+                pending = self.writer is not None and self.writer.needs_flush
+                notify = self.writer is not None and self.writer.needs_notify
+                readable = selector.wait(0) if notify else []
+                if not readable:
+                    if notify:
+                        self.writer.notify()
+                    readable = selector.wait(FLUSH_INTERVAL if pending else None)
+                if self.master_fd not in readable:
+                    if readable:
+                        return stored
+                    if pending:
+                        self.writer.flush()
+                    continue
+                # Move output from the master end of the pseudo terminal
+                # to its destinations without copying it into Python?
+                if zero_copy is not None and zero_copy.enabled:
+                    num_bytes = zero_copy.transfer()
+                    if num_bytes is not None:
+                        stored += num_bytes
+                        self.stats.read_calls += 1
+                        self.stats.bytes_captured += num_bytes
+                        if num_bytes:
+                            self.writer.record(num_bytes)
+                        else:
+                            time.sleep(0)
+                        continue
+                # Read from the master end of the pseudo terminal.
+                output = self.read_chunk()
+                self.stats.read_calls += 1
+                if output:
+                    # Store the output in the temporary file.
+                    if self.writer is not None:
+                        self.writer.write(output)
+                        stored += len(output)
+                        self.stats.bytes_captured += len(output)
+                    self.relay_output(output)
+                else:
+                    # Relinquish our time slice, or in other words: try to be
+                    # friendly to other processes when os.read() calls don't
+                    # block. Just for the record, all of my experiments have
+                    # shown that os.read() on the master file descriptor
+                    # returned by pty.openpty() does in fact block.
+                    time.sleep(0)
+        finally:
+            if zero_copy is not None:
+                zero_copy.close()
+
+
+class PseudoTerminal(TerminalRelay):
+
+    """
+    Helper for :class:`CaptureOutput`.
+
+    Manages capturing of output and exposing the captured output.
+    """
+
+    def __init__(self, encoding, termination_delay, chunk_size, relay_fd, output_queue, queue_token,
+                 engine=DEFAULT_ENGINE, max_chunk_size=None, zero_copy=False, pool=None,
+                 storage=None, index=None, transport='pty', pipe_size=DEFAULT_PIPE_SIZE,
+                 store_processors=None, relay_processors=None, start_method=DEFAULT_START_METHOD):
+        """
+        Initialize a :class:`PseudoTerminal` object.
+
+        :param encoding: The name of the character encoding used to decode the
+                         captured output (a string, defaults to
+                         :data:`DEFAULT_TEXT_ENCODING`).
+        :param termination_delay: The number of seconds to wait before
+                                  terminating the output relay process (a
+                                  floating point number, defaults to
+                                  :data:`TERMINATION_DELAY`).
+        :param chunk_size: The maximum number of bytes to read from the
+                           captured stream(s) on each call to :func:`os.read()`
+                           (an integer). When `max_chunk_size` is given this
+                           is the minimum number of bytes to read instead.
+        :param relay_fd: The number of the file descriptor where captured
+                         output should be relayed to (an integer or
+                         :data:`None` if ``output_queue`` and ``queue_token``
+                         are given).
+        :param output_queue: The multiprocessing queue where captured output
+                             chunks should be written to (a
+                             :class:`multiprocessing.Queue` object or
+                             :data:`None` if ``relay_fd`` is given).
+        :param queue_token: A unique identifier added to each output chunk
+                            written to the queue (any value or :data:`None` if
+                            ``relay_fd`` is given).
+        :param engine: The name of the relay engine to use (one of the strings
+                       in :data:`SUPPORTED_ENGINES`, defaults to
+                       :data:`DEFAULT_ENGINE`).
+        :param max_chunk_size: The maximum number of bytes to read from the
+                               captured stream(s) on each call to
+                               :func:`os.read()` (an integer or :data:`None`
+                               to always read `chunk_size` bytes).
+        :param zero_copy: :data:`True` to store and relay output using
+                          :class:`ZeroCopyRelay` when possible, :data:`False`
+                          (the default) to always copy output through Python.
+        :param pool: A :class:`CapturePool` object that provides the pseudo
+                     terminal and relay worker (:data:`None` by default). The
+                     `chunk_size`, `engine`, `max_chunk_size`, `zero_copy`
+                     and `start_method` options of the pool apply instead and `output_queue`
+                     isn't supported.
+        :param storage: The storage for the captured output (a
+                        :class:`FileStorage` object or :data:`None` to create
+                        a new :class:`FileStorage` object).
+        :param index: The timestamped index of the captured output (a
+                      :class:`ChunkIndex` object or :data:`None`).
+        :param transport: One of the strings in :data:`SUPPORTED_TRANSPORTS`
+                          (defaults to ``'pty'``). Not supported in
+                          combination with `pool`.
+        :param pipe_size: The requested capacity in bytes of the pipe used by
+                          the ``'pipe'`` transport (an integer).
+        :param store_processors: A list of processors (see
+                                 :class:`ProcessorChain`) that transform the
+                                 captured output before it's stored (or
+                                 :data:`None`).
+        :param relay_processors: A list of processors that transform the
+                                 captured output before it's relayed (or
+                                 :data:`None`).
+        :param start_method: The :mod:`multiprocessing` start method used to
+                             start the relay process (a string, defaults to
+                             :data:`DEFAULT_START_METHOD`).
+        """
+        # Initialize the superclass.
+        super(PseudoTerminal, self).__init__(
+            chunk_size, relay_fd=relay_fd, output_queue=output_queue,
+            queue_token=queue_token, engine=engine,
+            max_chunk_size=max_chunk_size, zero_copy=zero_copy,
+            start_method=start_method,
+        )
+        # Store constructor arguments.
+        self.encoding = encoding
+        self.index = index
+        self.termination_delay = termination_delay
+        self.pipe_size = pipe_size
+        self.pool = pool
+        self.transport = transport
+        # Initialize instance variables.
+        self.drained_offset = None
+        self.notifier = None
+        self.interpreter = None
+        self.interpreter_decoder = None
+        self.interpreter_finished = False
+        self.interpreter_lock = threading.Lock()
+        self.interpreted_offset = 0
+        self.cached_views = {}
+        self.cursor = None
+        self.multiplexer = None
+        self.streams = []
+        self.terminal = None
+        if pool is not None:
+            # Borrow a pseudo terminal and relay worker from the pool.
+            self.terminal = pool.acquire()
+            self.master_fd = self.terminal.master_fd
+            self.slave_fd = self.terminal.slave_fd
+        else:
+            # Allocate a pseudo terminal so we can fake subprocesses into
+            # thinking that they are connected to a real terminal (this will
+            # trigger them to use e.g. ANSI escape sequences).
+            self.open_pseudo_terminal()
+        # Prepare the storage for the output received on the master end of
+        # the pseudo terminal.
+        self.storage = storage if storage is not None else FileStorage()
+        self.writer = self.storage.create_writer()
+        if index is not None:
+            self.writer.recorder = index.create_recorder()
+        if store_processors:
+            self.writer.processors = ProcessorChain(store_processors)
+        if relay_processors:
+            self.relay_processors = ProcessorChain(relay_processors)
+
+    def open_pseudo_terminal(self):
+        """
+        Allocate the pseudo terminal's master/slave file descriptors.
+
+        When the transport is ``'pipe'`` the master end is the readable end
+        of a pipe and the slave end is the writable end (see :func:`open_pipe()`).
+        """
+        if self.transport == 'pipe':
+            self.master_fd, self.slave_fd = open_pipe(self.pipe_size)
+        else:
+            self.master_fd, self.slave_fd = pty.openpty()
+
+    def attach(self, stream):
+        """
+        Attach a stream to the pseudo terminal.
+
+        :param stream: A :class:`Stream` object.
+        """
+        stream.redirect(self.slave_fd)
+        self.streams.append(stream)
+
+    def start_capture(self):
+        """
+        Start the child process(es) responsible for capturing and relaying output.
+
+        When the pseudo terminal was borrowed from a :class:`CapturePool` the
+        relay worker of the pool is asked to start storing output instead.
+        """
+        if not (self.terminal or self).uses_threads:
+            # The relay worker needs the notification pipe up front.
+            self.create_notifier()
+        if self.terminal is not None:
+            self.terminal.attach_storage(self.writer, self.relay_fd, self.relay_processors)
+        else:
+            self.start_child(self.capture_loop)
+
+    def create_notifier(self):
+        """
+        Create the :class:`OutputNotifier` that's used by :func:`wait_for()`.
+
+        :returns: An :class:`OutputNotifier` object.
+
+        When the relay worker is a child process it needs to get the writable
+        end of the notification pipe when it's started, otherwise the
+        notifier is only created once :func:`wait_for()` is called, so that
+        captures whose output is never waited for don't pay for it.
+        """
+        if self.notifier is None:
+            self.notifier = OutputNotifier()
+            writer = self.writer
+            if writer is not None:
+                writer.notify_fd = self.notifier.write_fd
+            else:
+                os.close(self.notifier.write_fd)
+        return self.notifier
+
+    def finish_capture(self):
+        """
+        Stop the process of capturing output and destroy the pseudo terminal.
+
+        When the pseudo terminal is part of a :class:`Multiplexer` the
+        multiplexer is asked to finish the capture instead. When the pseudo
+        terminal was borrowed from a :class:`CapturePool` it's returned to the
+        pool instead of being destroyed.
+        """
+        started = monotonic()
+        terminal = self.terminal
+        if self.multiplexer is not None:
+            self.multiplexer.finish_capture()
+        elif terminal is not None:
+            flush_standard_streams()
+            if self.termination_delay:
+                time.sleep(self.termination_delay)
+            acknowledgement = terminal.detach_storage()
+            if acknowledgement:
+                self.drained_offset = acknowledgement['offset']
+                self.stats.update(acknowledgement['stats'])
+            # The pseudo terminal is owned by the pool.
+            self.terminal = self.master_fd = self.slave_fd = None
+        elif self.processes:
+            flush_standard_streams()
+            if self.termination_delay:
+                time.sleep(self.termination_delay)
+            self.stop_children()
+            if self.acknowledgement:
+                self.drained_offset = self.acknowledgement['offset']
+                self.stats.update(self.acknowledgement['stats'])
+        self.close_writer()
+        self.close_pseudo_terminal()
+        self.restore_streams()
+        if terminal is not None:
+            self.pool.release(terminal)
+        self.stats.finish_capture_seconds += monotonic() - started
+
+    @property
+    def is_capturing(self):
+        """
+        :data:`True` while output may still be stored, :data:`False` otherwise.
+
+        Output is no longer stored once :func:`finish_capture()` has been
+        called (even when it was called implicitly by one of the accessors).
+        """
+        return self.writer is not None
+
+    @property
+    def dropped_bytes(self):
+        """
+        The number of bytes of output that weren't kept (an integer).
+
+        This is always zero unless the output is stored in a
+        :class:`RingBufferStorage`.
+        """
+        return self.storage.dropped_bytes
+
+    @property
+    def decoding_errors(self):
+        """
+        The error handling scheme used to decode captured output (a string).
+
+        This is ``'replace'`` when the storage drops output (because multi
+        byte characters may have been cut in half) and ``'strict'`` otherwise.
+        """
+        return 'replace' if self.storage.is_lossy else 'strict'
+
+    def close_writer(self):
+        """Close the writable file descriptor of the storage (once output is no longer being stored)."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.storage.finish()
+
+    def restore_streams(self):
+        """Restore the stream(s) attached to the pseudo terminal."""
+        for stream in self.streams:
+            stream.restore()
+
+    # The CaptureOutput class contains proxy methods for the get_handle(),
+    # get_buffer(), get_bytes(), get_lines(), get_timestamped_lines(),
+    # get_text(), iter_chunks(), iter_lines(), mark(), create_cursor(),
+    # read_new(), wait_for(), save_to_handle() and save_to_path() methods
+    # defined below (see enable_old_api()). By default Sphinx generates
+    # method signatures of the form f(proxy, *args, **kw) for these proxy
+    # methods, with the result that the online documentation is rather
+    # confusing. As a workaround I've included explicit method signatures in
+    # the first line of each of the docstrings. This works because of the following Sphinx option:
+    # http://www.sphinx-doc.org/en/latest/ext/autodoc.html#confval-autodoc_docstring_signature
+
+    def get_handle(self, partial=PARTIAL_DEFAULT):
+        """get_handle(partial=False)
+        Get the captured output as a Python file object.
+
+        :param partial: If :data:`True` (*not the default*) the partial output
+                        captured so far is returned, otherwise (*so by
+                        default*) the relay process is terminated and output
+                        capturing is disabled before returning the captured
+                        output (the default is intended to protect unsuspecting
+                        users against partial reads).
+        :returns: The captured output as a Python file object. The file
+                  object's current position is reset to zero before this
+                  function returns.
+
+        This method is useful when you're dealing with arbitrary amounts of
+        captured data that you don't want to load into memory just so you can
+        save it to a file again. In fact, in that case you might want to take a
+        look at :func:`save_to_path()` and/or :func:`save_to_handle()` :-).
+
+        .. warning:: Two caveats about the use of this method:
+
+                     1. If partial is :data:`True` (not the default) the output
+                        can end in a partial line, possibly in the middle of an
+                        ANSI escape sequence or a multi byte character.
+
+                     2. If you close this file handle you just lost your last
+                        chance to get at the captured output! (calling this
+                        method again will not give you a new file handle)
+        """
+        if not partial:
+            self.finish_capture()
+        return self.storage.get_handle()
+
+    def get_bytes(self, partial=PARTIAL_DEFAULT, since=None, start_time=None, end_time=None):
+        """get_bytes(partial=False, since=None, start_time=None, end_time=None)
+        Get the captured output as binary data.
+
+        :param partial: Refer to :func:`get_handle()` for details.
+        :param since: The byte offset of a checkpoint returned by :func:`mark()`
+                      to get only the output captured after the checkpoint
+                      (an integer) or :data:`None` (the default) to get all of
+                      the captured output.
+        :param start_time: A value of :func:`time.monotonic()` to get only the
+                           output captured at or after that time (a number).
+        :param end_time: A value of :func:`time.monotonic()` to get only the
+                         output captured at or before that time (a number).
+        :returns: The captured output as a binary string.
+        :raises: :exc:`~exceptions.TypeError` when `start_time` or `end_time`
+                 is given but timestamps weren't recorded.
+
+        The `start_time` and `end_time` arguments are resolved to byte offsets
+        using the :class:`ChunkIndex`, so only the chunks of output captured
+        in the given time range are read. Their precision is limited to
+        chunks of output (a chunk is stored as soon as it's read from the
+        pseudo terminal, usually that's a line or a single write).
+        """
+        if start_time is not None or end_time is not None:
+            if not partial:
+                self.finish_capture()
+            return self.read_range(
+                self.find_offset(start_time) if start_time is not None else since or 0,
+                self.find_offset(end_time, False) if end_time is not None else None,
+            )
+        if since is not None:
+            if not partial:
+                self.finish_capture()
+            return self.read_output(since)
+        return self.get_cached_view('bytes', partial, lambda: self.get_buffer(partial=True)[:])
+
+    def find_offset(self, timestamp, inclusive=True):
+        """
+        Find the byte offset of the first output captured at (or after) the given time.
+
+        :param timestamp: A value of :func:`time.monotonic()` (a number).
+        :param inclusive: Refer to :func:`ChunkIndex.find_offset()`.
+        :returns: A byte offset (an integer). When no output was captured
+                  after the given time this is the size of the captured
+                  output.
+        :raises: :exc:`~exceptions.TypeError` when timestamps weren't recorded.
+        """
+        if self.index is None:
+            raise TypeError("Timestamps weren't recorded! (refer to the timestamps option of CaptureOutput)")
+        offset = self.index.find_offset(timestamp, inclusive)
+        return offset if offset is not None else self.mark()
+
+    def get_buffer(self, partial=PARTIAL_DEFAULT):
+        """get_buffer(partial=False)
+        Get the captured output as a read-only memory map.
+
+        :param partial: Refer to :func:`get_handle()` for details.
+        :returns: A read-only :class:`mmap.mmap` object backed by the
+                  temporary file that holds the captured output (or an empty
+                  binary string when no output was captured). When the
+                  output isn't stored as is (for example in a
+                  :class:`RingBufferStorage`) a binary string is returned.
+
+        Because the memory map is backed by the temporary file, captured
+        output can be sliced and searched (e.g. using :func:`mmap.mmap.find()`
+        or the :mod:`re` module) without loading all of it into memory. Wrap
+        the memory map in a :class:`memoryview` to slice it without copying.
+
+        When partial is :data:`True` the memory map covers the output captured
+        so far; output captured later requires another call to this method.
+        """
+        if not partial:
+            self.finish_capture()
+        return self.storage.get_buffer()
+
+    def get_lines(self, interpreted=True, partial=PARTIAL_DEFAULT, with_timestamps=False):
+        """get_lines(interpreted=True, partial=False, with_timestamps=False)
+        Get the captured output split into lines.
+
+        :param interpreted: If :data:`True` (the default) captured output is
+                            processed like :func:`.clean_terminal_output()`
+                            does (see :func:`get_interpreted_lines()`).
+        :param partial: Refer to :func:`get_handle()` for details.
+        :param with_timestamps: :data:`True` to get a tuple with a timestamp
+                                and a line for each line (see
+                                :func:`get_timestamped_lines()`).
+        :returns: The captured output as a list of Unicode strings (or tuples
+                  when `with_timestamps` is :data:`True`).
+
+        .. warning:: If partial is :data:`True` (not the default) the output
+                     can end in a partial line, possibly in the middle of a
+                     multi byte character (when `interpreted` is
+                     :data:`False` this may cause decoding errors).
+        """
+        if with_timestamps:
+            return self.get_timestamped_lines(interpreted, partial)
+        if interpreted:
+            lines = self.get_cached_view(('lines', True), partial, lambda: self.get_interpreted_lines(partial=True))
+        else:
+            lines = self.get_cached_view(('lines', False), partial, lambda: self.get_text(False, True).splitlines())
+        # Don't let callers modify the cached list.
+        return list(lines)
+
+    def get_timestamped_lines(self, interpreted=True, partial=PARTIAL_DEFAULT):
+        """get_timestamped_lines(interpreted=True, partial=False)
+        Get the captured output split into lines, with the time each line was captured.
+
+        :param interpreted: Refer to :func:`get_lines()`.
+        :param partial: Refer to :func:`get_handle()` for details.
+        :returns: A list of tuples with two values each: A value of
+                  :func:`time.monotonic()` (a number) and a line of output
+                  (a Unicode string).
+        :raises: :exc:`~exceptions.TypeError` when timestamps weren't recorded.
+
+        The timestamp of a line is the time when the chunk of output that
+        contains the start of the line was captured. Each line is interpreted
+        separately, so escape sequences that move the cursor between lines
+        aren't supported here.
+        """
+        if not partial:
+            self.finish_capture()
+        if self.index is None:
+            raise TypeError("Timestamps weren't recorded! (refer to the timestamps option of CaptureOutput)")
+        # Split the raw output into lines, remembering where each line starts.
+        raw_lines = []
+        offset = 0
+        unfinished_offset, unfinished_line = 0, b''
+        while True:
+            read_offset, output = self.storage.read(offset)
+            if not output:
+                break
+            if read_offset != offset:
+                # Output was dropped, so the unfinished line ends here.
+                if unfinished_line:
+                    raw_lines.append((unfinished_offset, unfinished_line))
+                unfinished_line = b''
+            if not unfinished_line:
+                unfinished_offset = read_offset
+            # The unfinished line of the previous read continues here.
+            split_lines = (unfinished_line + output).split(b'\n')
+            for raw_line in split_lines[:-1]:
+                raw_lines.append((unfinished_offset, raw_line))
+                unfinished_offset += len(raw_line) + 1
+            unfinished_line = split_lines[-1]
+            offset = read_offset + len(output)
+        if unfinished_line:
+            raw_lines.append((unfinished_offset, unfinished_line))
+        interpreter = TerminalInterpreter()
+        timestamps = []
+        lines = []
+        for i, (offset, raw_line) in enumerate(raw_lines):
+            text = codecs.decode(raw_line, self.encoding, self.decoding_errors)
+            timestamp = self.index.get_timestamp(offset)
+            if interpreted:
+                timestamps.append(timestamp)
+                interpreter.feed(text + u'\n' if i < len(raw_lines) - 1 else text, final=True)
+            else:
+                lines.extend((timestamp, line) for line in text.splitlines())
+        if interpreted:
+            lines = list(zip(timestamps, interpreter.get_lines()))
+        return lines
+
+    def get_text(self, interpreted=True, partial=PARTIAL_DEFAULT):
+        """get_text(interpreted=True, partial=False)
+        Get the captured output as a single string.
+
+        :param interpreted: If :data:`True` (the default) captured output is
+                            processed like :func:`.clean_terminal_output()`
+                            does (see :func:`get_interpreted_lines()`).
+        :param partial: Refer to :func:`get_handle()` for details.
+        :returns: The captured output as a Unicode string.
+
+        .. warning:: If partial is :data:`True` (not the default) the output
+                     can end in a partial line, possibly in the middle of a
+                     multi byte character (when `interpreted` is
+                     :data:`False` this may cause decoding errors).
+        """
+        if interpreted:
+            return self.get_cached_view(('text', True), partial, lambda: u'\n'.join(self.get_lines(True, True)))
+        else:
+            return self.get_cached_view(('text', False), partial, lambda: codecs.decode(
+                self.get_buffer(partial=True), self.encoding, self.decoding_errors,
+            ))
+
+    def get_cached_view(self, name, partial, compute):
+        """
+        Get a view of the captured output, computing it only when necessary.
+
+        :param name: The name of the view (a hashable value).
+        :param partial: Refer to :func:`get_handle()` for details.
+        :param compute: A callable that returns the view of the captured
+                        output (called with partial reads enabled because
+                        this method finishes the capture when necessary).
+        :returns: The value returned by `compute`.
+
+        Views are cached based on the size of the captured output and whether
+        the capture has finished, so a cached view is invalidated as soon as
+        more output arrives. Views of captures larger than
+        :data:`VIEW_CACHE_LIMIT` aren't cached.
+        """
+        if not partial:
+            self.finish_capture()
+        # Determine the cache key before computing the view, to make sure we
+        # never associate a view with output that was captured after it.
+        key = (not self.is_capturing, self.storage.get_size())
+        cached = self.cached_views.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        started = monotonic()
+        value = compute()
+        self.stats.decode_seconds += monotonic() - started
+        if key[1] <= VIEW_CACHE_LIMIT:
+            self.cached_views[name] = (key, value)
+        else:
+            self.cached_views.pop(name, None)
+        return value
+
+    def get_interpreted_lines(self, partial=PARTIAL_DEFAULT):
+        """get_interpreted_lines(partial=False)
+        Get the captured output processed like :func:`.clean_terminal_output()` does.
+
+        :param partial: Refer to :func:`get_handle()` for details.
+        :returns: The captured output as a list of Unicode strings.
+
+        The captured output is fed to a :class:`TerminalInterpreter` that's
+        kept between calls, so each call only decodes and interprets the
+        output that was captured since the previous call. This makes repeated
+        partial reads of progress bar heavy output cheap. Multi byte characters
+        and escape sequences that are split at the end of the available output
+        are held back until the rest arrives or the capture has finished.
+        Once a capture larger than :data:`VIEW_CACHE_LIMIT` has finished the
+        interpreter is discarded.
+        """
+        if not partial:
+            self.finish_capture()
+        with self.interpreter_lock:
+            if self.interpreter is None:
+                self.interpreter = TerminalInterpreter()
+                self.interpreter_decoder = codecs.getincrementaldecoder(self.encoding)(self.decoding_errors)
+            if not self.interpreter_finished:
+                # Check whether the capture has finished before reading, to
+                # make sure we don't miss output that's stored after the read.
+                finished = not self.is_capturing
+                while True:
+                    offset, chunk = self.storage.read(self.interpreted_offset, FOLLOW_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.interpreter.feed(self.interpreter_decoder.decode(chunk))
+                    self.interpreted_offset = offset + len(chunk)
+                if finished:
+                    self.interpreter.feed(self.interpreter_decoder.decode(b'', True), final=True)
+                    self.interpreter_finished = True
+            lines = self.interpreter.get_lines()
+            if self.interpreter_finished and self.interpreted_offset > VIEW_CACHE_LIMIT:
+                # Don't pin the interpreted output of huge captures in memory
+                # once the capture has finished (it's no longer needed to
+                # make partial reads incremental).
+                self.interpreter = None
+                self.interpreter_finished = False
+                self.interpreted_offset = 0
+            return lines
+
+    def save_to_handle(self, handle, partial=PARTIAL_DEFAULT, compressed=False):
+        """save_to_handle(handle, partial=False, compressed=False)
+        Save the captured output to an open file handle.
+
+        :param handle: A writable file-like object.
+        :param partial: Refer to :func:`get_handle()` for details.
+        :param compressed: :data:`True` to save the compressed stream as is
+                           (only supported when the output is stored in a
+                           :class:`CompressedStorage`), :data:`False` to
+                           save the decompressed output (the default).
+        :raises: :exc:`~exceptions.ValueError` when `compressed` is
+                 :data:`True` but the output isn't stored compressed.
+
+        A compressed stream saved with `partial` set to :data:`True` is
+        incomplete (it lacks the end of stream marker).
+        """
+        if compressed:
+            if not isinstance(self.storage, CompressedStorage):
+                raise ValueError("Captured output isn't stored compressed!")
+            if not partial:
+                self.finish_capture()
+            shutil.copyfileobj(self.storage.get_handle(compressed=True), handle)
+        else:
+            shutil.copyfileobj(self.get_handle(partial), handle)
+
+    def save_to_path(self, filename, partial=PARTIAL_DEFAULT, compressed=False):
+        """save_to_path(filename, partial=False, compressed=False)
+        Save the captured output to a file.
+
+        :param filename: The pathname of the file where the captured output
+                         should be written to (a string).
+        :param partial: Refer to :func:`get_handle()` for details.
+        :param compressed: Refer to :func:`save_to_handle()` for details.
+        """
+        with open(filename, 'wb') as handle:
+            self.save_to_handle(handle, partial, compressed)
+
+    def iter_chunks(self, offset=0):
+        """iter_chunks(offset=0)
+        Follow the captured output while it's being captured.
+
+        :param offset: The byte offset in the captured output where iteration
+                       should start (an integer, defaults to zero).
+        :returns: A generator of binary strings.
+
+        Captured output is read from the temporary file starting at the given
+        offset, so each chunk of output is read only once. When no new output
+        is available the generator waits for up to :data:`FOLLOW_INTERVAL`
+        seconds before checking again. Iteration ends once the capture has
+        finished (see :func:`finish_capture()`) and all output was yielded.
+
+        Because the capture has to finish before iteration ends, the
+        generator is meant to be consumed while output is being captured, for
+        example in a separate thread or while output is being produced by a
+        subprocess.
+        """
+        while True:
+            # Check whether the capture has finished before reading, to make
+            # sure we don't miss output that's stored after the read.
+            finished = not self.is_capturing
+            offset, chunk = self.storage.read(offset, FOLLOW_CHUNK_SIZE)
+            if chunk:
+                offset += len(chunk)
+                yield chunk
+            elif finished:
+                return
+            else:
+                time.sleep(FOLLOW_INTERVAL)
+
+    def iter_lines(self, offset=0, interpreted=False):
+        """iter_lines(offset=0, interpreted=False)
+        Follow the captured output line by line while it's being captured.
+
+        :param offset: Refer to :func:`iter_chunks()` for details.
+        :param interpreted: :data:`True` to process the output using a
+                            :class:`TerminalInterpreter`, :data:`False` (the
+                            default) to yield the lines as captured.
+        :returns: A generator of Unicode strings (one for each line, without
+                  line terminators).
+
+        The output yielded by :func:`iter_chunks()` is decoded incrementally
+        (so multi byte characters split between chunks are handled correctly)
+        and each line is yielded as soon as it's complete. The lines are the
+        same as those returned by ``get_lines(interpreted=False)``.
+
+        When `interpreted` is :data:`True` the lines are the same as those
+        returned by ``get_lines(interpreted=True)``, except that empty trailing
+        lines are yielded as well (because they're yielded as soon as they're
+        complete it isn't known yet whether they're trailing).
+        """
+        if interpreted:
+            decoder = codecs.getincrementaldecoder(self.encoding)(self.decoding_errors)
+            interpreter = TerminalInterpreter()
+            for chunk in self.iter_chunks(offset):
+                for line in interpreter.feed(decoder.decode(chunk)):
+                    yield line
+            for line in interpreter.feed(decoder.decode(b'', True), final=True):
+                yield line
+            if interpreter.current_line:
+                yield interpreter.current_line
+            return
+        decoder = IncrementalLineDecoder(self.encoding, self.decoding_errors)
+        for chunk in self.iter_chunks(offset):
+            for line in decoder.decode(chunk):
+                yield line
+        for line in decoder.decode(b'', final=True):
+            yield line
+
+    def mark(self):
+        """
+        Create a checkpoint in the captured output.
+
+        :returns: The number of bytes of output captured so far (an integer).
+
+        The returned offset can be passed to :func:`get_bytes()` (using the
+        `since` argument) or :func:`create_cursor()` to get only the output
+        captured after the checkpoint, without reading the output before it.
+        """
+        return self.storage.get_size()
+
+    def create_cursor(self, offset=0):
+        """
+        Create a cursor to read the captured output incrementally.
+
+        :param offset: The byte offset where the cursor should start (an
+                       integer, defaults to zero). Use :func:`mark()` to start
+                       at the end of the output captured so far.
+        :returns: An :class:`OutputCursor` object.
+        """
+        return OutputCursor(self, offset)
+
+    def read_new(self):
+        """
+        Get the output captured since the previous call to this method.
+
+        :returns: The captured output as a binary string (the first call
+                  returns the output captured so far).
+
+        This is a shortcut for :func:`OutputCursor.read_bytes()` using a cursor
+        that's created on the first call, so polling a long running capture
+        reads each byte of output only once. Use :func:`create_cursor()` when
+        you need decoded output.
+        """
+        if self.cursor is None:
+            self.cursor = self.create_cursor()
+        return self.cursor.read_bytes()
+
+    def wait_for(self, pattern, timeout=None, offset=0):
+        """wait_for(pattern, timeout=None, offset=0)
+        Wait for a pattern to appear in the captured output.
+
+        :param pattern: The pattern to search for (a binary string, a Unicode
+                        string that's encoded using the character encoding
+                        of the captured output, or a compiled regular
+                        expression with a binary pattern).
+        :param timeout: The maximum number of seconds to wait (a number or
+                        :data:`None` to wait until the capture finishes).
+        :param offset: The byte offset in the captured output where the
+                       search should start (an integer, defaults to zero).
+                       Use :func:`mark()` to only search the output captured
+                       after a checkpoint.
+        :returns: A tuple with two values: A regular expression match object
+                  and the byte offset in the captured output where the match
+                  starts (an integer). When the timeout expires (or the
+                  capture finishes) before the pattern appears :data:`None`
+                  is returned.
+
+        Each chunk of output is searched once, so waiting doesn't get slower
+        as the capture grows. To find matches that span two chunks, the end
+        of the previous chunk is searched again: The last ``len(pattern) -
+        1`` bytes when the pattern is a string, the last (incomplete) line
+        (up to :data:`MAX_LINE_LENGTH` bytes) when the pattern is a regular
+        expression. This means a regular expression that matches a line
+        break may miss a match that spans two chunks. The positions of the
+        match object are relative to the searched output, use the returned
+        offset instead.
+
+        The calling thread sleeps until the relay worker has stored more
+        output (see :class:`OutputNotifier`) instead of polling.
+        """
+        if not hasattr(pattern, 'search'):
+            if not isinstance(pattern, bytes):
+                pattern = pattern.encode(self.encoding)
+            overlap = len(pattern) - 1
+            pattern = re.compile(re.escape(pattern))
+        else:
+            overlap = None
+        deadline = monotonic() + timeout if timeout is not None else None
+        notifier = self.create_notifier()
+        window = b''
+        notifier.enter()
+        try:
+            while True:
+                # Check for notifications and whether the capture has finished
+                # before reading, to make sure we don't miss output that's
+                # stored after the read.
+                generation = notifier.generation
+                finished = not self.is_capturing
+                while True:
+                    chunk_offset, chunk = self.storage.read(offset + len(window), FOLLOW_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if chunk_offset != offset + len(window):
+                        # Don't search across output that wasn't kept.
+                        offset, window = chunk_offset, b''
+                    window += chunk
+                    match = pattern.search(window)
+                    if match:
+                        return match, offset + match.start()
+                    # Keep the end of the searched output for the next search.
+                    if overlap is None:
+                        keep = min(len(window) - window.rfind(b'\n') - 1, MAX_LINE_LENGTH)
+                    else:
+                        keep = min(len(window), overlap)
+                    offset += len(window) - keep
+                    window = window[len(window) - keep:]
+                if finished:
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                notifier.wait(generation, remaining)
+        finally:
+            notifier.leave()
+
+    def read_output(self, offset, size=None):
+        """
+        Read part of the captured output.
+
+        :param offset: The byte offset where reading should start (an integer).
+        :param size: The maximum number of bytes to read (an integer) or
+                     :data:`None` to read all available output.
+        :returns: The output that was read (a binary string).
+
+        This doesn't change the position of the file object returned by
+        :func:`get_handle()`. When the storage dropped the output at the given
+        offset (see :class:`RingBufferStorage`) reading starts at the first
+        output after the offset that was kept.
+        """
+        offset, output = self.storage.read(offset, size)
+        if size is None and output:
+            # Read the rest of the output kept after a gap of dropped output.
+            return output + self.read_output(offset + len(output))
+        return output
+
+    def read_range(self, start, end=None):
+        """
+        Read the captured output between two byte offsets.
+
+        :param start: The byte offset where reading should start (an integer).
+        :param end: The byte offset where reading should end (an integer) or
+                    :data:`None` to read all available output.
+        :returns: The output that was read (a binary string).
+        """
+        chunks = []
+        while end is None or start < end:
+            start, output = self.storage.read(start, None if end is None else end - start)
+            if end is not None:
+                output = output[:max(0, end - start)]
+            if not output:
+                break
+            chunks.append(output)
+            start += len(output)
+        return b''.join(chunks)
+
+    def capture_loop(self, started_event):
+        """
+        Continuously read from the master end of the pseudo terminal and relay the output.
+
+        This function is run in the background by :func:`start_capture()`
+        using the :mod:`multiprocessing` or :mod:`threading` module. It's role
+        is to read output emitted on the master end of the pseudo terminal and
+        relay this output to the real terminal (so the operator can see what's
+        happening in real time) as well as a temporary file (for additional
+        processing by the caller).
+        """
+        selector = FileDescriptorSelector([self.master_fd, self.worker_connection.fileno()])
+        started_event.set()
+        try:
+            stored = self.store_output(selector)
+            self.writer.finish()
+            self.relay_output(b'', final=True)
+            # Let the master process know that we're shutting down.
+            if self.output_queue is not None:
+                self.output_queue.put((self.queue_token, '', monotonic()))
+            # Let the main process know how much output was stored.
+            self.acknowledge_shutdown(dict(offset=stored, stats=self.stats.get_counters(CaptureStats.worker_counters)))
+        finally:
+            selector.close()
+
+
+class PythonTerminal(PseudoTerminal):
+
+    """
+    Helper for :class:`CaptureOutput` when the scope is ``'python'``.
+
+    Captures the output written to :data:`sys.stdout` and/or :data:`sys.stderr`
+    by replacing them with :class:`StreamTee` objects, which store output in
+    the thread that writes it and relay it to the streams that they replaced.
+    No pseudo terminal is allocated and no relay worker is started, so
+    starting and finishing a capture is cheap, while the captured output is
+    available using the same methods as for :class:`PseudoTerminal` objects.
+
+    Output written directly to the file descriptors of the standard streams
+    (by subprocesses, C extensions or :func:`os.write()`) isn't captured until
+    :func:`switch_to_fd_scope()` is called, after which the output written to
+    the :class:`StreamTee` objects goes through the pseudo terminal.
+    """
+
+    def __init__(self, encoding, termination_delay, chunk_size, relay_fd, max_chunk_size=None,
+                 zero_copy=False, storage=None, index=None, transport='pty', pipe_size=DEFAULT_PIPE_SIZE,
+                 store_processors=None, relay_processors=None):
+        """
+        Initialize a :class:`PythonTerminal` object.
+
+        Refer to :class:`PseudoTerminal` for details about the parameters.
+        Output is relayed to the replaced streams when `relay_fd` isn't
+        :data:`None`.
+        """
+        # Initialize the superclass.
+        super(PythonTerminal, self).__init__(
+            encoding, termination_delay, chunk_size, relay_fd, None, None,
+            engine='thread', max_chunk_size=max_chunk_size, zero_copy=zero_copy,
+            storage=storage, index=index, transport=transport, pipe_size=pipe_size,
+            store_processors=store_processors, relay_processors=relay_processors,
         )
-        self.pseudo_terminals.append(obj)
-        return obj
+        # Initialize instance variables.
+        self.handlers = []
+        self.store_lock = threading.Lock()
+        self.tees = []
 
-    def merge_loop(self, started_event):
+    def open_pseudo_terminal(self):
+        """Don't allocate a pseudo terminal until :func:`switch_to_fd_scope()` is called."""
+
+    def redirect(self, name):
         """
-        Merge and relay output in a child process.
+        Replace one of the standard streams by a :class:`StreamTee` object.
 
-        This internal method is used when standard output and standard error
-        are being captured separately. It's responsible for emitting each
-        captured line on the appropriate stream without interleaving text
-        within lines.
+        :param name: The name of the stream (``'stdout'`` or ``'stderr'``).
+
+        The :mod:`logging` handlers that write to the stream are updated as
+        well (see :func:`find_stream_handlers()`).
         """
-        buffers = {
-            STDOUT_FD: OutputBuffer(self.stdout_stream.original_fd),
-            STDERR_FD: OutputBuffer(self.stderr_stream.original_fd),
-        }
-        started_event.set()
-        while buffers:
-            captured_from, output = self.output_queue.get()
-            if output:
-                buffers[captured_from].add(output)
-            else:
-                buffers[captured_from].flush()
-                buffers.pop(captured_from)
+        original = getattr(sys, name)
+        tee = StreamTee(self, original)
+        setattr(sys, name, tee)
+        self.tees.append((name, tee))
+        for handler in find_stream_handlers(original):
+            handler.stream = tee
+            self.handlers.append((handler, tee))
 
+    def store(self, text):
+        """
+        Store output written to a :class:`StreamTee` object.
 
-class OutputBuffer(object):
+        :param text: The output (a Unicode string or a binary string).
+        :returns: The output that should be relayed to the replaced stream
+                  (a string of the same type as `text`) or :data:`None`.
+
+        When :attr:`relay_processors` isn't :data:`None` the returned output
+        is the processed output (which may be empty).
+        """
+        output = text if isinstance(text, bytes) else text.encode(self.encoding, 'replace')
+        with self.store_lock:
+            if self.writer is None:
+                # The capture has finished.
+                return text
+            if self.slave_fd is not None:
+                # The relay worker stores and relays the output.
+                write_all(self.slave_fd, output)
+                return None
+            self.writer.write(output)
+            self.stats.bytes_captured += len(output)
+            # There's no idle time in which to flush buffered index entries.
+            if self.writer.needs_flush:
+                self.writer.flush()
+            if self.notifier is not None and self.notifier.waiting and self.writer.needs_notify:
+                self.writer.notify()
+            if self.relay_fd is None:
+                return None
+            if self.relay_processors is None:
+                return text
+            output = self.relay_processors.process(output)
+            return output if isinstance(text, bytes) else output.decode(self.encoding, 'replace')
+
+    def switch_to_fd_scope(self):
+        """
+        Allocate the pseudo terminal.
+
+        Output written to the :class:`StreamTee` objects afterwards is written
+        to the pseudo terminal, so it's stored in the same order as the output
+        of subprocesses. Refer to :func:`CaptureOutput.switch_to_fd_scope()`
+        for details.
+        """
+        with self.store_lock:
+            super(PythonTerminal, self).open_pseudo_terminal()
+            self.writer.flush()
+
+    def finish_capture(self):
+        """Restore the replaced streams (and logging handlers) and stop capturing output."""
+        with self.store_lock:
+            if self.slave_fd is None and self.relay_fd is not None and self.relay_processors is not None:
+                # Relay the output that's still buffered by the processors.
+                output = self.relay_processors.process(b'', final=True)
+                if output:
+                    flush_standard_streams()
+                    write_all(self.relay_fd, output)
+            while self.tees:
+                name, tee = self.tees.pop()
+                if getattr(sys, name) is tee:
+                    setattr(sys, name, tee.stream)
+            while self.handlers:
+                handler, tee = self.handlers.pop()
+                if handler.stream is tee:
+                    handler.stream = tee.stream
+            super(PythonTerminal, self).finish_capture()
+
+
+class StreamTee(object):
 
     """
-    Helper for :func:`CaptureOutput.merge_loop()`.
+    Replaces :data:`sys.stdout` or :data:`sys.stderr` for :class:`PythonTerminal`.
 
-    Buffers captured output and flushes to the appropriate stream after each
-    line break.
+    Output written to the tee is stored by the :class:`PythonTerminal` and
+    relayed to the stream that was replaced. Other attributes (like
+    ``encoding``, ``fileno()`` and ``isatty()``) are those of the stream that
+    was replaced.
     """
 
-    def __init__(self, fd):
+    def __init__(self, terminal, stream):
         """
-        Initialize an :class:`OutputBuffer` object.
+        Initialize a :class:`StreamTee` object.
 
-        :param fd: The number of the file descriptor where output should be
-                   flushed (an integer).
+        :param terminal: The :class:`PythonTerminal` that stores the output.
+        :param stream: The file-like object that was replaced.
         """
-        self.fd = fd
-        self.buffer = b''
+        self.terminal = terminal
+        self.stream = stream
 
-    def add(self, output):
+    def __getattr__(self, name):
+        """Get the attributes of the stream that was replaced."""
+        return getattr(self.stream, name)
+
+    def write(self, text):
         """
-        Add output to the buffer and flush appropriately.
+        Store and relay output.
 
-        :param output: The output to add to the buffer (a string).
+        :param text: The output (a string).
+        :returns: The number of characters written (an integer).
         """
-        self.buffer += output
-        if b'\n' in self.buffer:
-            before, _, self.buffer = self.buffer.rpartition(b'\n')
-            os.write(self.fd, before + b'\n')
+        output = self.terminal.store(text)
+        if output:
+            self.stream.write(output)
+        return len(text)
 
-    def flush(self):
-        """Flush any remaining buffered output to the stream."""
-        os.write(self.fd, self.buffer)
-        self.buffer = b''
+    def writelines(self, lines):
+        """
+        Store and relay lines of output.
+
+        :param lines: An iterable of strings.
+        """
+        for line in lines:
+            self.write(line)
 
 
-class PseudoTerminal(MultiProcessHelper):
+class PooledTerminal(TerminalRelay):
 
     """
-    Helper for :class:`CaptureOutput`.
+    A pseudo terminal and relay worker that are reused between captures.
 
-    Manages capturing of output and exposing the captured output.
+    Used by :class:`CapturePool`. The relay worker keeps running between
+    captures: :func:`attach_storage()` hands it the file descriptor of the
+    temporary file of a new capture (and the file descriptor where output
+    should be relayed to) and :func:`detach_storage()` waits for it to store
+    all pending output. Output written to the pseudo terminal while no
+    storage is attached (for example by a background process that outlived
+    the previous capture) is discarded.
     """
 
-    def __init__(self, encoding, termination_delay, chunk_size, relay_fd, output_queue, queue_token):
+    def __init__(self, chunk_size, engine=DEFAULT_ENGINE, max_chunk_size=None, zero_copy=False,
+                 start_method=DEFAULT_START_METHOD):
         """
-        Initialize a :class:`PseudoTerminal` object.
+        Initialize a :class:`PooledTerminal` object.
 
-        :param encoding: The name of the character encoding used to decode the
-                         captured output (a string, defaults to
-                         :data:`DEFAULT_TEXT_ENCODING`).
-        :param termination_delay: The number of seconds to wait before
-                                  terminating the output relay process (a
-                                  floating point number, defaults to
-                                  :data:`TERMINATION_DELAY`).
-        :param chunk_size: The maximum number of bytes to read from the
-                           captured stream(s) on each call to :func:`os.read()`
-                           (an integer).
-        :param relay_fd: The number of the file descriptor where captured
-                         output should be relayed to (an integer or
-                         :data:`None` if ``output_queue`` and ``queue_token``
-                         are given).
-        :param output_queue: The multiprocessing queue where captured output
-                             chunks should be written to (a
-                             :class:`multiprocessing.Queue` object or
-                             :data:`None` if ``relay_fd`` is given).
-        :param queue_token: A unique identifier added to each output chunk
-                            written to the queue (any value or :data:`None` if
-                            ``relay_fd`` is given).
+        Refer to :class:`PseudoTerminal` for details about the parameters.
         """
         # Initialize the superclass.
-        super(PseudoTerminal, self).__init__()
-        # Store constructor arguments.
-        self.encoding = encoding
-        self.termination_delay = termination_delay
-        self.chunk_size = chunk_size
-        self.relay_fd = relay_fd
-        self.output_queue = output_queue
-        self.queue_token = queue_token
-        # Initialize instance variables.
-        self.streams = []
-        # Allocate a pseudo terminal so we can fake subprocesses into
-        # thinking that they are connected to a real terminal (this will
-        # trigger them to use e.g. ANSI escape sequences).
+        super(PooledTerminal, self).__init__(
+            chunk_size, engine=engine,
+            max_chunk_size=max_chunk_size,
+            zero_copy=zero_copy,
+            start_method=start_method,
+        )
+        # Allocate the pseudo terminal and remember its initial settings, so
+        # that changes made during one capture don't leak into the next.
         self.master_fd, self.slave_fd = pty.openpty()
-        # Create a temporary file in which we'll store the output received on
-        # the master end of the pseudo terminal.
-        self.output_fd, output_file = tempfile.mkstemp()
-        self.output_handle = open(output_file, 'rb')
-        # Unlink the temporary file because we have a readable file descriptor
-        # and a writable file descriptor and that's all we need! If this
-        # surprises you I suggest you investigate why unlink() was named the
-        # way it was in UNIX :-).
-        os.unlink(output_file)
+        self.terminal_attributes = termios.tcgetattr(self.slave_fd)
+        self.start_child(self.pool_loop)
 
-    def attach(self, stream):
+    @property
+    def is_alive(self):
+        """:data:`True` while the relay worker is running, :data:`False` otherwise."""
+        return any(child_process.is_alive() for child_process in self.processes)
+
+    def attach_storage(self, writer, relay_fd=None, relay_processors=None):
         """
-        Attach a stream to the pseudo terminal.
+        Start storing (and relaying) the output of the pseudo terminal.
 
-        :param stream: A :class:`Stream` object.
+        :param writer: The :class:`FileWriter` object that stores the output
+                       of the capture.
+        :param relay_fd: The file descriptor where output should be relayed
+                         to (an integer or :data:`None`).
+        :param relay_processors: A :class:`ProcessorChain` object that
+                                 transforms the output before it's relayed (or
+                                 :data:`None`).
         """
-        stream.redirect(self.slave_fd)
-        self.streams.append(stream)
+        index_fd = writer.recorder.fd if writer.recorder is not None else None
+        self.send_request(('attach', writer, relay_processors), writer.fd, index_fd, writer.notify_fd, relay_fd)
 
-    def start_capture(self):
-        """Start the child process(es) responsible for capturing and relaying output."""
-        self.start_child(self.capture_loop)
+    def detach_storage(self):
+        """
+        Stop storing (and relaying) the output of the pseudo terminal.
 
-    def finish_capture(self):
-        """Stop the process of capturing output and destroy the pseudo terminal."""
-        time.sleep(self.termination_delay)
+        :returns: The acknowledgement of the relay worker (a dictionary with
+                  the keys ``offset`` and ``stats``) or :data:`None` when the relay worker
+                  died.
+
+        All output that was written to the pseudo terminal before this method
+        was called has been stored once it returns.
+        """
+        acknowledgement = self.send_request(('detach',))
+        termios.tcsetattr(self.slave_fd, termios.TCSANOW, self.terminal_attributes)
+        return acknowledgement
+
+    def send_request(self, request, *fds):
+        """
+        Send a request to the relay worker and wait for its reply.
+
+        :param request: The request to send (a tuple with a command string
+                        followed by its arguments).
+        :param fds: Any file descriptors to pass along with the request
+                    (integers or :data:`None`).
+        :returns: The reply of the relay worker.
+
+        When the relay worker is a child process the file descriptors are
+        passed using :func:`multiprocessing.reduction.send_handle()`.
+        """
+        child_process = self.processes[0]
+        try:
+            self.control_connection.send(request + fds)
+            if not self.uses_threads:
+                for fd in fds:
+                    if fd is not None:
+                        multiprocessing.reduction.send_handle(self.control_connection, fd, child_process.pid)
+        except (IOError, OSError):
+            # The relay worker died.
+            return None
+        return self.wait_for_reply(child_process)
+
+    def close(self):
+        """Stop the relay worker and destroy the pseudo terminal."""
         self.stop_children()
         self.close_pseudo_terminal()
-        self.restore_streams()
 
-    def close_pseudo_terminal(self):
-        """Close the pseudo terminal's master/slave file descriptors."""
-        for name in ('master_fd', 'slave_fd'):
-            fd = getattr(self, name)
-            if fd is not None:
-                os.close(fd)
-                setattr(self, name, None)
+    def pool_loop(self, started_event):
+        """
+        Store and relay output for successive captures until shutdown is requested.
 
-    def restore_streams(self):
-        """Restore the stream(s) attached to the pseudo terminal."""
-        for stream in self.streams:
-            stream.restore()
+        This function is run in the background by :func:`__init__()` using the
+        :mod:`multiprocessing` or :mod:`threading` module. It handles the
+        requests sent by :func:`attach_storage()`, :func:`detach_storage()`
+        and :func:`~MultiProcessHelper.stop_children()`.
+        """
+        selector = FileDescriptorSelector([self.master_fd, self.worker_connection.fileno()])
+        stored = 0
+        started_event.set()
+        try:
+            while True:
+                stored += self.store_output(selector)
+                request = self.worker_connection.recv()
+                if request is None:
+                    self.worker_connection.send(None)
+                    break
+                command = request[0]
+                if command == 'attach':
+                    writer, self.relay_processors, output_fd, index_fd, notify_fd, relay_fd = request[1:]
+                    writer.fd = self.receive_fd(output_fd)
+                    if writer.recorder is not None:
+                        writer.recorder.fd = self.receive_fd(index_fd)
+                    writer.notify_fd = self.receive_fd(notify_fd)
+                    self.relay_fd = self.receive_fd(relay_fd)
+                    self.writer = writer
+                    self.stats = CaptureStats()
+                    self.worker_connection.send(None)
+                elif command == 'detach':
+                    if self.writer is not None:
+                        self.writer.finish()
+                    self.relay_output(b'', final=True)
+                    counters = self.stats.get_counters(CaptureStats.worker_counters)
+                    self.worker_connection.send(dict(offset=stored, stats=counters))
+                    self.release_fds()
+                stored = 0
+        finally:
+            selector.close()
+            self.release_fds()
 
-    # The CaptureOutput class contains proxy methods for the get_handle(),
-    # get_bytes(), get_lines(), get_text(), save_to_handle() and save_to_path()
-    # methods defined below. By default Sphinx generates method signatures of
-    # the form f(proxy, *args, **kw) for these proxy methods, with the result
-    # that the online documentation is rather confusing. As a workaround I've
-    # included explicit method signatures in the first line of each of the
-    # docstrings. This works because of the following Sphinx option:
-    # http://www.sphinx-doc.org/en/latest/ext/autodoc.html#confval-autodoc_docstring_signature
+    def receive_fd(self, fd):
+        """
+        Receive a file descriptor sent by :func:`send_request()` (called in the relay worker).
 
-    def get_handle(self, partial=PARTIAL_DEFAULT):
-        """get_handle(partial=False)
-        Get the captured output as a Python file object.
+        :param fd: The file descriptor number in the main process (an integer
+                   or :data:`None`).
+        :returns: The file descriptor number in the relay worker (an integer
+                  or :data:`None`).
+        """
+        if fd is None or self.uses_threads:
+            return fd
+        return multiprocessing.reduction.recv_handle(self.worker_connection)
 
-        :param partial: If :data:`True` (*not the default*) the partial output
-                        captured so far is returned, otherwise (*so by
-                        default*) the relay process is terminated and output
-                        capturing is disabled before returning the captured
-                        output (the default is intended to protect unsuspecting
-                        users against partial reads).
-        :returns: The captured output as a Python file object. The file
-                  object's current position is reset to zero before this
-                  function returns.
+    def release_fds(self):
+        """Forget the file descriptors received by :func:`pool_loop()` (closing them in a child process)."""
+        if not self.uses_threads:
+            if self.writer is not None:
+                self.writer.close()
+            if self.relay_fd is not None:
+                os.close(self.relay_fd)
+        self.writer = None
+        self.relay_fd = None
+        self.relay_processors = None
 
-        This method is useful when you're dealing with arbitrary amounts of
-        captured data that you don't want to load into memory just so you can
-        save it to a file again. In fact, in that case you might want to take a
-        look at :func:`save_to_path()` and/or :func:`save_to_handle()` :-).
 
-        .. warning:: Two caveats about the use of this method:
+class AdaptiveReader(object):
 
-                     1. If partial is :data:`True` (not the default) the output
-                        can end in a partial line, possibly in the middle of an
-                        ANSI escape sequence or a multi byte character.
+    """
+    Helper for :class:`PseudoTerminal`.
 
-                     2. If you close this file handle you just lost your last
-                        chance to get at the captured output! (calling this
-                        method again will not give you a new file handle)
+    Adapts the number of bytes read on each call to :func:`os.read()` to the
+    amount of pending output, to reduce the number of system calls required to
+    capture bulk output without increasing latency for interactive output.
+
+    The number of pending bytes is queried using the ``FIONREAD`` ioctl. When
+    this isn't supported the read size is doubled after each read that filled
+    the buffer and halved after each read that used less than a quarter of
+    the buffer.
+
+    Note that on Linux a single read from the master end of a pseudo terminal
+    never returns more than 4095 bytes (the size of the line discipline's read
+    buffer) so larger maximums only help on other platforms.
+    """
+
+    def __init__(self, minimum, maximum):
         """
-        if not partial:
-            self.finish_capture()
-        self.output_handle.seek(0)
-        return self.output_handle
+        Initialize an :class:`AdaptiveReader` object.
 
-    def get_bytes(self, partial=PARTIAL_DEFAULT):
-        """get_bytes(partial=False)
-        Get the captured output as binary data.
+        :param minimum: The minimum number of bytes to read (an integer).
+        :param maximum: The maximum number of bytes to read (an integer).
+        """
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.size = minimum
+        self.pending = array.array('i', [0])
+        self.use_ioctl = hasattr(termios, 'FIONREAD')
 
-        :param partial: Refer to :func:`get_handle()` for details.
-        :returns: The captured output as a binary string.
+    def read(self, fd):
         """
-        return self.get_handle(partial).read()
+        Read a chunk of output from a file descriptor.
 
-    def get_lines(self, interpreted=True, partial=PARTIAL_DEFAULT):
-        """get_lines(interpreted=True, partial=False)
-        Get the captured output split into lines.
+        :param fd: The file descriptor to read from (an integer).
+        :returns: The output that was read (a binary string).
+        """
+        if self.use_ioctl:
+            try:
+                fcntl.ioctl(fd, termios.FIONREAD, self.pending, True)
+            except (IOError, OSError):
+                # Fall back to the heuristic below when the ioctl isn't
+                # supported by the file descriptor.
+                self.use_ioctl = False
+            else:
+                return os.read(fd, min(max(self.pending[0], self.minimum), self.maximum))
+        output = os.read(fd, self.size)
+        if len(output) >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+        elif len(output) < self.size // 4:
+            self.size = max(self.size // 2, self.minimum)
+        return output
 
-        :param interpreted: If :data:`True` (the default) captured output is
-                            processed using :func:`.clean_terminal_output()`.
-        :param partial: Refer to :func:`get_handle()` for details.
-        :returns: The captured output as a list of Unicode strings.
 
-        .. warning:: If partial is :data:`True` (not the default) the output
-                     can end in a partial line, possibly in the middle of a
-                     multi byte character (this may cause decoding errors).
+class ZeroCopyRelay(object):
+
+    """
+    Helper for :class:`PseudoTerminal`.
+
+    Moves output from the master end of a pseudo terminal to the temporary
+    file (and optionally duplicates it to a relay file descriptor) using the
+    Linux :man:`splice` and :man:`tee` system calls, so that the output never
+    needs to be copied into Python byte strings:
+
+    1. The output is spliced from the pseudo terminal into a pipe.
+    2. When relaying, the contents of the pipe are duplicated into a second
+       pipe using :man:`tee` (which doesn't consume the contents).
+    3. The contents of the pipes are spliced into the temporary file and the
+       relay file descriptor.
+
+    :func:`os.splice()` is available on Python 3.10+ while :man:`tee` is
+    called using :mod:`ctypes`. When any of these system calls turns out to
+    be unsupported for the given file descriptors, output that was already
+    moved into the pipes is copied the regular way and :attr:`enabled` is
+    set to :data:`False`, so that the caller can fall back to copying.
+
+    Note that zero-copy relaying needs more system calls per chunk than
+    copying, so it pays off for large chunks (e.g. when combined with
+    `max_chunk_size` on platforms with large pseudo terminal buffers) but
+    not necessarily for the small reads that Linux pseudo terminals allow.
+    Use :mod:`capturer.benchmarks` to find out what works best.
+    """
+
+    unsupported_errors = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV)
+    """The :data:`~errno.errorcode` values that indicate that zero-copy isn't supported (a tuple)."""
+
+    def __init__(self, source_fd, output_fd, relay_fd, chunk_size):
         """
-        output = self.get_bytes(partial)
-        output = output.decode(self.encoding)
-        if interpreted:
-            return clean_terminal_output(output)
-        else:
-            return output.splitlines()
+        Initialize a :class:`ZeroCopyRelay` object.
 
-    def get_text(self, interpreted=True, partial=PARTIAL_DEFAULT):
-        """get_text(interpreted=True, partial=False)
-        Get the captured output as a single string.
+        :param source_fd: The file descriptor to read output from (an integer).
+        :param output_fd: The file descriptor where output should be stored
+                          (an integer).
+        :param relay_fd: The file descriptor where output should be relayed to
+                         (an integer or :data:`None`).
+        :param chunk_size: The maximum number of bytes to transfer at once (an
+                           integer, shouldn't exceed :data:`PIPE_CAPACITY`).
+        """
+        self.source_fd = source_fd
+        self.output_fd = output_fd
+        self.relay_fd = relay_fd
+        self.chunk_size = chunk_size
+        self.enabled = True
+        self.output_pipe = os.pipe()
+        self.relay_pipe = os.pipe() if relay_fd is not None else None
 
-        :param interpreted: If :data:`True` (the default) captured output is
-                            processed using :func:`clean_terminal_output()`.
-        :param partial: Refer to :func:`get_handle()` for details.
-        :returns: The captured output as a Unicode string.
+    @staticmethod
+    def is_supported():
+        """
+        Check whether the required system calls are available.
 
-        .. warning:: If partial is :data:`True` (not the default) the output
-                     can end in a partial line, possibly in the middle of a
-                     multi byte character (this may cause decoding errors).
+        :returns: :data:`True` if :func:`os.splice()` and :man:`tee` are
+                  available, :data:`False` otherwise.
         """
-        output = self.get_bytes(partial)
-        output = output.decode(self.encoding)
-        if interpreted:
-            output = u'\n'.join(clean_terminal_output(output))
-        return output
+        return hasattr(os, 'splice') and (get_tee_function() is not None)
 
-    def save_to_handle(self, handle, partial=PARTIAL_DEFAULT):
-        """save_to_handle(handle, partial=False)
-        Save the captured output to an open file handle.
+    def transfer(self):
+        """
+        Transfer a chunk of output.
 
-        :param handle: A writable file-like object.
-        :param partial: Refer to :func:`get_handle()` for details.
+        :returns: The number of bytes transferred (an integer, zero on EOF)
+                  or :data:`None` when zero-copy turned out to be unsupported
+                  before any output was transferred (in which case the caller
+                  should fall back to copying).
         """
-        shutil.copyfileobj(self.get_handle(partial), handle)
+        try:
+            num_bytes = os.splice(self.source_fd, self.output_pipe[1], self.chunk_size)
+        except OSError as e:
+            if e.errno not in self.unsupported_errors:
+                raise
+            self.enabled = False
+            return None
+        if num_bytes and self.relay_pipe is not None:
+            try:
+                duplicated = tee(self.output_pipe[0], self.relay_pipe[1], num_bytes)
+            except OSError as e:
+                if e.errno not in self.unsupported_errors:
+                    raise
+                self.enabled = False
+                duplicated = 0
+            self.move(self.output_pipe[0], self.output_fd, duplicated)
+            self.move(self.relay_pipe[0], self.relay_fd, duplicated)
+            if duplicated < num_bytes:
+                # Copy the output that wasn't duplicated by tee().
+                output = read_exactly(self.output_pipe[0], num_bytes - duplicated)
+                write_all(self.output_fd, output)
+                write_all(self.relay_fd, output)
+        elif num_bytes:
+            self.move(self.output_pipe[0], self.output_fd, num_bytes)
+        return num_bytes
 
-    def save_to_path(self, filename, partial=PARTIAL_DEFAULT):
-        """save_to_path(filename, partial=False)
-        Save the captured output to a file.
+    def move(self, pipe_fd, target_fd, num_bytes):
+        """
+        Move output from one of the pipes to its destination.
 
-        :param filename: The pathname of the file where the captured output
-                         should be written to (a string).
-        :param partial: Refer to :func:`get_handle()` for details.
+        :param pipe_fd: The read end of the pipe (an integer).
+        :param target_fd: The destination file descriptor (an integer).
+        :param num_bytes: The number of bytes to move (an integer).
+
+        When :func:`os.splice()` isn't supported for the destination the
+        remaining output is copied the regular way.
         """
-        with open(filename, 'wb') as handle:
-            self.save_to_handle(handle, partial)
+        while num_bytes > 0:
+            if self.enabled:
+                try:
+                    num_bytes -= os.splice(pipe_fd, target_fd, num_bytes)
+                    continue
+                except OSError as e:
+                    if e.errno not in self.unsupported_errors:
+                        raise
+                    self.enabled = False
+            write_all(target_fd, read_exactly(pipe_fd, num_bytes))
+            num_bytes = 0
 
-    def capture_loop(self, started_event):
+    def close(self):
+        """Close the pipes used to transfer output."""
+        for pipe in (self.output_pipe, self.relay_pipe):
+            if pipe is not None:
+                for fd in pipe:
+                    os.close(fd)
+        self.output_pipe = None
+        self.relay_pipe = None
+
+
+class FileDescriptorSelector(object):
+
+    """
+    Wait for one or more file descriptors to become readable.
+
+    Uses :class:`selectors.PollSelector` when available and falls back to
+    :class:`selectors.DefaultSelector` or :func:`select.select()` (on Python
+    2).
+
+    Event based mechanisms like epoll aren't used on purpose: Output written
+    to a pseudo terminal is handed to the master end asynchronously by the
+    kernel, and only polling the master end explicitly (which poll() and
+    select() do on every call) guarantees that such output is noticed before
+    a shutdown request that was sent after it.
+    """
+
+    def __init__(self, fds=()):
         """
-        Continuously read from the master end of the pseudo terminal and relay the output.
+        Initialize a :class:`FileDescriptorSelector` object.
 
-        This function is run in the background by :func:`start_capture()`
-        using the :mod:`multiprocessing` module. It's role is to read output
-        emitted on the master end of the pseudo terminal and relay this output
-        to the real terminal (so the operator can see what's happening in real
-        time) as well as a temporary file (for additional processing by the
-        caller).
+        :param fds: An iterable of file descriptors to watch (integers).
         """
-        self.enable_graceful_shutdown()
-        started_event.set()
-        try:
-            while True:
-                # Read from the master end of the pseudo terminal.
-                output = os.read(self.master_fd, self.chunk_size)
-                if output:
-                    # Store the output in the temporary file.
-                    os.write(self.output_fd, output)
-                    # Relay the output to the real terminal?
-                    if self.relay_fd is not None:
-                        os.write(self.relay_fd, output)
-                    # Relay the output to the master process?
-                    if self.output_queue is not None:
-                        self.output_queue.put((self.queue_token, output))
-                else:
-                    # Relinquish our time slice, or in other words: try to be
-                    # friendly to other processes when os.read() calls don't
-                    # block. Just for the record, all of my experiments have
-                    # shown that os.read() on the master file descriptor
-                    # returned by pty.openpty() does in fact block.
-                    time.sleep(0)
-        except ShutdownRequested:
-            # Let the master process know that we're shutting down.
-            if self.output_queue is not None:
-                self.output_queue.put((self.queue_token, ''))
+        self.fds = []
+        if selectors is not None:
+            self.selector = getattr(selectors, 'PollSelector', selectors.DefaultSelector)()
+        else:
+            self.selector = None
+        for fd in fds:
+            self.register(fd)
+
+    def register(self, fd):
+        """
+        Start watching a file descriptor.
+
+        :param fd: The file descriptor to watch (an integer).
+        """
+        if self.selector is not None:
+            self.selector.register(fd, selectors.EVENT_READ)
+        self.fds.append(fd)
+
+    def unregister(self, fd):
+        """
+        Stop watching a file descriptor.
+
+        :param fd: The file descriptor to stop watching (an integer).
+        """
+        if self.selector is not None:
+            self.selector.unregister(fd)
+        self.fds.remove(fd)
+
+    def wait(self, timeout=None):
+        """
+        Wait for one or more of the file descriptors to become readable.
+
+        :param timeout: The maximum number of seconds to wait (a number) or
+                        :data:`None` to wait indefinitely.
+        :returns: A list of readable file descriptors (integers).
+        """
+        if self.selector is not None:
+            return [key.fd for key, events in self.selector.select(timeout)]
+        readable, writable, exceptional = select.select(self.fds, [], [], timeout)
+        return readable
+
+    def close(self):
+        """Release the resources held by the selector."""
+        if self.selector is not None:
+            self.selector.close()
 
 
 class Stream(object):
@@ -681,6 +5312,14 @@ class Stream(object):
         self.original_fd = os.dup(self.fd)
         self.is_redirected = False
 
+    def __getstate__(self):
+        """Prepare the stream to be pickled (see :func:`reduce_fds()`)."""
+        return reduce_fds(dict(self.__dict__), ['original_fd'])
+
+    def __setstate__(self, state):
+        """Restore the stream after it was unpickled (see :func:`rebuild_fds()`)."""
+        self.__dict__.update(rebuild_fds(state, ['original_fd']))
+
     def redirect(self, target_fd):
         """
         Redirect output written to the file descriptor to another file descriptor.
@@ -707,8 +5346,9 @@ class Stream(object):
 class ShutdownRequested(Exception):
 
     """
-    Raised by :func:`~MultiProcessHelper.raise_shutdown_request()` to signal
-    graceful termination requests (in :func:`~PseudoTerminal.capture_loop()`).
+    Raised by :func:`~Multiplexer.multiplex_loop()` to break out of the loop
+    once a graceful termination request arrives and all pending output has
+    been stored (and by :func:`~MultiProcessHelper.raise_shutdown_request()`).
     """
 
 
@@ -0,0 +1,296 @@
+# Easily capture stdout/stderr of the current process and subprocesses.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://capturer.readthedocs.io
+
+"""
+Capture output in :mod:`asyncio` based programs (requires Python 3.5+).
+
+The :class:`AsyncCaptureOutput` class is an asynchronous context manager that
+reads the master end of the pseudo terminal in the event loop (using
+:meth:`~asyncio.loop.add_reader()`) instead of in a relay process or thread,
+so starting and finishing a capture never blocks the event loop. Here's how
+you capture the output of a subprocess:
+
+.. code-block:: python
+
+   import asyncio
+   from capturer.aio import AsyncCaptureOutput
+
+   async def run(*command):
+       async with AsyncCaptureOutput(redirect=False, relay=False) as capturer:
+           process = await asyncio.create_subprocess_exec(
+               *command, stdout=capturer.fileno(), stderr=capturer.fileno(),
+           )
+           await process.wait()
+       return capturer.get_text()
+
+Because `redirect` is :data:`False` the standard streams of the current
+process are left alone, which makes it possible to capture the output of
+many concurrent subprocesses (each with their own capture). Captured output
+can be followed using ``async for chunk in capturer`` (for example in a
+separate task), which ends once the capture has finished.
+"""
+
+# Standard library modules.
+import asyncio
+import errno
+import fcntl
+import os
+import select
+
+# Modules included in our package.
+from capturer import (
+    DEFAULT_TEXT_ENCODING,
+    FOLLOW_CHUNK_SIZE,
+    CaptureOutput,
+    CaptureStats,
+    flush_standard_streams,
+    monotonic,
+    write_all,
+)
+
+# Use the most specific way to get the event loop that's available.
+get_event_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncCaptureOutput(CaptureOutput):
+
+    """
+    Asynchronous context manager to capture output in the event loop.
+
+    Supports the same methods to get at the captured output as
+    :class:`~capturer.CaptureOutput` with `merged` set to :data:`True`
+    (:func:`~capturer.PseudoTerminal.get_text()`,
+    :func:`~capturer.PseudoTerminal.get_lines()`, etc).
+
+    Only the `encoding`, `chunk_size`, `relay` and `redirect` options are
+    supported. The other options of :class:`~capturer.CaptureOutput` (like
+    `merged`, `timestamps`, `store_processors`, the storage options and
+    `stats_callback`) can't be given: Output is always captured by a single
+    pseudo terminal (as if `merged` is :data:`True`) and stored uncompressed
+    in an unlinked temporary file, with timestamps and without processors.
+    Statistics are collected in :attr:`~capturer.CaptureOutput.stats` but
+    not reported using a callback.
+
+    .. warning:: Output written by the event loop thread itself (e.g. using
+                 :func:`print()` while `redirect` is :data:`True`) is only
+                 stored when the event loop gets a chance to run, so writing
+                 more output than fits in the buffer of the pseudo terminal
+                 without awaiting anything in between blocks forever. This
+                 doesn't apply to output written by subprocesses and other
+                 threads.
+    """
+
+    def __init__(self, encoding=DEFAULT_TEXT_ENCODING, chunk_size=FOLLOW_CHUNK_SIZE, relay=True, redirect=True):
+        """
+        Initialize an :class:`AsyncCaptureOutput` object.
+
+        :param encoding: Refer to :class:`~capturer.CaptureOutput` for details.
+        :param chunk_size: The maximum number of bytes to read from the
+                           pseudo terminal at once (an integer, defaults to
+                           :data:`~capturer.FOLLOW_CHUNK_SIZE`).
+        :param relay: Refer to :class:`~capturer.CaptureOutput` for details.
+        :param redirect: If this is :data:`True` (the default) the standard
+                         output and error streams of the current process are
+                         redirected to the pseudo terminal, like
+                         :class:`~capturer.CaptureOutput` does. If this is
+                         :data:`False` only output written to :func:`fileno()`
+                         is captured.
+        """
+        super(AsyncCaptureOutput, self).__init__(encoding=encoding, chunk_size=chunk_size, relay=relay)
+        self.redirect = redirect
+        self.loop = None
+        self.master_fd = None
+        self.waiters = []
+
+    async def __aenter__(self):
+        """Automatically call :func:`start_capture()` when entering an :keyword:`async with` block."""
+        self.start_capture()
+        return self
+
+    async def __aexit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Automatically call :func:`finish_capture()` when leaving an :keyword:`async with` block."""
+        self.finish_capture()
+
+    def __aiter__(self):
+        """Follow the captured output using ``async for`` (see :class:`AsyncChunkIterator`)."""
+        return AsyncChunkIterator(self)
+
+    @property
+    def is_capturing(self):
+        """:data:`True` while output is being captured, :data:`False` otherwise."""
+        return self.loop is not None
+
+    def fileno(self):
+        """
+        Get the file descriptor of the slave end of the pseudo terminal.
+
+        :returns: A file descriptor (an integer) that can be used as the
+                  standard output and/or error stream of subprocesses.
+        :raises: :exc:`~exceptions.TypeError` when the capture hasn't been
+                 started yet.
+        """
+        if not self.is_capturing:
+            raise TypeError("Output capturing hasn't been started yet!")
+        return self.output.slave_fd
+
+    def start_capture(self):
+        """
+        Start capturing output.
+
+        :raises: :exc:`~exceptions.TypeError` when output is already being
+                 captured.
+
+        Must be called from a coroutine (or callback) that's run by the event
+        loop, because on Python 3.7+ :func:`asyncio.get_running_loop()` raises
+        :exc:`~exceptions.RuntimeError` when no event loop is running. This
+        method is called automatically when using the capture object as an
+        asynchronous context manager.
+        """
+        if self.is_capturing:
+            raise TypeError("Output capturing is already enabled!")
+        started = monotonic()
+        self.loop = get_event_loop()
+        fd = self.stderr_stream.original_fd if self.relay else None
+        self.output = self.allocate_pty(relay_fd=fd)
+        self.stats = CaptureStats()
+        self.stats.streams = dict(output=self.output.stats)
+        self.master_fd = self.output.master_fd
+        flags = fcntl.fcntl(self.master_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.loop.add_reader(self.master_fd, self.handle_output)
+        if self.redirect:
+            for kind, stream in self.streams:
+                self.output.attach(stream)
+        self.stats.start_capture_seconds = monotonic() - started
+
+    def finish_capture(self):
+        """
+        Stop capturing output.
+
+        Output that's still pending in the pseudo terminal is stored before
+        the pseudo terminal is destroyed. This doesn't block because the
+        master end of the pseudo terminal is non-blocking. This method is
+        called automatically when using the capture object as an asynchronous
+        context manager.
+        """
+        if self.is_capturing:
+            started = monotonic()
+            # The pseudo terminal is already gone when one of the accessors
+            # was called without partial=True (which finishes the capture).
+            if self.output.is_capturing:
+                flush_standard_streams()
+                # Polling the master end makes the kernel hand over pending
+                # output, so this loop stores all output written so far.
+                while select.select([self.master_fd], [], [], 0)[0] and self.handle_output():
+                    pass
+            self.loop.remove_reader(self.master_fd)
+            self.loop = None
+            self.output.finish_capture()
+            self.notify_waiters()
+            self.stats.finish_capture_seconds += monotonic() - started
+
+    def handle_output(self):
+        """
+        Store and relay the output that's available (called by the event loop).
+
+        :returns: :data:`True` when output was read, :data:`False` otherwise.
+        """
+        if not self.output.is_capturing:
+            # One of the accessors finished the capture.
+            self.loop.remove_reader(self.master_fd)
+            return False
+        try:
+            output = self.output.read_chunk()
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            if e.errno != errno.EIO:
+                raise
+            # The slave end of the pseudo terminal was closed.
+            output = b''
+        self.output.stats.read_calls += 1
+        if not output:
+            self.loop.remove_reader(self.master_fd)
+            return False
+        self.output.writer.write(output)
+        self.output.stats.bytes_captured += len(output)
+        # There's no idle time in which to flush buffered index entries.
+        self.output.writer.flush()
+        if self.output.notifier is not None and self.output.notifier.waiting:
+            self.output.writer.notify()
+        if self.output.relay_fd is not None:
+            started = monotonic()
+            write_all(self.output.relay_fd, output)
+            self.output.stats.relay_write_seconds += monotonic() - started
+        self.notify_waiters()
+        return True
+
+    def wait_for_output(self):
+        """
+        Wait for more output to be captured (or the capture to finish).
+
+        :returns: An :class:`asyncio.Future` object.
+        """
+        waiter = self.loop.create_future()
+        self.waiters.append(waiter)
+        return waiter
+
+    def notify_waiters(self):
+        """Wake up the coroutines waiting in :func:`wait_for_output()`."""
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class AsyncChunkIterator(object):
+
+    """
+    Asynchronous iterator over the output captured by :class:`AsyncCaptureOutput`.
+
+    Captured output is read from the temporary file starting at the given
+    offset, so each chunk of output is read only once (like
+    :func:`~capturer.PseudoTerminal.iter_chunks()` does). Iteration ends once
+    the capture has finished and all output was yielded.
+    """
+
+    def __init__(self, capturer, offset=0):
+        """
+        Initialize an :class:`AsyncChunkIterator` object.
+
+        :param capturer: An :class:`AsyncCaptureOutput` object whose capture
+                         has been started.
+        :param offset: The byte offset in the captured output where iteration
+                       should start (an integer, defaults to zero).
+        :raises: :exc:`~exceptions.TypeError` when the capture hasn't been
+                 started yet.
+        """
+        if not hasattr(capturer, 'output'):
+            raise TypeError("Output capturing hasn't been started yet!")
+        self.capturer = capturer
+        self.offset = offset
+
+    def __aiter__(self):
+        """Return the iterator itself."""
+        return self
+
+    async def __anext__(self):
+        """
+        Get the next chunk of captured output.
+
+        :returns: A binary string.
+        :raises: :exc:`StopAsyncIteration` once the capture has finished and
+                 all output was yielded.
+        """
+        while True:
+            finished = not self.capturer.is_capturing
+            offset, chunk = self.capturer.output.storage.read(self.offset, FOLLOW_CHUNK_SIZE)
+            if chunk:
+                self.offset = offset + len(chunk)
+                return chunk
+            if finished:
+                raise StopAsyncIteration
+            await self.capturer.wait_for_output()
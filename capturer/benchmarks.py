@@ -0,0 +1,523 @@
+# Easily capture stdout/stderr of the current process and subprocesses.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://capturer.readthedocs.io
+
+"""
+Usage: python -m capturer.benchmarks [OPTIONS] [BENCHMARK..]
+
+Measure the overhead of capturing output using the `capturer` package and
+report the results in JSON format, so that they can be compared between
+releases of `capturer` (on the same hardware).
+
+When no benchmark names are given all benchmarks are run. The following
+benchmarks are available: startup, throughput, queue-overhead, accessors,
+line-buffering and producer-stall.
+
+During the benchmarks the standard output and error streams are redirected to
+/dev/null, to make sure that relayed output doesn't flood the terminal.
+
+Supported options:
+
+  -i, --iterations=COUNT
+
+    The number of times that each latency measurement is repeated
+    (defaults to 50).
+
+  -s, --size=BYTES
+
+    The number of bytes of output generated by each throughput
+    measurement (defaults to 16 MiB).
+
+  -c, --chunk-sizes=LIST
+
+    A comma separated list of chunk sizes used by the throughput
+    measurements (defaults to 1024,4096,16384,65536).
+
+  -o, --output=FILE
+
+    Save the results to the given filename (by default the results are
+    written to standard output).
+
+  -h, --help
+
+    Show this message and exit.
+"""
+
+# Standard library modules.
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+# External dependencies.
+from humanfriendly.terminal import usage, warning
+
+# Modules included in our package.
+from capturer import (
+    STDERR_FD,
+    STDOUT_FD,
+    SUPPORTED_ENGINES,
+    SUPPORTED_TRANSPORTS,
+    CaptureOutput,
+    CapturePool,
+    OutputBuffer,
+    Stream,
+    __version__,
+    start_forkserver,
+)
+
+DEFAULT_ITERATIONS = 50
+"""The default number of times that each latency measurement is repeated (an integer)."""
+
+DEFAULT_SIZE = 1024 * 1024 * 16
+"""The default number of bytes of output generated by throughput measurements (an integer)."""
+
+DEFAULT_CHUNK_SIZES = (1024, 4096, 16384, 65536)
+"""The default chunk sizes used by throughput measurements (a tuple of integers)."""
+
+LINE_LENGTH = 80
+"""The length of the lines of output generated by throughput measurements (an integer)."""
+
+BURST_SIZE = 1024 * 256
+"""The number of bytes of output written at once by producer stall measurements (an integer)."""
+
+BURST_INTERVAL = 0.01
+"""The number of seconds that producer stall measurements wait between bursts of output (a number)."""
+
+CONFIGURATIONS = (
+    ('merged', dict(merged=True)),
+    ('adaptive', dict(merged=True, max_chunk_size=1024 * 1024)),
+    ('zero-copy', dict(merged=True, zero_copy=True)),
+    ('pipe', dict(merged=True, transport='pipe')),
+    ('separate', dict(merged=False)),
+    ('multiplexed', dict(merged=False, multiplexed=True)),
+)
+"""
+The capture configurations measured by the benchmarks (a tuple of tuples with
+two values each: a name and a dictionary of keyword arguments for
+:class:`~capturer.CaptureOutput`).
+"""
+
+# Use the most accurate clock available.
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def main():
+    """Command line interface for ``python -m capturer.benchmarks``."""
+    options = dict()
+    filename = None
+    try:
+        opts, arguments = getopt.getopt(sys.argv[1:], 'i:s:c:o:h', [
+            'iterations=', 'size=', 'chunk-sizes=', 'output=', 'help',
+        ])
+        for option, value in opts:
+            if option in ('-i', '--iterations'):
+                options['iterations'] = int(value)
+            elif option in ('-s', '--size'):
+                options['size'] = int(value)
+            elif option in ('-c', '--chunk-sizes'):
+                options['chunk_sizes'] = tuple(int(n) for n in value.split(','))
+            elif option in ('-o', '--output'):
+                filename = value
+            elif option in ('-h', '--help'):
+                usage(__doc__)
+                return
+        unknown = [name for name in arguments if name not in BENCHMARKS]
+        if unknown:
+            raise ValueError("Unknown benchmark(s): %s" % ", ".join(unknown))
+    except Exception as e:
+        warning("Error: %s", e)
+        sys.exit(1)
+    report = run_benchmarks(arguments or None, **options)
+    encoded = json.dumps(report, indent=2, sort_keys=True)
+    if filename:
+        with open(filename, 'w') as handle:
+            handle.write(encoded + '\n')
+    else:
+        print(encoded)
+
+
+def run_benchmarks(names=None, iterations=DEFAULT_ITERATIONS, size=DEFAULT_SIZE, chunk_sizes=DEFAULT_CHUNK_SIZES):
+    """
+    Run one or more benchmarks.
+
+    :param names: A list of benchmark names (strings) or :data:`None` to run
+                  all benchmarks (the keys of :data:`BENCHMARKS`).
+    :param iterations: The number of times that each latency measurement is
+                       repeated (an integer).
+    :param size: The number of bytes of output generated by each throughput
+                 measurement (an integer).
+    :param chunk_sizes: The chunk sizes used by throughput measurements (an
+                        iterable of integers).
+    :returns: A dictionary with the keys ``metadata`` and ``results`` that
+              can be serialized to JSON.
+    """
+    options = BenchmarkOptions(iterations=iterations, size=size, chunk_sizes=chunk_sizes)
+    results = {}
+    with SilencedOutput():
+        for name in (names or sorted(BENCHMARKS)):
+            results[name] = BENCHMARKS[name](options)
+    return dict(metadata=get_metadata(options), results=results)
+
+
+def get_metadata(options):
+    """
+    Get metadata about the environment in which the benchmarks were run.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary that can be serialized to JSON.
+    """
+    return dict(
+        capturer_version=__version__,
+        python_implementation=platform.python_implementation(),
+        python_version=platform.python_version(),
+        platform=platform.platform(),
+        timestamp=time.time(),
+        iterations=options.iterations,
+        size=options.size,
+        chunk_sizes=list(options.chunk_sizes),
+    )
+
+
+def benchmark_startup(options):
+    """
+    Measure the latency of :func:`~capturer.CaptureOutput.start_capture()` and
+    :func:`~capturer.CaptureOutput.finish_capture()`.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary with the results for each combination of relay
+              engine and capture configuration (including captures that use
+              a :class:`~capturer.CapturePool`), for relay processes started
+              using each of the available :mod:`multiprocessing` start
+              methods and for captures whose scope is ``'python'``.
+    """
+    results = {}
+    for engine, name, kw in iterate_configurations():
+        results['%s/%s' % (engine, name)] = measure_startup(options.iterations, engine=engine, **kw)
+    for method in getattr(multiprocessing, 'get_all_start_methods', lambda: ['fork'])():
+        if method == 'forkserver':
+            start_forkserver()
+        results['process/%s' % method] = measure_startup(options.iterations, start_method=method)
+    results['python-scope'] = measure_startup(options.iterations, scope='python')
+    for engine in SUPPORTED_ENGINES:
+        with CapturePool(engine=engine) as pool:
+            results['%s/pooled' % engine] = measure_startup(options.iterations, pool=pool)
+    return results
+
+
+def measure_startup(iterations, **options):
+    """
+    Measure the latency of starting and finishing captures.
+
+    :param iterations: The number of captures to measure (an integer).
+    :param options: Any keyword arguments are passed on to
+                    :class:`~capturer.CaptureOutput`.
+    :returns: A dictionary with the keys ``start_capture`` and ``finish_capture``.
+    """
+    start_times = []
+    finish_times = []
+    for i in range(iterations):
+        capturer = CaptureOutput(**options)
+        started = timer()
+        capturer.start_capture()
+        finishing = timer()
+        capturer.finish_capture()
+        finished = timer()
+        start_times.append(finishing - started)
+        finish_times.append(finished - finishing)
+    return dict(
+        start_capture=summarize(start_times),
+        finish_capture=summarize(finish_times),
+    )
+
+
+def benchmark_throughput(options):
+    """
+    Measure the sustained throughput of the capture loop for different chunk sizes.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary with the results for each combination of relay
+              engine and capture configuration.
+
+    The elapsed time includes :func:`~capturer.CaptureOutput.finish_capture()`
+    to make sure that all output was actually stored before the clock stops.
+    """
+    results = {}
+    for engine, name, kw in iterate_configurations():
+        results['%s/%s' % (engine, name)] = dict(
+            (str(chunk_size), measure_throughput(options.size, chunk_size=chunk_size, engine=engine, **kw))
+            for chunk_size in options.chunk_sizes
+        )
+    return results
+
+
+def benchmark_queue_overhead(options):
+    """
+    Measure the per-chunk overhead of the ``merged=False`` queue path.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary with the results for each relay engine.
+
+    The same amount of output is captured with ``merged=True`` (where output
+    is relayed directly) and ``merged=False`` (where output is relayed through
+    a queue) using the smallest chunk size. The difference in elapsed time is
+    divided by the number of chunks that were relayed.
+    """
+    results = {}
+    chunk_size = min(options.chunk_sizes)
+    for engine in SUPPORTED_ENGINES:
+        direct = measure_throughput(options.size, chunk_size=chunk_size, engine=engine, merged=True)
+        queued = measure_throughput(options.size, chunk_size=chunk_size, engine=engine, merged=False)
+        num_chunks = max(1, options.size // chunk_size)
+        results[engine] = dict(
+            chunk_size=chunk_size,
+            chunks=num_chunks,
+            direct_seconds=direct['seconds'],
+            queued_seconds=queued['seconds'],
+            seconds_per_chunk=(queued['seconds'] - direct['seconds']) / num_chunks,
+        )
+    return results
+
+
+def benchmark_accessors(options):
+    """
+    Measure the cost of getting at the captured output of a large capture.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary with the results for each accessor method. The
+              ``cold`` result is the duration of the first call on a fresh
+              capture, the ``cached`` results summarize the calls after that.
+    """
+    accessors = (
+        ('get_buffer', lambda capturer: capturer.get_buffer()),
+        ('get_bytes', lambda capturer: capturer.get_bytes()),
+        ('get_text', lambda capturer: capturer.get_text()),
+        ('get_text_raw', lambda capturer: capturer.get_text(interpreted=False)),
+        ('get_lines', lambda capturer: capturer.get_lines()),
+        ('get_lines_raw', lambda capturer: capturer.get_lines(interpreted=False)),
+    )
+    results = {}
+    for name, accessor in accessors:
+        capturer = CaptureOutput()
+        with capturer:
+            generate_output(options.size)
+        results['size'] = len(capturer.get_buffer())
+        started = timer()
+        accessor(capturer)
+        cold = timer() - started
+        timings = []
+        for i in range(max(1, options.iterations // 10)):
+            started = timer()
+            accessor(capturer)
+            timings.append(timer() - started)
+        results[name] = dict(cold=cold, cached=summarize(timings))
+    return results
+
+
+def benchmark_line_buffering(options):
+    """
+    Measure how the line buffering of relayed output scales with the line length.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary with the results for each line length.
+
+    A single line of output without line breaks (the worst case) is added to
+    an :class:`~capturer.OutputBuffer` (without a maximum line length) in
+    chunks of the smallest chunk size, for lines of a quarter, half and the
+    full output size. Because line buffering takes linear time the
+    ``seconds_per_mb`` values should be roughly the same for each line length.
+    """
+    results = {}
+    chunk = b'x' * min(options.chunk_sizes)
+    null_fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        for line_length in (options.size // 4, options.size // 2, options.size):
+            buffer = OutputBuffer(null_fd, max_line_length=None)
+            num_chunks = max(1, line_length // len(chunk))
+            started = timer()
+            for i in range(num_chunks):
+                buffer.add(chunk)
+            buffer.add(b'\n')
+            elapsed = timer() - started
+            results[str(line_length)] = dict(
+                seconds=elapsed,
+                seconds_per_mb=elapsed / (num_chunks * len(chunk) / 1024.0 / 1024.0),
+            )
+    finally:
+        os.close(null_fd)
+    return results
+
+
+def benchmark_producer_stall(options):
+    """
+    Measure how long a producer of bursty output is blocked, for each transport.
+
+    :param options: A :class:`BenchmarkOptions` object.
+    :returns: A dictionary with the results for each combination of relay
+              engine and transport (see :func:`measure_stall()`).
+
+    The buffer of a pseudo terminal only holds a few KiB of output, so a
+    producer that writes a burst of output is blocked until the relay worker
+    has read most of it. A pipe whose capacity was raised can absorb the
+    burst, so the producer can continue right away.
+    """
+    results = {}
+    for engine in SUPPORTED_ENGINES:
+        for transport in SUPPORTED_TRANSPORTS:
+            results['%s/%s' % (engine, transport)] = measure_stall(options.size, engine=engine, transport=transport)
+    return results
+
+
+def measure_stall(size, **options):
+    """
+    Measure how long writing bursts of output blocks while the output is being captured.
+
+    :param size: The number of bytes of output to generate (an integer).
+    :param options: Any keyword arguments are passed on to
+                    :class:`~capturer.CaptureOutput`.
+    :returns: A dictionary with the keys ``bursts``, ``stalled_seconds`` (the
+              total time spent writing) and ``max_stall_seconds`` (the
+              longest time spent writing a single burst).
+
+    Output is written in bursts of :data:`BURST_SIZE` bytes, separated by
+    :data:`BURST_INTERVAL` seconds (during which the producer would be doing
+    something else, giving the relay worker time to catch up).
+    """
+    line = b'x' * (LINE_LENGTH - 1) + b'\n'
+    burst = (line * (BURST_SIZE // len(line) + 1))[:BURST_SIZE]
+    stalls = []
+    with CaptureOutput(**options):
+        for i in range(max(1, size // BURST_SIZE)):
+            started = timer()
+            written = 0
+            while written < len(burst):
+                written += os.write(STDOUT_FD, burst[written:])
+            stalls.append(timer() - started)
+            time.sleep(BURST_INTERVAL)
+    return dict(
+        bursts=len(stalls),
+        stalled_seconds=sum(stalls),
+        max_stall_seconds=max(stalls),
+    )
+
+
+def measure_throughput(size, **options):
+    """
+    Measure how long it takes to capture the given amount of output.
+
+    :param size: The number of bytes of output to generate (an integer).
+    :param options: Any keyword arguments are passed on to
+                    :class:`~capturer.CaptureOutput`.
+    :returns: A dictionary with the keys ``seconds`` and ``mb_per_second``.
+    """
+    capturer = CaptureOutput(**options)
+    started = timer()
+    with capturer:
+        generate_output(size)
+    elapsed = timer() - started
+    return dict(seconds=elapsed, mb_per_second=size / elapsed / 1024.0 / 1024.0)
+
+
+def generate_output(size):
+    """
+    Write lines of output to the standard output stream.
+
+    :param size: The number of bytes of output to write (an integer).
+    """
+    line = b'x' * (LINE_LENGTH - 1) + b'\n'
+    block = line * max(1, 65536 // len(line))
+    remaining = size
+    while remaining > 0:
+        remaining -= os.write(STDOUT_FD, block[:remaining])
+
+
+def iterate_configurations():
+    """
+    Iterate over the combinations of relay engines and capture configurations.
+
+    :returns: A generator of tuples with three values each: The name of the
+              relay engine, the name of the capture configuration and a
+              dictionary of keyword arguments for :class:`~capturer.CaptureOutput`.
+    """
+    for engine in SUPPORTED_ENGINES:
+        for name, kw in CONFIGURATIONS:
+            yield engine, name, kw
+
+
+def summarize(samples):
+    """
+    Summarize a list of timings.
+
+    :param samples: A list of numbers.
+    :returns: A dictionary with the keys ``min``, ``max``, ``mean`` and ``median``.
+    """
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2.0
+    return dict(
+        min=ordered[0],
+        max=ordered[-1],
+        mean=sum(ordered) / float(len(ordered)),
+        median=median,
+    )
+
+
+class BenchmarkOptions(object):
+
+    """Container for the options that control the benchmarks."""
+
+    def __init__(self, iterations=DEFAULT_ITERATIONS, size=DEFAULT_SIZE, chunk_sizes=DEFAULT_CHUNK_SIZES):
+        """
+        Initialize a :class:`BenchmarkOptions` object.
+
+        Refer to :func:`run_benchmarks()` for details about the arguments.
+        """
+        self.iterations = iterations
+        self.size = size
+        self.chunk_sizes = tuple(chunk_sizes)
+
+
+class SilencedOutput(object):
+
+    """Context manager that redirects the standard output and error streams to /dev/null."""
+
+    def __enter__(self):
+        """Redirect the standard output and error streams to /dev/null."""
+        for handle in (sys.stdout, sys.stderr):
+            handle.flush()
+        fds = set([STDOUT_FD, STDERR_FD, sys.stdout.fileno(), sys.stderr.fileno()])
+        self.null_fd = os.open(os.devnull, os.O_WRONLY)
+        self.streams = [Stream(fd) for fd in sorted(fds)]
+        for stream in self.streams:
+            stream.redirect(self.null_fd)
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Restore the standard output and error streams."""
+        for stream in self.streams:
+            stream.restore()
+            os.close(stream.original_fd)
+        os.close(self.null_fd)
+
+
+BENCHMARKS = {
+    'accessors': benchmark_accessors,
+    'line-buffering': benchmark_line_buffering,
+    'producer-stall': benchmark_producer_stall,
+    'queue-overhead': benchmark_queue_overhead,
+    'startup': benchmark_startup,
+    'throughput': benchmark_throughput,
+}
+"""A dictionary that maps benchmark names to functions."""
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,24 @@
 # Easily capture stdout/stderr of the current process and subprocesses.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 7, 2020
+# Last Change: October 16, 2026
 # URL: https://capturer.readthedocs.io
 
 """Test suite for the `capturer` package."""
 
 # Standard library modules.
+import fcntl
+import json
+import logging
+import multiprocessing
 import os
+import re
 import subprocess
 import sys
 import tempfile
+import termios
+import threading
+import time
 import unittest
 
 # External dependencies.
@@ -18,13 +26,54 @@ from humanfriendly.terminal import clean_terminal_output
 from humanfriendly.testing import TestCase, random_string, retry
 
 # The module we're testing.
-from capturer import CaptureOutput, Stream
+from capturer import (
+    AdaptiveReader,
+    CaptureOutput,
+    CapturePool,
+    DecompressingReader,
+    RingBufferStorage,
+    SpooledStorage,
+    IncrementalLineDecoder,
+    LineProcessor,
+    OutputBuffer,
+    OutputNotifier,
+    ProcessorChain,
+    Stream,
+    TerminalInterpreter,
+    ZeroCopyRelay,
+    python_scope_captures,
+    start_forkserver,
+)
+from capturer.benchmarks import BENCHMARKS, run_benchmarks
+
+
+def redact_secret(line):
+    """Redact a secret from a line of output (a processor used in the test suite)."""
+    return line.replace(b'hunter2', b'*******')
+
+
+def drop_debug_lines(line):
+    """Drop lines that start with ``DEBUG`` (a processor used in the test suite)."""
+    return b'' if line.startswith(b'DEBUG') else line
+
+
+def swap_case(output):
+    """Swap the case of a chunk of output (a processor used in the test suite)."""
+    return output.swapcase()
 
 
 class CapturerTestCase(TestCase):
 
     """Container for the `capturer` test suite."""
 
+    engine = 'process'
+    """The name of the relay engine under test (a string)."""
+
+    def create_capturer(self, **options):
+        """Create a :class:`~capturer.CaptureOutput` object that uses the relay engine under test."""
+        options.setdefault('engine', self.engine)
+        return CaptureOutput(**options)
+
     def test_carriage_return_interpretation(self):
         """Sanity check the results of clean_terminal_output()."""
         # Simple output should pass through unharmed.
@@ -39,7 +88,7 @@ class CapturerTestCase(TestCase):
     def test_error_handling(self):
         """Test error handling code paths."""
         # Nested CaptureOutput.start_capture() calls should raise an exception.
-        capturer = CaptureOutput()
+        capturer = self.create_capturer()
         capturer.start_capture()
         try:
             self.assertRaises(TypeError, capturer.start_capture)
@@ -50,18 +99,38 @@ class CapturerTestCase(TestCase):
         stream = Stream(sys.stdout.fileno())
         stream.redirect(sys.stderr.fileno())
         self.assertRaises(TypeError, stream.redirect, sys.stderr.fileno())
+        # Unsupported relay engines should raise an exception.
+        self.assertRaises(ValueError, CaptureOutput, engine='carrier-pigeon')
+        # Capture pools don't support capturing stdout/stderr separately.
+        self.assertRaises(ValueError, CaptureOutput, merged=False, pool=CapturePool())
+        # Invalid ring buffer options should raise an exception.
+        self.assertRaises(ValueError, CaptureOutput, max_bytes=0)
+        self.assertRaises(ValueError, CaptureOutput, max_bytes=1024, keep='middle')
+        # Unsupported compression methods should raise an exception.
+        self.assertRaises(ValueError, CaptureOutput, compression='rar')
+        self.assertRaises(ValueError, CaptureOutput, compression='zlib', max_bytes=1024)
+        # Unsupported storage backends should raise an exception.
+        self.assertRaises(ValueError, CaptureOutput, backend='floppy')
+        self.assertRaises(ValueError, CaptureOutput, backend='spooled', compression='zlib')
+        self.assertRaises(ValueError, CaptureOutput, backend='memory')
+        # Unsupported scopes should raise an exception.
+        self.assertRaises(ValueError, CaptureOutput, scope='universe')
+        self.assertRaises(ValueError, CaptureOutput, scope='python', pool=CapturePool())
+        # Unsupported transports should raise an exception.
+        self.assertRaises(ValueError, CaptureOutput, transport='carrier-pigeon')
+        self.assertRaises(ValueError, CaptureOutput, transport='pipe', pool=CapturePool())
 
     def test_stdout_capture_same_process(self):
         """Test standard output capturing from the same process."""
         expected_stdout = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             print(expected_stdout)
             assert expected_stdout in capturer.get_lines()
 
     def test_stderr_capture_same_process(self):
         """Test standard error capturing from the same process."""
         expected_stderr = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             sys.stderr.write(expected_stderr + "\n")
             assert expected_stderr in capturer.get_lines()
 
@@ -69,7 +138,7 @@ class CapturerTestCase(TestCase):
         """Test combined standard output and error capturing from the same process."""
         expected_stdout = random_string()
         expected_stderr = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             sys.stdout.write(expected_stdout + "\n")
             sys.stderr.write(expected_stderr + "\n")
             assert expected_stdout in capturer.get_lines()
@@ -78,7 +147,7 @@ class CapturerTestCase(TestCase):
     def test_stdout_capture_subprocess(self):
         """Test standard output capturing from subprocesses."""
         expected_stdout = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             subprocess.call([
                 sys.executable,
                 '-c',
@@ -92,7 +161,7 @@ class CapturerTestCase(TestCase):
     def test_stderr_capture_subprocess(self):
         """Test standard error capturing from subprocesses."""
         expected_stderr = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             subprocess.call([
                 sys.executable,
                 '-c',
@@ -107,7 +176,7 @@ class CapturerTestCase(TestCase):
         """Test combined standard output and error capturing from subprocesses."""
         expected_stdout = random_string()
         expected_stderr = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             subprocess.call([
                 sys.executable,
                 '-c',
@@ -129,7 +198,7 @@ class CapturerTestCase(TestCase):
         cur_stderr = "Output from Python's sys.stderr.write() method"
         sub_stderr = "Output from subprocess stderr stream"
         sub_stdout = "Output from subprocess stdout stream"
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             # Emit multiple lines on both streams from current process and subprocess.
             print(cur_stdout_1)
             sys.stderr.write("%s\n" % cur_stderr)
@@ -150,7 +219,7 @@ class CapturerTestCase(TestCase):
         # `partial=False' by default :-).
         initial_part = random_string()
         later_part = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             sys.stderr.write("%s\n" % initial_part)
             retry(lambda: initial_part in capturer.get_lines(partial=True))
             sys.stderr.write("%s\n" % later_part)
@@ -159,21 +228,271 @@ class CapturerTestCase(TestCase):
     def test_non_interpreted_lines_capture(self):
         """Test that interpretation of special characters can be disabled."""
         expected_output = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             print(expected_output)
             assert expected_output in capturer.get_lines(interpreted=False)
 
     def test_text_capture(self):
         """Test that capturing of all output as a single string is supported."""
         expected_output = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             print(expected_output)
             assert expected_output in capturer.get_text()
 
+    def test_buffer_capture(self):
+        """Test that captured output can be accessed using a memory map."""
+        expected_output = random_string()
+        with self.create_capturer() as capturer:
+            assert capturer.get_buffer(partial=True) == b''
+            print(expected_output)
+            buffer = capturer.get_buffer()
+            assert buffer.find(expected_output.encode('ascii')) == 0
+            assert bytes(memoryview(buffer)[:len(expected_output)]) == expected_output.encode('ascii')
+            assert capturer.get_buffer() is buffer
+
+    def test_iter_lines(self):
+        """Test that captured output can be followed line by line while it's being captured."""
+        expected_lines = [random_string() for i in range(10)]
+        followed_lines = []
+        with self.create_capturer(relay=False) as capturer:
+            follower = threading.Thread(target=lambda: followed_lines.extend(capturer.iter_lines()))
+            follower.start()
+            for line in expected_lines:
+                print(line)
+                sys.stdout.flush()
+                time.sleep(0.01)
+            sys.stdout.write("partial line")
+        follower.join()
+        assert followed_lines == expected_lines + ["partial line"]
+        assert followed_lines == capturer.get_lines(interpreted=False)
+        # Once the capture has finished iteration ends immediately.
+        assert list(capturer.iter_lines()) == followed_lines
+        assert b''.join(capturer.iter_chunks()) == capturer.get_bytes()
+
+    def test_incremental_line_decoder(self):
+        """Test that output split into arbitrary chunks is decoded into the expected lines."""
+        output = u'caf\xe9\r\nna\xefve\rprogress\n\nlast'.encode('UTF-8')
+        expected_lines = output.decode('UTF-8').splitlines()
+        for chunk_size in range(1, len(output) + 1):
+            decoder = IncrementalLineDecoder('UTF-8')
+            lines = []
+            for i in range(0, len(output), chunk_size):
+                lines.extend(decoder.decode(output[i:i + chunk_size]))
+            lines.extend(decoder.decode(b'', final=True))
+            assert lines == expected_lines
+
+    def test_terminal_interpreter(self):
+        """Test that interpreting output in arbitrary chunks matches clean_terminal_output()."""
+        output = u'foo\rbar\n10%\b\b\b50%\r\x1b[K\x1b[1mdone\x1b[0m\n\n\nlast\b\b\bLA\r\n\n'
+        expected_lines = clean_terminal_output(output)
+        for chunk_size in range(1, len(output) + 1):
+            interpreter = TerminalInterpreter()
+            completed_lines = []
+            for i in range(0, len(output), chunk_size):
+                completed_lines.extend(interpreter.feed(output[i:i + chunk_size]))
+            completed_lines.extend(interpreter.feed(u'', final=True))
+            assert interpreter.get_lines() == expected_lines
+            assert completed_lines[:len(expected_lines)] == expected_lines
+        # Escape sequences other than 'erase line' can be stripped.
+        interpreter = TerminalInterpreter(strip_ansi=True)
+        interpreter.feed(u'\x1b[1')
+        interpreter.feed(u';32mbold\x1b')
+        interpreter.feed(u'[0m\rB\x1b[')
+        interpreter.feed(u'Kdone\n', final=True)
+        assert interpreter.get_lines() == [u'done']
+
+    def test_interpreted_partial_read(self):
+        """Test that interpreted output is kept up to date between partial reads."""
+        with self.create_capturer(relay=False) as capturer:
+            for i in range(0, 101, 10):
+                sys.stdout.write("\rprogress: %i%%" % i)
+                sys.stdout.flush()
+                retry(lambda: capturer.get_lines(partial=True) == ["progress: %i%%" % i])
+            print("\ndone")
+        raw_text = capturer.get_text(interpreted=False)
+        assert capturer.get_lines() == clean_terminal_output(raw_text)
+        assert capturer.get_text() == u'\n'.join(clean_terminal_output(raw_text))
+
+    def test_cached_views(self):
+        """Test that decoded views of the captured output are cached until more output arrives."""
+        with self.create_capturer(relay=False) as capturer:
+            print("first line")
+            retry(lambda: capturer.get_lines(partial=True) == ["first line"])
+            partial_text = capturer.get_text(partial=True)
+            assert capturer.get_text(partial=True) is partial_text
+            print("second line")
+        assert capturer.get_text() is not partial_text
+        assert capturer.get_text() is capturer.get_text()
+        assert capturer.get_bytes() is capturer.get_bytes()
+        assert capturer.get_text(interpreted=False) is capturer.get_text(interpreted=False)
+        # Callers can't modify the cached lines.
+        lines = capturer.get_lines()
+        assert lines == ["first line", "second line"]
+        lines.append("third line")
+        assert capturer.get_lines() == ["first line", "second line"]
+
+    def test_output_cursor(self):
+        """Test that output captured since a checkpoint can be read without reading all output."""
+        with self.create_capturer(relay=False) as capturer:
+            os.write(sys.stdout.fileno(), b'first line\n')
+            retry(lambda: capturer.get_bytes(partial=True) == b'first line\r\n')
+            checkpoint = capturer.mark()
+            cursor = capturer.create_cursor(checkpoint)
+            assert capturer.read_new() == b'first line\r\n'
+            # Split a multi byte character between reads.
+            os.write(sys.stdout.fileno(), b'caf\xc3')
+            retry(lambda: capturer.get_bytes(partial=True, since=checkpoint) == b'caf\xc3')
+            assert cursor.read_text() == u'caf'
+            assert capturer.read_new() == b'caf\xc3'
+            os.write(sys.stdout.fileno(), b'\xa9 au lait')
+            retry(lambda: capturer.get_bytes(partial=True).endswith(b'lait'))
+            assert cursor.read_text() == u'\xe9 au lait'
+            assert capturer.read_new() == b'\xa9 au lait'
+            assert capturer.read_new() == b''
+        assert capturer.get_bytes(since=checkpoint) == b'caf\xc3\xa9 au lait'
+        lines_cursor = capturer.create_cursor()
+        assert lines_cursor.read_lines() == [u'first line', u'caf\xe9 au lait']
+        assert lines_cursor.read_lines() == []
+
+    def test_ring_buffer_storage(self):
+        """Test that a ring buffer keeps a bounded window of the output."""
+        storage = RingBufferStorage(max_bytes=10, keep='head+tail')
+        writer = storage.create_writer()
+        writer.write(b'0123')
+        assert storage.get_buffer() == b'0123'
+        writer.write(b'456789abcdef')
+        assert storage.get_size() == 16
+        assert storage.dropped_bytes == 6
+        assert storage.get_buffer() == b'01234bcdef'
+        # Offsets in the dropped output skip ahead to the tail.
+        assert storage.read(7) == (11, b'bcdef')
+        assert storage.read(2, 2) == (2, b'23')
+        # Output wraps around at the end of the ring buffer.
+        writer.write(b'ghi')
+        assert storage.read(11, 3) == (14, b'efg')
+        assert storage.get_handle().read() == b'01234efghi'
+        writer.close()
+
+    def test_bounded_capture(self):
+        """Test that the disk usage of captured output stays constant."""
+        for keep in ('tail', 'head+tail'):
+            with self.create_capturer(relay=False, max_bytes=1024, keep=keep) as capturer:
+                size_before = os.fstat(capturer.output.storage.output_handle.fileno()).st_size
+                for i in range(1000):
+                    print("line %i" % i)
+            assert os.fstat(capturer.output.storage.output_handle.fileno()).st_size == size_before
+            lines = capturer.get_lines()
+            assert lines[-1] == "line 999"
+            assert capturer.output.dropped_bytes == capturer.output.mark() - 1024
+            assert len(capturer.get_bytes()) == 1024
+            if keep == 'head+tail':
+                assert lines[0] == "line 0"
+            assert capturer.output.create_cursor().read_lines()[-1] == u"line 999"
+
+    def test_compressed_capture(self):
+        """Test that captured output can be compressed while it's being stored."""
+        for compression, module_name in (('zlib', 'gzip'), ('lzma', 'lzma')):
+            if compression == 'lzma' and sys.version_info[:2] < (3, 3):
+                continue
+            with self.create_capturer(relay=False, compression=compression) as capturer:
+                for i in range(1000):
+                    print("line %i" % i)
+                if compression == 'zlib':
+                    # Partial reads see all output captured so far.
+                    retry(lambda: capturer.get_lines(partial=True)[-1:] == ["line 999"])
+            assert capturer.get_lines() == ["line %i" % i for i in range(1000)]
+            compressed_size = os.fstat(capturer.output.storage.output_handle.fileno()).st_size
+            assert compressed_size * 3 < len(capturer.get_bytes())
+            # Reads are served by decompressing the stream (forward, a
+            # little backward or from the start).
+            storage = capturer.output.storage
+            expected_output = capturer.get_bytes()
+            for offset, size in ((0, 10), (100, 50), (120, 10), (8000, None), (5, 5)):
+                assert storage.read(offset, size) == (offset, expected_output[offset:offset + size if size else None])
+            assert storage.get_size() == len(expected_output)
+            assert storage.get_handle().read() == expected_output
+            # The compressed stream can be saved as is.
+            fd, temporary_file = tempfile.mkstemp()
+            try:
+                capturer.save_to_path(temporary_file, compressed=True)
+                with __import__(module_name).open(temporary_file) as handle:
+                    assert handle.read() == capturer.get_bytes()
+            finally:
+                os.unlink(temporary_file)
+            # Very compressible output doesn't expand into a large buffer.
+            with self.create_capturer(relay=False, compression=compression) as capturer:
+                sys.stdout.write("x" * (1024 * 1024))
+            reader = DecompressingReader(capturer.output.storage)
+            chunks = []
+            while True:
+                chunk = reader.read_chunk(4096)
+                if not chunk:
+                    break
+                assert len(reader.pending) <= 4096
+                chunks.append(chunk)
+            assert b''.join(chunks) == b"x" * (1024 * 1024)
+        # Only compressed output can be saved in compressed form.
+        with self.create_capturer(relay=False) as capturer:
+            print("not compressed")
+        self.assertRaises(ValueError, capturer.save_to_path, '/dev/null', compressed=True)
+
+    def test_storage_backends(self):
+        """Test that captured output can be stored in memory."""
+        if not hasattr(os, 'memfd_create'):
+            return self.skipTest("memory backed files require Python 3.8+ on Linux")
+        expected_lines = ["line %i" % i for i in range(100)]
+        for backend in ('memfd', 'spooled'):
+            for spool_size in (100, 1024 * 1024):
+                with self.create_capturer(relay=False, backend=backend, spool_size=spool_size) as capturer:
+                    for line in expected_lines:
+                        print(line)
+                assert capturer.get_lines() == expected_lines
+                if backend == 'spooled':
+                    assert capturer.output.storage.spilled == (spool_size == 100)
+                    assert not os.path.exists(capturer.output.storage.spill_path)
+        # A spill file left behind by a relay worker that died is unlinked.
+        storage = SpooledStorage(spool_size=100)
+        with open(storage.spill_path, 'wb'):
+            pass
+        storage.finish()
+        assert not storage.spilled
+        assert not os.path.exists(storage.spill_path)
+
+    def test_timestamped_output(self):
+        """Test that the time when each chunk of output was captured is recorded."""
+        with self.create_capturer(relay=False) as capturer:
+            print("first line")
+            sys.stdout.flush()
+            retry(lambda: capturer.get_bytes(partial=True) == b'first line\r\n')
+            checkpoint = time.monotonic()
+            print("second line")
+            sys.stdout.flush()
+            retry(lambda: len(capturer.get_lines(partial=True, with_timestamps=True)) == 2)
+            print("third\rTHIRD line")
+        lines = capturer.get_lines(with_timestamps=True)
+        assert [line for timestamp, line in lines] == ["first line", "second line", "THIRD line"]
+        assert lines[0][0] < checkpoint <= lines[1][0] <= lines[2][0]
+        assert capturer.get_timestamped_lines() == lines
+        assert capturer.get_bytes(start_time=checkpoint) == b'second line\r\nthird\rTHIRD line\r\n'
+        assert capturer.get_bytes(end_time=checkpoint) == b'first line\r\n'
+        assert capturer.get_bytes(start_time=time.monotonic()) == b''
+        raw_lines = capturer.get_lines(interpreted=False, with_timestamps=True)
+        assert [line for timestamp, line in raw_lines] == ["first line", "second line", "third", "THIRD line"]
+        # Lines aren't split where the head and the ring of a ring buffer meet.
+        with self.create_capturer(relay=False, max_bytes=20, keep='head+tail') as capturer:
+            print("abcdefghijklmn")
+        assert capturer.get_lines() == ["abcdefghijklmn"]
+        assert [line for timestamp, line in capturer.get_lines(with_timestamps=True)] == ["abcdefghijklmn"]
+        # Timestamps can be disabled.
+        with self.create_capturer(relay=False, timestamps=False) as capturer:
+            print("no timestamps")
+        self.assertRaises(TypeError, capturer.get_lines, with_timestamps=True)
+        self.assertRaises(TypeError, capturer.get_bytes, start_time=0)
+
     def test_save_to_path(self):
         """Test that captured output can be stored in a file."""
         expected_output = random_string()
-        with CaptureOutput() as capturer:
+        with self.create_capturer() as capturer:
             print(expected_output)
             fd, temporary_file = tempfile.mkstemp()
             try:
@@ -183,16 +502,494 @@ class CapturerTestCase(TestCase):
             finally:
                 os.unlink(temporary_file)
 
+    def test_output_buffer(self):
+        """Test that relayed output is buffered until a line break (or the maximum line length)."""
+        read_fd, write_fd = os.pipe()
+        try:
+            buffer = OutputBuffer(write_fd, max_line_length=10)
+            buffer.add(b'foo')
+            buffer.add(b'bar\nba')
+            assert os.read(read_fd, 1024) == b'foobar\n'
+            buffer.add(b'z\nqux\nquu')
+            assert os.read(read_fd, 1024) == b'baz\nqux\n'
+            # Long lines are flushed in pieces.
+            buffer.add(b'x' * 10)
+            assert os.read(read_fd, 1024) == b'quu' + b'x' * 10
+            buffer.add(b'y')
+            buffer.flush()
+            assert os.read(read_fd, 1024) == b'y'
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
     def test_unmerged_capture(self):
         """Test that standard output and error can be captured separately."""
         expected_stdout = random_string()
         expected_stderr = random_string()
-        with CaptureOutput(merged=False) as capturer:
+        with self.create_capturer(merged=False) as capturer:
             sys.stdout.write(expected_stdout + "\n")
             sys.stderr.write(expected_stderr + "\n")
             assert expected_stdout in capturer.stdout.get_lines()
             assert expected_stderr in capturer.stderr.get_lines()
 
+    def test_combined_output(self):
+        """Test that the output of separately captured streams can be combined (when the relays keep up)."""
+        for kw in (dict(merged=False), dict(merged=False, multiplexed=True)):
+            with self.create_capturer(relay=False, **kw) as capturer:
+                for i in range(3):
+                    for name, handle in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+                        line = "line %i on %s" % (i, name)
+                        handle.write(line + "\n")
+                        handle.flush()
+                        # Give the relay worker(s) a chance to store the output.
+                        retry(lambda: capturer.get_combined_lines(partial=True)[-1:] == [line])
+            expected_lines = ["line %i on %s" % (i, name) for i in range(3) for name in ('stdout', 'stderr')]
+            assert capturer.get_combined_lines() == expected_lines
+            assert capturer.get_combined_text() == "\n".join(expected_lines)
+            assert [stream for stream, output in capturer.get_combined_chunks()] == [1, 2] * 3
+            # The separate streams are unaffected.
+            assert capturer.stdout.get_lines() == expected_lines[0::2]
+            assert capturer.stderr.get_lines() == expected_lines[1::2]
+
+    def test_combined_output_limits(self):
+        """Test that combined output is only ordered per relay read (writes in quick succession may be grouped)."""
+        for kw in (dict(merged=False), dict(merged=False, engine='thread'), dict(merged=False, multiplexed=True)):
+            with self.create_capturer(relay=False, **kw) as capturer:
+                # Alternate between the streams without waiting for the relay worker(s).
+                for i in range(200):
+                    handle = sys.stdout if i % 2 == 0 else sys.stderr
+                    handle.write("%i\n" % i)
+                    handle.flush()
+            numbers = [int(line) for line in capturer.get_combined_lines()]
+            # No output is lost or duplicated, however the interleaving isn't
+            # guaranteed, only the order of the output of each stream.
+            assert sorted(numbers) == list(range(200))
+            assert [n for n in numbers if n % 2 == 0] == list(range(0, 200, 2))
+            assert [n for n in numbers if n % 2 == 1] == list(range(1, 200, 2))
+        # The indexes of both streams share a log whose entries are numbered
+        # in the order in which the chunks were stored.
+        assert capturer.stdout.index.output_handle is capturer.stderr.index.output_handle
+        sequence_numbers = sorted(r[0] for t in (capturer.stdout, capturer.stderr) for r in t.index.get_ranges(0))
+        assert sequence_numbers == list(range(len(sequence_numbers)))
+        # Output written to sys.stdout and sys.stderr by the current process
+        # is stored by the writing thread, so the order is exact.
+        with self.create_capturer(scope='python', relay=False, merged=False) as capturer:
+            for i in range(200):
+                handle = sys.stdout if i % 2 == 0 else sys.stderr
+                handle.write("%i\n" % i)
+        assert capturer.get_combined_lines() == [str(i) for i in range(200)]
+        assert [stream for stream, output in capturer.get_combined_chunks()] == [1, 2] * 100
+
+    def test_python_scope(self):
+        """Test that output written to sys.stdout and sys.stderr can be captured without a pseudo terminal."""
+        handler = logging.StreamHandler(sys.stderr)
+        logger = logging.getLogger('capturer.tests')
+        logger.addHandler(handler)
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+        try:
+            with self.create_capturer(scope='python', relay=False) as capturer:
+                print("first line")
+                sys.stderr.write("second line\n")
+                logger.warning("third line")
+                assert capturer.output.master_fd is None
+                assert capturer.get_lines(partial=True) == ["first line", "second line", "third line"]
+        finally:
+            logger.removeHandler(handler)
+        assert sys.stdout is original_stdout and sys.stderr is original_stderr
+        assert handler.stream is original_stderr
+        assert capturer.get_text() == "first line\nsecond line\nthird line"
+        assert len(capturer.get_lines(with_timestamps=True)) == 3
+        fd, temporary_file = tempfile.mkstemp()
+        try:
+            capturer.save_to_path(temporary_file)
+            with open(temporary_file, 'rb') as handle:
+                assert handle.read() == b"first line\nsecond line\nthird line\n"
+        finally:
+            os.unlink(temporary_file)
+        # Output can be captured separately and combined in the original order.
+        with self.create_capturer(scope='python', relay=False, merged=False) as capturer:
+            sys.stdout.write("stdout\n")
+            sys.stderr.write("stderr\n")
+        assert capturer.stdout.get_lines() == ["stdout"]
+        assert capturer.stderr.get_lines() == ["stderr"]
+        assert capturer.get_combined_lines() == ["stdout", "stderr"]
+        # The capture switches to the 'fd' scope when a subprocess is spawned.
+        with self.create_capturer(scope='python', relay=False) as capturer:
+            print("before")
+            if not hasattr(sys, 'addaudithook'):
+                capturer.switch_to_fd_scope()
+            subprocess.call(['echo', 'subprocess'])
+            assert capturer.output.master_fd is not None
+            print("after")
+        assert capturer.get_lines() == ["before", "subprocess", "after"]
+
+    def test_nested_python_scope(self):
+        """Test that starting a relay process doesn't switch enclosing captures to the 'fd' scope."""
+        with self.create_capturer(scope='python') as outer:
+            print("outer")
+            with CaptureOutput(engine='process', relay=False) as inner:
+                print("inner")
+                assert outer.output.master_fd is None
+                if hasattr(sys, 'addaudithook'):
+                    assert outer in python_scope_captures
+        assert inner.get_text() == "inner"
+        assert outer.get_lines() == ["outer", "inner"]
+
+    def test_pipe_transport(self):
+        """Test that output can be captured using a pipe instead of a pseudo terminal."""
+        for kw in (dict(), dict(merged=False), dict(zero_copy=True)):
+            with self.create_capturer(relay=False, transport='pipe', **kw) as capturer:
+                print("current process")
+                sys.stdout.flush()
+                subprocess.call(['echo', 'subprocess'])
+                terminal = capturer.stdout if 'merged' in kw else capturer.output
+                assert not os.isatty(terminal.slave_fd)
+                if sys.platform.startswith('linux'):
+                    assert fcntl.fcntl(terminal.slave_fd, getattr(fcntl, 'F_GETPIPE_SZ', 1032)) >= 65536
+            # Pipes don't translate line feeds.
+            assert terminal.get_bytes() == b"current process\nsubprocess\n"
+
+    def test_capture_stats(self):
+        """Test that statistics about captures are collected and reported."""
+        for kw in (dict(), dict(merged=False), dict(merged=False, multiplexed=True), dict(scope='python')):
+            reports = []
+            with self.create_capturer(stats_callback=reports.append, **kw) as capturer:
+                for i in range(10):
+                    print("line %i" % i)
+                    sys.stdout.flush()
+            stats = capturer.stats
+            assert reports == [stats]
+            assert stats.start_capture_seconds > 0
+            assert stats.finish_capture_seconds > 0
+            terminal = capturer.output if 'merged' not in kw else capturer.stdout
+            assert sorted(stats.streams) == (['output'] if 'merged' not in kw else ['stderr', 'stdout'])
+            assert stats.streams['output' if 'merged' not in kw else 'stdout'] is terminal.stats
+            assert terminal.get_lines() == ["line %i" % i for i in range(10)]
+            assert terminal.stats.bytes_captured == len(terminal.get_bytes())
+            assert terminal.stats.decode_seconds > 0
+            if kw.get('scope') != 'python':
+                assert terminal.stats.read_calls > 0
+                average = float(terminal.stats.bytes_captured) / terminal.stats.read_calls
+                assert terminal.stats.average_chunk_size == average
+            if kw == dict(merged=False):
+                # Output is relayed through the queue.
+                assert stats.queued_chunks > 0
+                assert stats.max_queue_depth > 0
+            assert json.loads(json.dumps(stats.to_dict())) == stats.to_dict()
+            # The callback is only called once.
+            capturer.finish_capture()
+            assert len(reports) == 1
+
+    def test_processor_chain(self):
+        """Test that line processors only see complete lines."""
+        seen = []
+        chain = ProcessorChain([LineProcessor(lambda line: seen.append(line) or line), swap_case])
+        assert chain.process(b'foo\rbar') == b''
+        assert chain.process(b'\nbaz\nqu') == b'FOO\rBAR\nBAZ\n'
+        assert chain.process(b'', final=True) == b'QU'
+        assert seen == [b'foo\rbar\n', b'baz\n', b'qu']
+
+    def test_chunk_processors(self):
+        """Test that the stored and relayed copies of the output are processed separately."""
+        store_processors = [LineProcessor(redact_secret), LineProcessor(drop_debug_lines)]
+        relay_processors = [swap_case]
+        for kw in (dict(), dict(merged=False), dict(merged=False, multiplexed=True), dict(scope='python')):
+            with self.create_capturer() as outer:
+                with self.create_capturer(store_processors=store_processors,
+                                          relay_processors=relay_processors, **kw) as capturer:
+                    print("password: hunter2")
+                    print("DEBUG noise")
+                    sys.stdout.write("no line break")
+                    sys.stdout.flush()
+                terminal = capturer.output if 'merged' not in kw else capturer.stdout
+                assert terminal.get_lines() == ["password: *******", "no line break"]
+                assert "PASSWORD: HUNTER2" in outer.get_text()
+                assert "debug NOISE" in outer.get_text()
+        # Processors disable zero copy relaying.
+        with self.create_capturer(relay=False, zero_copy=True, store_processors=[swap_case]) as capturer:
+            print("zero copy")
+        assert capturer.get_lines() == ["ZERO COPY"]
+
+    def test_wait_for(self):
+        """Test that waiting for a pattern wakes up as soon as the pattern is captured."""
+        def produce():
+            for chunk in ("starting\n", "listen", "ing on port ", "8080\n"):
+                time.sleep(0.05)
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+        for kw in (dict(), dict(merged=False), dict(merged=False, multiplexed=True),
+                   dict(scope='python'), dict(compression='zlib')):
+            with self.create_capturer(relay=False, **kw) as capturer:
+                terminal = capturer.output if 'merged' not in kw else capturer.stdout
+                thread = threading.Thread(target=produce)
+                thread.start()
+                # The pattern spans several chunks.
+                match, offset = terminal.wait_for(re.compile(br'listening on port (\d+)'), timeout=10)
+                assert match.group(1) == b'8080'
+                assert offset == terminal.get_bytes(partial=True).index(b'listening')
+                thread.join()
+                assert terminal.wait_for(u'port', timeout=10)[1] == offset + len(b'listening on ')
+                # Waiting times out.
+                assert terminal.wait_for(b'port', offset=offset + len(b'listening on p'), timeout=0.1) is None
+        # Waiting ends when the capture is finished.
+        with CapturePool(engine=self.engine) as pool:
+            capturer = CaptureOutput(pool=pool, relay=False)
+            capturer.start_capture()
+            timer = threading.Timer(0.2, capturer.finish_capture)
+            timer.start()
+            assert capturer.wait_for(b'never') is None
+            timer.join()
+
+    def test_concurrent_wait_for(self):
+        """Test that threads waiting for the same capture don't consume each other's notifications."""
+        # A notification consumed by one thread still wakes up the others.
+        notifier = OutputNotifier()
+        generation = notifier.generation
+        os.write(notifier.write_fd, b'\n')
+        notifier.wait(generation, timeout=10)
+        assert notifier.generation == generation + 1
+        started = time.time()
+        notifier.wait(generation, timeout=10)
+        assert time.time() - started < 5
+        os.close(notifier.write_fd)
+        # Several threads wait for output that stops after the match.
+        for kw in (dict(), dict(merged=False, multiplexed=True), dict(scope='python')):
+            with self.create_capturer(relay=False, **kw) as capturer:
+                terminal = capturer.output if 'merged' not in kw else capturer.stdout
+                results = {}
+
+                def wait(pattern):
+                    results[pattern] = terminal.wait_for(pattern, timeout=10)
+                threads = [threading.Thread(target=wait, args=(pattern,)) for pattern in (b'first', b'second')]
+                for thread in threads:
+                    thread.start()
+                time.sleep(0.1)
+                sys.stdout.write("first\n")
+                sys.stdout.flush()
+                time.sleep(0.05)
+                sys.stdout.write("second\n")
+                sys.stdout.flush()
+                for thread in threads:
+                    thread.join()
+                assert results[b'first'] is not None
+                assert results[b'second'] is not None
+
+    def test_start_methods(self):
+        """Test that relay processes can be started using each of the multiprocessing start methods."""
+        self.assertRaises(ValueError, CaptureOutput, start_method='unsupported')
+        if self.engine != 'process':
+            return self.skipTest("start methods only apply to relay processes")
+        for method in getattr(multiprocessing, 'get_all_start_methods', lambda: ['fork'])():
+            if method == 'forkserver':
+                start_forkserver()
+            for kw in (dict(), dict(merged=False), dict(merged=False, multiplexed=True)):
+                expected_output = random_string()
+                with self.create_capturer(relay=False, start_method=method,
+                                          store_processors=[LineProcessor(redact_secret)], **kw) as capturer:
+                    print("password: hunter2")
+                    subprocess.call(['echo', expected_output])
+                    terminal = capturer.output if 'merged' not in kw else capturer.stdout
+                    assert terminal.wait_for(expected_output, timeout=10)
+                assert terminal.get_lines() == ["password: *******", expected_output]
+            with CapturePool(start_method=method) as pool:
+                for i in range(2):
+                    expected_output = random_string()
+                    with CaptureOutput(pool=pool, relay=False) as capturer:
+                        print(expected_output)
+                    assert capturer.get_lines() == [expected_output]
+
+    def test_multiplexed_capture(self):
+        """Test that standard output and error can be captured separately by a single loop."""
+        expected_stdout = random_string()
+        expected_stderr = random_string()
+        with self.create_capturer(merged=False, multiplexed=True) as capturer:
+            sys.stdout.write(expected_stdout + "\n")
+            sys.stderr.write(expected_stderr + "\n")
+            assert expected_stdout in capturer.stdout.get_lines()
+            assert expected_stderr in capturer.stderr.get_lines()
+        assert capturer.multiplexer is not None
+        assert not capturer.processes
+
+    def test_multiplexed_relay(self):
+        """Test that output captured separately by a single loop is relayed line by line."""
+        expected_stdout = random_string()
+        expected_stderr = random_string()
+        with self.create_capturer() as outer:
+            with self.create_capturer(merged=False, multiplexed=True) as inner:
+                sys.stdout.write(expected_stdout + "\n")
+                sys.stderr.write(expected_stderr + "\n")
+                sys.stdout.write("no line break")
+            assert expected_stdout in inner.stdout.get_lines()
+            assert expected_stderr in inner.stderr.get_lines()
+            lines = outer.get_lines()
+            assert expected_stdout in lines
+            assert expected_stderr in lines
+            assert "no line break" in lines
+
+    def test_capture_pool(self):
+        """Test that pooled pseudo terminals and relay workers are reused between captures."""
+        with CapturePool(engine=self.engine) as pool:
+            terminals = set()
+            for i in range(5):
+                expected_output = random_string()
+                with self.create_capturer() as outer:
+                    with CaptureOutput(pool=pool) as capturer:
+                        terminals.add(capturer.output.terminal)
+                        print(expected_output)
+                        # Terminal settings are reset between captures.
+                        attributes = termios.tcgetattr(sys.stdout.fileno())
+                        assert attributes[3] & termios.ECHO
+                        attributes[3] &= ~termios.ECHO
+                        termios.tcsetattr(sys.stdout.fileno(), termios.TCSANOW, attributes)
+                    assert capturer.get_lines() == [expected_output]
+                    assert capturer.output.drained_offset == len(capturer.get_bytes())
+                    # The captured output was relayed to the outer capture.
+                    assert expected_output in outer.get_lines()
+            # All captures used the same pseudo terminal and relay worker.
+            assert len(terminals) == 1
+            assert pool.idle == list(terminals)
+            # Concurrent captures get their own pseudo terminal.
+            first = CaptureOutput(pool=pool, relay=False)
+            first.start_capture()
+            second = CaptureOutput(pool=pool, relay=False)
+            second.start_capture()
+            assert first.output.terminal is not second.output.terminal
+            second.finish_capture()
+            first.finish_capture()
+            assert len(pool.idle) == 2
+        assert not pool.idle
+
+    def test_async_capture(self):
+        """Test that output can be captured in the event loop using :mod:`asyncio`."""
+        if sys.version_info[:2] < (3, 5):
+            return self.skipTest("asyncio integration requires Python 3.5+")
+        import asyncio
+        from capturer.aio import AsyncCaptureOutput
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            # Capture the output of a subprocess without redirecting our own.
+            capturer = AsyncCaptureOutput(relay=False, redirect=False)
+            loop.run_until_complete(capturer.__aenter__())
+            chunks = capturer.__aiter__()
+            process = loop.run_until_complete(asyncio.create_subprocess_exec(
+                'echo', 'hello world', stdout=capturer.fileno(), stderr=capturer.fileno(),
+            ))
+            assert loop.run_until_complete(process.wait()) == 0
+            assert loop.run_until_complete(chunks.__anext__()) == b'hello world\r\n'
+            loop.run_until_complete(capturer.__aexit__())
+            self.assertRaises(StopAsyncIteration, loop.run_until_complete, chunks.__anext__())
+            assert capturer.get_lines() == ['hello world']
+            # Capture the output of the current process.
+            expected_output = random_string()
+            with self.create_capturer() as outer:
+                capturer = AsyncCaptureOutput()
+                loop.run_until_complete(capturer.__aenter__())
+                print(expected_output)
+                loop.run_until_complete(capturer.__aexit__())
+                assert capturer.get_lines() == [expected_output]
+                # The captured output was relayed to the outer capture.
+                assert expected_output in outer.get_lines()
+            # Only a subset of the options of CaptureOutput is supported.
+            self.assertRaises(TypeError, AsyncCaptureOutput, merged=False)
+            # The capture must be started from the running event loop.
+            if hasattr(asyncio, 'get_running_loop'):
+                self.assertRaises(RuntimeError, AsyncCaptureOutput().start_capture)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_adaptive_reader(self):
+        """Test that the read size adapts to the amount of pending output."""
+        read_fd, write_fd = os.pipe()
+        try:
+            for use_ioctl in (True, False):
+                reader = AdaptiveReader(16, 1024)
+                reader.use_ioctl = use_ioctl
+                # Bulk output should result in large reads.
+                os.write(write_fd, b'x' * 4096)
+                sizes = []
+                while sum(sizes) < 4096:
+                    sizes.append(len(reader.read(read_fd)))
+                assert max(sizes) == 1024
+                # Trickling output should result in small reads.
+                for i in range(10):
+                    os.write(write_fd, b'x')
+                    assert len(reader.read(read_fd)) == 1
+                assert reader.size == 16 or use_ioctl
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_adaptive_capture(self):
+        """Test that output is captured correctly when the read size adapts."""
+        expected_lines = [random_string() for i in range(1000)]
+        with self.create_capturer(relay=False, max_chunk_size=1024 * 64) as capturer:
+            sys.stdout.write('\n'.join(expected_lines) + '\n')
+            sys.stdout.flush()
+            assert capturer.get_lines() == expected_lines
+
+    def test_zero_copy_capture(self):
+        """Test that output can be captured and relayed without copying it into Python."""
+        expected_lines = [random_string() for i in range(100)]
+        with self.create_capturer() as outer:
+            with self.create_capturer(zero_copy=True) as inner:
+                sys.stdout.write('\n'.join(expected_lines) + '\n')
+                sys.stdout.flush()
+            assert inner.get_lines() == expected_lines
+            relayed_lines = outer.get_lines()
+            assert all(line in relayed_lines for line in expected_lines)
+
+    def test_zero_copy_fallback(self):
+        """Test that zero-copy relaying falls back to copying when splice() isn't supported."""
+        if not ZeroCopyRelay.is_supported():
+            return self.skipTest("splice() and tee() aren't supported on this platform")
+        source_fd, writer_fd = os.pipe()
+        output_fd, output_file = tempfile.mkstemp()
+        relay_fd, relay_file = tempfile.mkstemp()
+        # Regular files opened in append mode don't support splice().
+        append_fd = os.open(relay_file, os.O_WRONLY | os.O_APPEND)
+        relay = ZeroCopyRelay(source_fd, output_fd, append_fd, 1024)
+        try:
+            os.write(writer_fd, b'zero-copy')
+            assert relay.transfer() == len(b'zero-copy')
+            assert not relay.enabled
+            for filename in (output_file, relay_file):
+                with open(filename, 'rb') as handle:
+                    assert handle.read() == b'zero-copy'
+        finally:
+            relay.close()
+            for fd in (source_fd, writer_fd, output_fd, relay_fd, append_fd):
+                os.close(fd)
+            for filename in (output_file, relay_file):
+                os.unlink(filename)
+
+    def test_drain_on_finish(self):
+        """Test that finishing a capture stores all pending output without a termination delay."""
+        for kw in (dict(merged=True), dict(merged=False), dict(merged=False, multiplexed=True)):
+            expected_output = b'x' * (1024 * 256)
+            with self.create_capturer(relay=False, termination_delay=0, **kw) as capturer:
+                os.write(sys.stdout.fileno(), expected_output)
+            pseudo_terminal = capturer.output if kw['merged'] else capturer.stdout
+            captured_output = pseudo_terminal.get_bytes()
+            assert captured_output == expected_output
+            assert pseudo_terminal.drained_offset == len(expected_output)
+
+    def test_benchmarks(self):
+        """Test that the benchmarks run and report their results in JSON format."""
+        report = run_benchmarks(iterations=2, size=1024 * 32, chunk_sizes=[1024, 4096])
+        assert sorted(report['results']) == sorted(BENCHMARKS)
+        assert json.loads(json.dumps(report)) == report
+        for name, results in report['results']['throughput'].items():
+            assert sorted(results) == ['1024', '4096']
+
+
+class ThreadEngineTestCase(CapturerTestCase):
+
+    """Run the `capturer` test suite using the thread based relay engine."""
+
+    engine = 'thread'
+
 
 if __name__ == '__main__':
     unittest.main()